@@ -0,0 +1,46 @@
+"""Time the SymbolFinder on synthetic modules of increasing size
+
+Extraction time per line should stay roughly flat as the module grows, eg::
+
+    python benchmarks/bench_ast_symbol_extractor.py --sizes 250 500 1000 2000
+"""
+import argparse
+import ast
+import time
+
+from symbol_exporter.ast_symbol_extractor import SymbolFinder
+
+
+def make_module(n):
+    lines = [f"from pkg{i} import name{i}" for i in range(n)]
+    lines += [f"import mod{i} as alias{i}" for i in range(n)]
+    for i in range(n):
+        lines += [
+            f"def func{i}(a, b=None):",
+            f"    x = name{i}(a) + alias{i}.attr.call(b)",
+            f"    return func{max(i - 1, 0)}(x, b=undeclared{i})",
+        ]
+    return "\n".join(lines)
+
+
+def time_extraction(code, repeat):
+    tree = ast.parse(code)
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        SymbolFinder(module_name="bench").visit(tree)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", nargs="+", type=int, default=[250, 500, 1000, 2000, 4000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    for n in args.sizes:
+        code = make_module(n)
+        elapsed = time_extraction(code, args.repeat)
+        n_lines = code.count("\n") + 1
+        print(f"{n_lines:>8} lines  {elapsed:8.4f} s  {elapsed / n_lines * 1e6:8.2f} us/line")
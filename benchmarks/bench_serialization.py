@@ -0,0 +1,71 @@
+"""Time the serializers on the symbols of a large artifact
+
+The payload is harvested from a local artifact, eg python or botocore::
+
+    python benchmarks/bench_serialization.py --artifact botocore-1.20.112-pyhd8ed1ab_0.tar.bz2
+
+or extracted from a directory of sources, by default the standard library of the running python::
+
+    python benchmarks/bench_serialization.py --path /path/to/site-packages/botocore
+"""
+import argparse
+import io
+import json
+import sys
+import sysconfig
+import time
+
+from symbol_exporter.ast_db_populator import harvest_imports
+from symbol_exporter.ast_package_symbol_extractor import DirectorySymbolFinder
+from symbol_exporter.serialization import SERIALIZERS, make_json_friendly
+from symbol_exporter.tools import artifact_format
+
+
+def payload_from_directory(path):
+    symbols = DirectorySymbolFinder(path).extract_symbols()
+    return {"metadata": {"top level symbols": set(k.partition(".")[0] for k in symbols)}, "symbols": symbols}
+
+
+def legacy_dumps(data):
+    # what reap_imports used to do
+    f = io.StringIO()
+    json.dump(data, f, indent=1, sort_keys=True, default=make_json_friendly)
+    return f.getvalue().encode()
+
+
+def best_of(func, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--artifact", help="local .tar.bz2 or .conda artifact to harvest")
+    parser.add_argument("--path", default=sysconfig.get_paths()["stdlib"], help="directory of sources to extract")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.artifact:
+        with open(args.artifact, "rb") as f:
+            data = harvest_imports(f, artifact_format(args.artifact))
+    else:
+        data = payload_from_directory(args.path)
+    if not data:
+        sys.exit("Nothing harvested")
+    print(f"{len(data['symbols'])} symbols")
+
+    elapsed, body = best_of(lambda: legacy_dumps(data), args.repeat)
+    print(f"{'json indent=1':>14}  dumps {elapsed:8.4f} s  {len(body) / 1e6:8.2f} MB")
+    for name, serializer_class in SERIALIZERS.items():
+        try:
+            serializer = serializer_class()
+        except ImportError as e:
+            print(f"{name:>14}  skipped, {e}")
+            continue
+        dump_time, body = best_of(lambda: serializer.dumps(data), args.repeat)
+        load_time, _ = best_of(lambda: serializer.loads(body), args.repeat)
+        print(f"{name:>14}  dumps {dump_time:8.4f} s  {len(body) / 1e6:8.2f} MB  loads {load_time:8.4f} s")
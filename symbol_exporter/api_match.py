@@ -1,12 +1,35 @@
 """tools for matching the volumes with artifacts that supply the symbols"""
+
+import logging
+import os
+import pickle
+import threading
 from concurrent.futures._base import as_completed
 from concurrent.futures.thread import ThreadPoolExecutor
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache
 from itertools import groupby
 
 from symbol_exporter.ast_symbol_extractor import builtin_symbols
-from symbol_exporter.db_access_model import WebDB
+from symbol_exporter.db_access_model import open_db, symbol_table_revision
+from symbol_exporter.disk_cache import DiskCache
+
+logger = logging.getLogger("api_match")
+logger.setLevel(logging.ERROR)
+
+# Environment variable holding the directory where symbol resolutions are kept between runs
+RESOLUTION_CACHE_ENV = "SYMBOL_EXPORTER_RESOLUTION_CACHE"
+RESOLUTION_CACHE_SIZE_ENV = "SYMBOL_EXPORTER_RESOLUTION_CACHE_SIZE"
+DEFAULT_RESOLUTION_CACHE_SIZE = 512 * 1024**2
+# Number of symbol tables fetched at once before resolving a volume
+PREFETCH_CONCURRENCY = int(os.environ.get("SYMBOL_EXPORTER_PREFETCH_CONCURRENCY", 16))
+# Length of the shadows chains followed when planning which tables a volume needs
+PREFETCH_DEPTH = 8
+# Number of decoded symbol tables a resolver keeps in memory
+RESOLVER_TABLES = int(os.environ.get("SYMBOL_EXPORTER_RESOLVER_TABLES", 256))
 
-web_interface = WebDB()
+web_interface = open_db()
 
 
 def recursive_get_from_table(symbol, get_symbol_table_func=web_interface.get_symbol_table, seen_symbols=set()):
@@ -46,22 +69,394 @@ def recursive_get_from_table(symbol, get_symbol_table_func=web_interface.get_sym
     return output_supply
 
 
-def find_supplying_version_set(volume, get_symbol_table_func=web_interface.get_symbol_table):
+class ResolutionCache(DiskCache):
+    """Stores the resolutions of the symbols of a top level name, keyed by the revision of its symbol table"""
+
+    suffix = ".pkl"
+
+    def __init__(self, directory, max_size=DEFAULT_RESOLUTION_CACHE_SIZE):
+        super().__init__(directory, max_size)
+
+    @classmethod
+    def from_env(cls):
+        directory = os.environ.get(RESOLUTION_CACHE_ENV)
+        if not directory:
+            return None
+        return cls(directory, max_size=int(os.environ.get(RESOLUTION_CACHE_SIZE_ENV, DEFAULT_RESOLUTION_CACHE_SIZE)))
+
+    def get(self, top_level_name, revision):
+        path = self._path(self.key(top_level_name, revision))
+        try:
+            with open(path, "rb") as f:
+                resolutions = pickle.load(f)
+        except FileNotFoundError:
+            self.misses += 1
+            return {}
+        except Exception as e:
+            logger.warning(f"Dropping unreadable cache entry {path}. {repr(e)}")
+            self._remove(path)
+            self.misses += 1
+            return {}
+        self._touch(path)
+        self.hits += 1
+        return resolutions
+
+    def put(self, top_level_name, revision, resolutions):
+        path = self._path(self.key(top_level_name, revision))
+        self._write(path, pickle.dumps(resolutions, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+class ArtifactBitsets:
+    """Artifact sets as bitsets over dense ids interned per top level name.
+
+    A set is a python int with one bit per artifact so intersecting two sets is a bitwise and over machine words
+    rather than hashing thousands of artifact paths. The bitset of a list of artifacts is remembered as long as the
+    list lives, which is as long as the ``SymbolResolver`` memo holding it.
+    """
+
+    # number of bitsets remembered before starting over
+    max_remembered = 100_000
+
+    def __init__(self):
+        self._ids = {}
+        self._names = {}
+        self._remembered = {}
+        self._lock = threading.Lock()
+
+    def bitset(self, top_level_name, artifacts) -> int:
+        remembered = self._remembered.get(id(artifacts))
+        if remembered is not None and remembered[0] is artifacts:
+            return remembered[1]
+        with self._lock:
+            ids = self._ids.setdefault(top_level_name, {})
+            names = self._names.setdefault(top_level_name, [])
+            artifact_ids = []
+            for artifact in artifacts:
+                if artifact not in ids:
+                    ids[artifact] = len(names)
+                    names.append(artifact)
+                artifact_ids.append(ids[artifact])
+        bits = bytearray(max(artifact_ids, default=0) // 8 + 1)
+        for i in artifact_ids:
+            bits[i >> 3] |= 1 << (i & 7)
+        bitset = int.from_bytes(bits, "little")
+        if len(self._remembered) >= self.max_remembered:
+            self._remembered = {}
+        # keep a reference to the list so its id can't be reused by another one
+        self._remembered[id(artifacts)] = artifacts, bitset
+        return bitset
+
+    def names(self, top_level_name, bitset: int) -> set:
+        names = self._names.get(top_level_name, [])
+        artifacts = set()
+        while bitset:
+            lowest = bitset & -bitset
+            artifacts.add(names[lowest.bit_length() - 1])
+            bitset ^= lowest
+        return artifacts
+
+
+class SymbolResolver:
+    """Memoized ``recursive_get_from_table``.
+
+    Both the resolved supplies and the longest prefix of a symbol found in its table are remembered, so symbols
+    sharing a prefix such as ``numpy.core`` only walk it once, and the shadows chains the indexer resolved with
+    ``ast_index.close_shadow_chains`` are a single lookup. Every resolution records the revisions of the
+    tables it was read from and is dropped as soon as one of them changes. A table is fetched once and kept
+    until it is one of the ``max_tables`` least recently used, only ``prefetched`` fetches it again and picks up
+    a new revision.
+    With a ``ResolutionCache`` the resolutions are saved for the next run every time ``autosave`` tables have
+    new ones and on ``save``.
+    The closures are read with ``get_shadow_closure_func``, by default the ``get_shadow_closure`` of the database
+    ``get_symbol_table_func`` belongs to.
+    Threads can share a resolver, at worst they resolve the same symbol twice.
+    """
+
+    def __init__(
+        self,
+        get_symbol_table_func=web_interface.get_symbol_table,
+        cache=None,
+        autosave=1000,
+        get_shadow_closure_func=None,
+        max_tables=RESOLVER_TABLES,
+    ):
+        self.get_symbol_table_func = get_symbol_table_func
+        if get_shadow_closure_func is None:
+            get_shadow_closure_func = getattr(
+                getattr(get_symbol_table_func, "__self__", None), "get_shadow_closure", None
+            )
+        self.get_shadow_closure_func = get_shadow_closure_func
+        self.cache = cache
+        self.autosave = autosave
+        self.max_tables = max_tables
+        self.hits = 0
+        self.misses = 0
+        self._init_state()
+
+    def _init_state(self):
+        self._tables = OrderedDict()
+        self._closures = {}
+        self._prefixes = {}
+        self._resolved = {}
+        self._loaded = set()
+        self._unsaved = set()
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self.bitsets = ArtifactBitsets()
+
+    def __getstate__(self):
+        names = [
+            "get_symbol_table_func",
+            "get_shadow_closure_func",
+            "cache",
+            "autosave",
+            "max_tables",
+            "hits",
+            "misses",
+        ]
+        return {k: self.__dict__[k] for k in names}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_state()
+
+    def _table(self, top_level_name):
+        """The symbol table and its revision, forgetting the prefixes read from an older revision"""
+        with self._lock:
+            known = self._tables.get(top_level_name)
+            if known is not None:
+                self._tables.move_to_end(top_level_name)
+        prefetched = getattr(self._local, "tables", None)
+        if prefetched is not None and top_level_name in prefetched:
+            table = prefetched[top_level_name]
+        elif known is not None:
+            return known
+        else:
+            table = self.get_symbol_table_func(top_level_name)
+        if known is not None and known[0] is table:
+            return known
+        revision = symbol_table_revision(table)
+        with self._lock:
+            if known is not None and known[1] != revision:
+                self._prefixes.pop(top_level_name, None)
+            self._tables[top_level_name] = table, revision
+            while len(self._tables) > self.max_tables:
+                self._evict(*self._tables.popitem(last=False))
+        if self.cache is not None and (top_level_name, revision) not in self._loaded:
+            self._loaded.add((top_level_name, revision))
+            for symbol, resolution in self.cache.get(top_level_name, revision).items():
+                self._resolved.setdefault(symbol, resolution)
+        return table, revision
+
+    def _evict(self, top_level_name, known):
+        # the prefixes and closures go with the table, its new resolutions are saved before the revision is lost
+        self._prefixes.pop(top_level_name, None)
+        revision = known[1]
+        self._closures.pop((top_level_name, revision), None)
+        if self.cache is not None and top_level_name in self._unsaved:
+            self._unsaved.discard(top_level_name)
+            self._put(top_level_name, revision, list(self._resolved.items()))
+
+    def _lookup(self, symbol, top_level_name, symbol_table):
+        """The longest prefix of ``symbol`` in the table, the remaining children and the supply of the prefix"""
+        prefixes = self._prefixes.setdefault(top_level_name, {})
+        if symbol not in prefixes:
+            supply = symbol_table.get("symbol table", {}).get(symbol)
+            if supply is not None or "." not in symbol:
+                prefixes[symbol] = symbol, (), supply
+            else:
+                parent_symbol, _, child_symbol = symbol.rpartition(".")
+                prefix, children, supply = self._lookup(parent_symbol, top_level_name, symbol_table)
+                prefixes[symbol] = prefix, children + (child_symbol,), supply
+        return prefixes[symbol]
+
+    def _cached(self, symbol, seen_symbols):
+        resolution = self._resolved.get(symbol)
+        if resolution is None:
+            return None
+        output_supply, revisions, visited = resolution
+        # a resolution that went through a symbol already on the stack would have been cut short there
+        if not visited.isdisjoint(seen_symbols):
+            return None
+        if any(self._table(top_level_name)[1] != revision for top_level_name, revision in revisions.items()):
+            self._resolved.pop(symbol, None)
+            return None
+        return resolution
+
+    def _shadow_closure(self, top_level_name, revision):
+        """The closure the indexer stored for a table, read once per revision of the table"""
+        if self.get_shadow_closure_func is None:
+            return None
+        key = top_level_name, revision
+        if key not in self._closures:
+            prefetched = getattr(self._local, "closures", None)
+            if prefetched is not None and top_level_name in prefetched:
+                self._closures[key] = prefetched[top_level_name]
+            else:
+                self._closures[key] = self.get_shadow_closure_func(top_level_name)
+        return self._closures[key]
+
+    def _closure(self, symbol, top_level_name, revision):
+        """The resolution of ``symbol`` precomputed by the indexer, if it is still up to date"""
+        closure = self._shadow_closure(top_level_name, revision)
+        if not closure or symbol not in closure["symbols"]:
+            return None
+        revisions = closure["revisions"]
+        if any(self._table(top_level_name)[1] != revision for top_level_name, revision in revisions.items()):
+            return None
+        return closure["symbols"][symbol], revisions, frozenset({symbol}), frozenset()
+
+    def _resolve(self, symbol, seen_symbols):
+        """Returns the supply, the table revisions and symbols it depends on and the cycles it was cut at"""
+        top_level_name = symbol.partition(".")[0]
+        # fetched first so the resolutions saved for this revision of the table are loaded
+        symbol_table, revision = self._table(top_level_name)
+        closure = self._closure(symbol, top_level_name, revision)
+        if closure is not None:
+            self.hits += 1
+            return closure
+        cached = self._cached(symbol, seen_symbols)
+        if cached is not None:
+            self.hits += 1
+            return cached + (frozenset(),)
+        self.misses += 1
+        seen_symbols = seen_symbols | {symbol}
+        parent_symbol, children_symbols, supply = self._lookup(symbol, top_level_name, symbol_table)
+        output_supply = {}
+        revisions = {top_level_name: revision}
+        visited = {symbol}
+        cut_at = set()
+        for suplier in supply or []:
+            shadow = suplier.get("shadows")
+            if shadow:
+                new_symbol = ".".join((shadow,) + children_symbols)
+                if new_symbol in seen_symbols:
+                    output_supply.setdefault(parent_symbol, []).append(suplier["artifact name"])
+                    cut_at.add(new_symbol)
+                    continue
+                results, sub_revisions, sub_visited, sub_cut_at = self._resolve(new_symbol, seen_symbols)
+                revisions.update(sub_revisions)
+                visited |= sub_visited
+                cut_at |= sub_cut_at
+                if results:
+                    output_supply.setdefault(parent_symbol, []).append(suplier["artifact name"])
+                    output_supply.update({k: list(v) for k, v in results.items()})
+            # If not a shadows then we must have the full symbol
+            elif not children_symbols:
+                output_supply.setdefault(parent_symbol, []).append(suplier["artifact name"])
+        cut_at.discard(symbol)
+        visited = frozenset(visited)
+        # only resolutions that don't depend on where they were reached from are worth remembering
+        if not cut_at:
+            self._resolved[symbol] = output_supply, revisions, visited
+            self._unsaved.add(top_level_name)
+        return output_supply, revisions, visited, frozenset(cut_at)
+
+    def _plan(self, symbol):
+        """The symbols resolving ``symbol`` leads to and the tables its precomputed closure was read from"""
+        top_level_name = symbol.partition(".")[0]
+        symbol_table, revision = self._table(top_level_name)
+        closure = self._shadow_closure(top_level_name, revision)
+        if closure and symbol in closure["symbols"]:
+            return set(), set(closure["revisions"])
+        _, children_symbols, supply = self._lookup(symbol, top_level_name, symbol_table)
+        return {".".join((s["shadows"],) + children_symbols) for s in supply or [] if s.get("shadows")}, set()
+
+    @contextmanager
+    def prefetched(self, symbols, concurrency=PREFETCH_CONCURRENCY):
+        """Fetch the symbol tables needed to resolve ``symbols`` concurrently and resolve from those in this thread.
+
+        The plan starts from the top level names of ``symbols`` and follows their shadows entries, or the tables
+        listed by a precomputed closure, up to ``PREFETCH_DEPTH`` links. Anything it misses is fetched as usual.
+        """
+        tables = self._local.tables = {}
+        closures = self._local.closures = {}
+        try:
+            pending, closure_tables, seen = set(symbols), set(), set()
+            with ThreadPoolExecutor(concurrency) as pool:
+                for _ in range(PREFETCH_DEPTH):
+                    top_level_names = sorted(({s.partition(".")[0] for s in pending} | closure_tables) - set(tables))
+                    tables.update(zip(top_level_names, pool.map(self.get_symbol_table_func, top_level_names)))
+                    if self.get_shadow_closure_func is not None:
+                        closures.update(zip(top_level_names, pool.map(self.get_shadow_closure_func, top_level_names)))
+                    seen |= pending
+                    next_symbols = set()
+                    for symbol in pending:
+                        symbols_reached, tables_read = self._plan(symbol)
+                        next_symbols |= symbols_reached
+                        closure_tables |= tables_read
+                    pending = next_symbols - seen
+                    if not pending and closure_tables.issubset(tables):
+                        break
+            yield tables
+        finally:
+            self._local.tables = self._local.closures = None
+
+    def resolve(self, symbol):
+        """Same as ``recursive_get_from_table(symbol)``, the lists are shared with the memo and must not be changed"""
+        output_supply = self._resolve(symbol, frozenset())[0]
+        if self.cache is not None and len(self._unsaved) >= self.autosave:
+            self.save()
+        return output_supply
+
+    def save(self):
+        """Write the resolutions of the tables with new ones to the cache"""
+        if self.cache is None:
+            return
+        with self._lock:
+            unsaved, self._unsaved = self._unsaved, set()
+            resolved = list(self._resolved.items())
+            for top_level_name in unsaved:
+                # evicted while one of its symbols was being resolved, that one is resolved again next run
+                if top_level_name in self._tables:
+                    self._put(top_level_name, self._tables[top_level_name][1], resolved)
+
+    def _put(self, top_level_name, revision, resolved):
+        self.cache.put(
+            top_level_name,
+            revision,
+            {
+                symbol: resolution
+                for symbol, resolution in resolved
+                if symbol.partition(".")[0] == top_level_name and resolution[1].get(top_level_name) == revision
+            },
+        )
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit rate": self.hits / lookups if lookups else 0.0}
+
+
+def find_supplying_version_set(volume, get_symbol_table_func=web_interface.get_symbol_table, resolver=None):
+    """``resolver`` is a ``SymbolResolver`` shared between calls, by default one is made for this volume"""
+    if resolver is None:
+        resolver = SymbolResolver(get_symbol_table_func)
     effective_volume = sorted(volume - builtin_symbols)
+    bitsets = resolver.bitsets
     supplies = {}
     bad_symbols = set()
-    for v_symbol in effective_volume:
-        supply = recursive_get_from_table(v_symbol, get_symbol_table_func)
-        if not supply:
-            bad_symbols.add(v_symbol)
-            continue
-        for symbol, artifacts in supply.items():
-            top_level_symbol = symbol.partition(".")[0]
-            if top_level_symbol not in supplies:
-                supplies[top_level_symbol] = set(artifacts)
-            else:
-                supplies[top_level_symbol] &= set(artifacts)
-    return supplies or {}, bad_symbols
+    with resolver.prefetched(effective_volume):
+        for v_symbol in effective_volume:
+            supply = resolver.resolve(v_symbol)
+            if not supply:
+                bad_symbols.add(v_symbol)
+                continue
+            for symbol, artifacts in supply.items():
+                top_level_symbol = symbol.partition(".")[0]
+                bitset = bitsets.bitset(top_level_symbol, artifacts)
+                if top_level_symbol not in supplies:
+                    supplies[top_level_symbol] = bitset
+                else:
+                    supplies[top_level_symbol] &= bitset
+    return {k: bitsets.names(k, v) for k, v in supplies.items()}, bad_symbols
+
+
+@lru_cache(maxsize=2**16)
+def split_artifact_path(artifact_path):
+    """The package name and version of ``<package>/<channel>/<arch>/<name>-<version>-<build>``"""
+    package_name, channel, arch, artifact = artifact_path.split("/")
+    artifact_name, version, build_string = artifact.rsplit("-", 2)
+    return package_name, version
 
 
 def extract_artifacts_from_deps(deps):
@@ -73,8 +468,7 @@ def extract_artifacts_from_deps(deps):
         if not artifacts:
             continue
         for artifact_path in artifacts:
-            package_name, channel, arch, artifact = artifact_path.split("/")
-            artifact_name, version, build_string = artifact.rsplit("-", 2)
+            package_name, version = split_artifact_path(artifact_path)
             version_set.add(version)
         if package_name not in versions_by_package:
             versions_by_package[package_name] = version_set
@@ -1,38 +1,43 @@
 """Audit to derived the expected dependencies and version ranges for all extracted packages"""
-import bz2
-import glob
-import io
-import json
 import os
 import shutil
 from concurrent.futures._base import as_completed
 from concurrent.futures.thread import ThreadPoolExecutor
+from functools import lru_cache
 from random import shuffle
-from distributed.client import Client
-import dask.bag as db
 
-import requests
 from tqdm import tqdm
 
-from symbol_exporter.api_match import extract_artifacts_from_deps, find_supplying_version_set
-from symbol_exporter.ast_db_populator import make_json_friendly
+from symbol_exporter.api_match import (
+    extract_artifacts_from_deps,
+    find_supplying_version_set,
+    ResolutionCache,
+    SymbolResolver,
+)
 from symbol_exporter.ast_symbol_extractor import version, builtin_symbols
-from symbol_exporter.db_access_model import WebDB
-from symbol_exporter.tools import channel_list, find_version_ranges
+from symbol_exporter.db_access_model import open_db
+from symbol_exporter.serialization import get_serializer
+from symbol_exporter.tools import existing_versions, Manifest, VersionIndexes
 
 audit_version = "2.4"
+# Artifacts audited at once, the work is mostly waiting on the database
+AUDIT_THREADS = int(os.environ.get("SYMBOL_EXPORTER_AUDIT_THREADS", 100))
 
 complete_version = f"{version}_{audit_version}"
 
-web_interface = WebDB()
+web_interface = open_db()
+resolver = SymbolResolver(web_interface.get_symbol_table, cache=ResolutionCache.from_env())
 
 
-existing_versions_by_package = {}
-for channel in channel_list:
-    r = requests.get(f"{channel}/repodata.json.bz2")
-    repodata = json.load(bz2.BZ2File(io.BytesIO(r.content)))
-    for p, v in repodata["packages"].items():
-        existing_versions_by_package.setdefault(v["name"], set()).add(v["version"])
+@lru_cache(maxsize=None)
+def existing_versions_by_package():
+    # loaded on first use in each worker, from the repodata cache when it is warm
+    return existing_versions()
+
+
+@lru_cache(maxsize=None)
+def version_indexes():
+    return VersionIndexes(existing_versions_by_package())
 
 
 def inner_loop(artifact):
@@ -45,7 +50,7 @@ def inner_loop(artifact):
     # pull out self symbols, since we assume those are gotten locally and self consistent
     volume -= set(symbols)
     volume -= set(builtin_symbols)
-    deps, bad = find_supplying_version_set(volume)
+    deps, bad = find_supplying_version_set(volume, resolver=resolver)
     return deps, bad
 
 
@@ -56,13 +61,11 @@ def inner_loop_and_write(artifact):
     else:
         dep_sets, bad = result
         versions_by_package = extract_artifacts_from_deps(dep_sets)
-        version_ranges_by_package = {}
-        missing_versions_by_package = {}
-        for package, versions in versions_by_package.items():
-            version_ranges_by_package[package] = find_version_ranges(
-                existing_versions_by_package.get(package, set()), versions
-            )
-            missing_versions_by_package[package] = set(existing_versions_by_package.get(package, set())) - set(versions)
+        version_ranges_by_package = version_indexes().find_version_ranges_many(versions_by_package)
+        missing_versions_by_package = {
+            package: existing_versions_by_package().get(package, set()) - set(versions)
+            for package, versions in versions_by_package.items()
+        }
         output = {
             "deps": dep_sets,
             "bad": list(sorted(bad)),
@@ -73,8 +76,9 @@ def inner_loop_and_write(artifact):
         }
     outname = os.path.join("audit", artifact)
     os.makedirs(os.path.dirname(outname), exist_ok=True)
-    with open(outname, "w") as f:
-        json.dump(output, f, indent=1, sort_keys=True, default=make_json_friendly)
+    with open(outname, "wb") as f:
+        get_serializer("json").dump(output, f)
+    Manifest("audit").add(artifact)
 
 
 def main(n_to_pull=100):
@@ -94,16 +98,23 @@ def main(n_to_pull=100):
         f.write(complete_version)
 
     all_extracted_artifacts = web_interface.get_all_extracted_artifacts()
-    existing_artifacts = glob.glob(f"{path}/**/*.json", recursive=True)
-    existing_artifact_names = {k.partition("/")[2].replace(".json", "") for k in existing_artifacts}
+    manifest = Manifest(path)
+    existing_artifact_names = manifest.paths() if manifest.exists() else manifest.rebuild()
 
     artifacts = sorted(list(set(all_extracted_artifacts) - set(existing_artifact_names)))
 
     # Don't have the artifacts in alphabetical order
     shuffle(artifacts)
 
-    with Client(threads_per_worker=100):
-        db.from_sequence(artifacts[:n_to_pull]).map(inner_loop_and_write).compute()
+    # threads of this process rather than worker processes, so the resolver and the symbol table cache they share
+    # are the ones saved and reported below
+    with ThreadPoolExecutor(AUDIT_THREADS) as pool:
+        futures = [pool.submit(inner_loop_and_write, artifact) for artifact in artifacts[:n_to_pull]]
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            future.result()
+    resolver.save()
+    print(f"Symbol table cache: {web_interface.cache_stats()}")
+    print(f"Symbol resolutions: {resolver.stats()}")
 
 
 if __name__ == "__main__":
@@ -1,34 +1,58 @@
 """Stores the ast derived symbols in either github or CERN"""
+import contextlib
 import io
 import json
 import logging
 import os
+import posixpath
+import queue
 import shutil
 import tarfile
-import http
+import threading
+import zipfile
 from functools import partial
 from pathlib import Path
 from random import shuffle
-from tempfile import TemporaryDirectory
+from tempfile import mkstemp, SpooledTemporaryFile, TemporaryDirectory
 
-import dask.bag as db
 import requests
-from dask.diagnostics import ProgressBar
 from tqdm import tqdm
 
-from symbol_exporter.ast_package_symbol_extractor import DirectorySymbolFinder
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from symbol_exporter.ast_package_symbol_extractor import DirectorySymbolFinder, InMemoryPath, InMemoryTree
 from symbol_exporter.ast_symbol_extractor import version
-from symbol_exporter.db_access_model import make_json_friendly, WebDB
-from symbol_exporter.tools import diff, ReapFailure, fetch_upstream, existing, expand_file_and_mkdirs
+from symbol_exporter.db_access_model import open_db
+from symbol_exporter.tools import (
+    diff,
+    ReapFailure,
+    fetch_upstream,
+    existing,
+    expand_file_and_mkdirs,
+    artifact_format,
+    executor,
+    Manifest,
+)
 from symbol_exporter.python_so_extractor import parse_so
-
-ProgressBar().register()
+from symbol_exporter.serialization import get_serializer
+from symbol_exporter.sessions import get_session, TIMEOUTS
+from symbol_exporter.work_queue import WorkQueue
 
 logger = logging.getLogger("ast_db_populator")
 logger.setLevel(logging.ERROR)
 
 # TODO: push this into the web only branches so we don't require the secret to be set
-web_interface = WebDB()
+web_interface = open_db()
+
+# Most compressed bytes of a single artifact a worker keeps in memory, beyond this downloads wait on the
+# decompressor (.tar.bz2) or spill to disk (.conda)
+artifact_memory_ceiling = int(os.environ.get("SYMBOL_EXPORTER_ARTIFACT_MEMORY", 64 * 1024**2))
+DOWNLOAD_CHUNK_SIZE = 1024**2
+# Seconds after which the outstanding artifacts are diffed against upstream again, even if some are still queued
+QUEUE_REFRESH_SECONDS = int(os.environ.get("SYMBOL_EXPORTER_QUEUE_REFRESH_SECONDS", 24 * 3600))
 
 
 def single_so_file_extraction(so_file, top_dir):
@@ -43,7 +67,7 @@ def single_so_file_extraction(so_file, top_dir):
     return s
 
 
-def get_all_symbol_names(top_dir):
+def get_all_symbol_names(site: InMemoryPath):
     # Note ast seems to pick up things that are protected by a
     # __name__ == '__main__' if statement
     # this could cause some over-reporting of viable imports this
@@ -51,40 +75,68 @@ def get_all_symbol_names(top_dir):
     # to depend on those
     symbols_dict = {}
     # walk all the files looking for python files
-    site = Path(top_dir)
     for package in site.iterdir():
         dsf = DirectorySymbolFinder(package)
         symbols = dsf.extract_symbols()
         symbols_dict.update(symbols)
 
-    for file_name in site.rglob("*.so"):
-        sd = single_so_file_extraction(file_name, top_dir=top_dir)
-        symbols_dict.update(sd)
+    # the ELF reader needs real files so only the extension modules are written to disk
+    so_files = list(site.rglob("*.so"))
+    if so_files:
+        with TemporaryDirectory() as top_dir:
+            for so_file in so_files:
+                file_name = Path(top_dir) / so_file.relative_to(site)
+                file_name.parent.mkdir(parents=True, exist_ok=True)
+                file_name.write_bytes(so_file.read_bytes())
+                sd = single_so_file_extraction(file_name, top_dir=top_dir)
+                symbols_dict.update(sd)
 
     return symbols_dict
 
 
-def harvest_imports(io_like):
-    tf = tarfile.open(fileobj=io_like, mode="r:bz2")
-    # TODO: push dir allocation into thread?
-    with TemporaryDirectory() as f:
-        py_members = [
-            m for m in tf.getmembers() if m.name.endswith(".py") or (".cpython" in m.name and m.name.endswith(".so"))
-        ]
-        tf.extractall(path=f, members=py_members)
-        symbols = {}
-        found_sp = False
-        for root, subdirs, files in os.walk(f):
-            # only run if we have a site packages file or it is python itself
-            # todo pull up list of python versions or pull it from somewhere else
-            if root.lower().endswith("site-packages") or (
-                any(root.lower().endswith(f"python{k}") for k in ["2.7", "3.5", "3.6", "3.7", "3.8", "3.9"])
-                and "site-packages" not in subdirs
-            ):
-                found_sp = True
-                _symbols = get_all_symbol_names(root)
-                symbols.update(_symbols)
-    tf.close()
+def is_harvestable_member(name):
+    return name.endswith(".py") or (".cpython" in name and name.endswith(".so"))
+
+
+def read_harvestable_members(tf) -> InMemoryTree:
+    """Read the python files and extension modules out of a tarfile in a single pass over the stream"""
+    tree = InMemoryTree()
+    for member in tf:
+        if not is_harvestable_member(member.name):
+            continue
+        if member.isfile():
+            tree.add_file(member.name, tf.extractfile(member).read())
+        elif member.issym() or member.islnk():
+            # streams can't seek back, so links are only followed to members that have already been read
+            target = member.linkname
+            if member.issym():
+                target = posixpath.join(posixpath.dirname(member.name), target)
+            target_path = tree.path(posixpath.normpath(target).split("/"))
+            if target_path.is_file():
+                tree.add_file(member.name, target_path.read_bytes())
+    return tree
+
+
+def find_site_roots(tree: InMemoryTree):
+    for parts in tree.directories():
+        root = "/".join(parts).lower()
+        subdirs = {name for name in tree.children[parts] if parts + (name,) in tree.children}
+        # only run if we have a site packages file or it is python itself
+        # todo pull up list of python versions or pull it from somewhere else
+        if root.endswith("site-packages") or (
+            any(root.endswith(f"python{k}") for k in ["2.7", "3.5", "3.6", "3.7", "3.8", "3.9"])
+            and "site-packages" not in subdirs
+        ):
+            yield tree.path(parts)
+
+
+def harvest_tree(tree: InMemoryTree):
+    symbols = {}
+    found_sp = False
+    for root in find_site_roots(tree):
+        found_sp = True
+        _symbols = get_all_symbol_names(root)
+        symbols.update(_symbols)
     if not found_sp:
         return None
 
@@ -97,15 +149,45 @@ def harvest_imports(io_like):
     }
 
 
+@contextlib.contextmanager
+def open_conda_pkg_tarfile(io_like):
+    """Stream the members of the ``pkg-*.tar.zst`` archive inside a ``.conda`` artifact.
+
+    The ``info-*.tar.zst`` archive is never decompressed.
+    """
+    if zstandard is None:
+        raise ImportError("zstandard is required to read .conda artifacts")
+    with zipfile.ZipFile(io_like) as zf:
+        pkg_names = [n for n in zf.namelist() if n.startswith("pkg-") and n.endswith(".tar.zst")]
+        if not pkg_names:
+            raise ValueError("No pkg-*.tar.zst archive found in .conda artifact")
+        with zf.open(pkg_names[0]) as compressed:
+            decompressor = zstandard.ZstdDecompressor()
+            with decompressor.stream_reader(compressed, read_across_frames=True) as decompressed:
+                with tarfile.open(fileobj=decompressed, mode="r|") as tf:
+                    yield tf
+
+
+def open_artifact_tarfile(io_like, fmt=".tar.bz2"):
+    if fmt == ".conda":
+        return open_conda_pkg_tarfile(io_like)
+    # stream mode decompresses the archive exactly once and never extracts to disk
+    return tarfile.open(fileobj=io_like, mode="r|bz2")
+
+
+def harvest_imports(io_like, fmt=".tar.bz2"):
+    with open_artifact_tarfile(io_like, fmt) as tf:
+        tree = read_harvestable_members(tf)
+    return harvest_tree(tree)
+
+
 def reap_symbols_send_to_webserver(package, dst_path, src_url, filelike, progress_callback=None):
     if progress_callback:
         progress_callback()
     try:
-        harvested_data = harvest_imports(filelike)
+        harvested_data = harvest_imports(filelike, artifact_format(src_url))
         web_interface.send_to_webserver(harvested_data, package, dst_path)
         del harvested_data
-    except (http.client.RemoteDisconnected, requests.exceptions.RequestException) as e:
-        print(f"Failure: {package}, {src_url}, {str(e)}")
     except Exception as e:
         raise ReapFailure(package, src_url, str(e))
 
@@ -114,32 +196,118 @@ def reap_imports(root_path, package, dst_path, src_url, filelike, progress_callb
     if progress_callback:
         progress_callback()
     try:
-        harvested_data = harvest_imports(filelike)
-        with open(expand_file_and_mkdirs(os.path.join(root_path, package, dst_path)), "w") as fo:
-            json.dump(harvested_data, fo, indent=1, sort_keys=True, default=make_json_friendly)
+        harvested_data = harvest_imports(filelike, artifact_format(src_url))
+        dst = expand_file_and_mkdirs(os.path.join(root_path, package, dst_path))
+        # written aside and moved in place so a speculative copy of the same artifact can't interleave with it
+        fd, tmp_name = mkstemp(dir=os.path.dirname(dst), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fo:
+                get_serializer("json").dump(harvested_data, fo)
+            os.replace(tmp_name, dst)
+        except BaseException:
+            Path(tmp_name).unlink(missing_ok=True)
+            raise
+        Manifest(root_path).add(f"{package}/{dst_path}")
         del harvested_data
     except Exception as e:
         raise ReapFailure(package, src_url, str(e))
 
 
-def fetch_artifact(src_url):
-    resp = requests.get(src_url, timeout=60 * 2)
-    filelike = io.BytesIO(resp.content)
+class ResponseStream(io.RawIOBase):
+    """Read only, non seekable stream over the body of a streamed HTTP response.
+
+    A background thread downloads the body into a bounded queue so the download overlaps with decompression
+    while at most ``max_buffer`` bytes of the body are held in memory.
+    """
+
+    def __init__(self, resp, max_buffer=None, chunk_size=DOWNLOAD_CHUNK_SIZE):
+        max_buffer = max_buffer or artifact_memory_ceiling
+        self._resp = resp
+        self._queue = queue.Queue(maxsize=max(1, max_buffer // chunk_size))
+        self._stop = threading.Event()
+        self._buffer = memoryview(b"")
+        self._eof = False
+        self._thread = threading.Thread(target=self._download, args=(chunk_size,), daemon=True)
+        self._thread.start()
+
+    def _download(self, chunk_size):
+        try:
+            for chunk in self._resp.iter_content(chunk_size):
+                if chunk and not self._put(chunk):
+                    return
+            self._put(None)
+        except Exception as e:
+            self._put(e)
+        finally:
+            self._resp.close()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buffer:
+            if self._eof:
+                return 0
+            item = self._queue.get()
+            if item is None:
+                self._eof = True
+                return 0
+            if isinstance(item, Exception):
+                self._eof = True
+                raise item
+            self._buffer = memoryview(item)
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+    def close(self):
+        self._stop.set()
+        super().close()
+
+
+def spool_response(resp, max_memory=None):
+    """Download the body into a file that stays in memory up to ``max_memory`` bytes and then spills to disk"""
+    filelike = SpooledTemporaryFile(max_size=max_memory or artifact_memory_ceiling)
+    try:
+        for chunk in resp.iter_content(DOWNLOAD_CHUNK_SIZE):
+            filelike.write(chunk)
+    except Exception:
+        filelike.close()
+        raise
+    finally:
+        resp.close()
+    filelike.seek(0)
     return filelike
 
 
+def fetch_artifact(src_url, max_memory=None):
+    resp = get_session().get(src_url, timeout=TIMEOUTS["artifact"], stream=True)
+    # zip archives keep their index at the end of the file so .conda artifacts need to be seekable
+    if artifact_format(src_url) == ".conda":
+        return spool_response(resp, max_memory)
+    return ResponseStream(resp, max_buffer=max_memory)
+
+
 def fetch_and_run(path, pkg, dst, src_url, progess_callback=None):
     print(dst)
-    filelike = fetch_artifact(src_url)
-    reap_imports(path, pkg, dst, src_url, filelike, progress_callback=progess_callback)
-    filelike.close()
+    with contextlib.closing(fetch_artifact(src_url)) as filelike:
+        reap_imports(path, pkg, dst, src_url, filelike, progress_callback=progess_callback)
 
 
 def fetch_and_run_web(pkg, dst, src_url, progess_callback=None):
     print(dst)
-    filelike = fetch_artifact(src_url)
-    reap_symbols_send_to_webserver(pkg, dst, src_url, filelike, progress_callback=progess_callback)
-    filelike.close()
+    with contextlib.closing(fetch_artifact(src_url)) as filelike:
+        reap_symbols_send_to_webserver(pkg, dst, src_url, filelike, progress_callback=progess_callback)
 
 
 # todo pull this from the og list but reorder that list first
@@ -158,14 +326,45 @@ def only_python(metadata):
     return metadata["name"] == "python" or any("python" in k for k in metadata["depends"])
 
 
+def outstanding_artifacts(existing_pkg_dict):
+    """The ``(package, dst, src_url)`` of the upstream artifacts that aren't in ``existing_pkg_dict``, most
+    wanted first, and the size of each url"""
+    sizes = {}
+    upstream = fetch_upstream(only_python, sizes)
+    hubs_auths = requests.get(
+        "https://raw.githubusercontent.com/regro/cf-graph-countyfair/master/ranked_hubs_authorities.json"
+    ).json()
+
+    # Pull up and partial this out existing_pkgs
+    def diff_sort(val):
+        package, dst, src_url = val
+        arch = dst.split("/")[1]
+        idx = hubs_auths.index(package) if package in hubs_auths else len(hubs_auths)
+        return (
+            package in existing_pkg_dict,
+            idx,
+            sort_arch_ordering.index(arch),
+        )
+
+    pkgs_to_inspect = list(diff(upstream, existing_pkg_dict))
+    # shuffle so that we don't always get the same pkgs
+    shuffle(pkgs_to_inspect)
+    return sorted(pkgs_to_inspect, key=diff_sort), sizes
+
+
 def reap(
     path,
     known_bad_packages=(),
     number_to_reap=1000,
     single_thread=False,
     webserver=True,
+    queue_path=None,
+    refresh=False,
+    workers=None,
 ):
-    upstream = fetch_upstream(only_python)
+    """Reap the next ``number_to_reap`` artifacts of the work queue at ``queue_path``, ``path/_work_queue.sqlite``
+    by default, which is filled with the diff against upstream when it runs dry, is older than
+    ``QUEUE_REFRESH_SECONDS`` or ``refresh`` is set, on ``workers`` processes, by default one per CPU"""
     if not webserver:
         if os.path.exists(os.path.join(path, "_inspection_version.txt")):
             with open(os.path.join(path, "_inspection_version.txt")) as f:
@@ -179,48 +378,25 @@ def reap(
             with open(os.path.join(path, "_inspection_version.txt"), "w") as f:
                 f.write(version)
 
-        existing_pkg_dict = existing(path)
         fetch_and_run_function = partial(fetch_and_run, path)
     else:
-        existing_pkg_dict = web_interface.get_current_extracted_pkgs()
         fetch_and_run_function = fetch_and_run_web
 
-    hubs_auths = requests.get(
-        "https://raw.githubusercontent.com/regro/cf-graph-countyfair/master/ranked_hubs_authorities.json"
-    ).json()
-
-    # Pull up and partial this out existing_pkgs
-    def diff_sort(val):
-        package, dst, src_url = val
-        arch = dst.split("/")[1]
-        idx = hubs_auths.index(package) if package in hubs_auths else len(hubs_auths)
-        return (
-            package in existing_pkg_dict,
-            idx,
-            sort_arch_ordering.index(arch),
-        )
-
-    pkgs_to_inspect = list(diff(upstream, existing_pkg_dict))
-    # shuffle so that we don't always get the same pkgs
-    shuffle(pkgs_to_inspect)
-    sorted_files = sorted(pkgs_to_inspect, key=diff_sort)
-    print(f"TOTAL OUTSTANDING ARTIFACTS: {len(sorted_files)}")
-    sorted_files = sorted_files[:number_to_reap]
-
+    work_queue = WorkQueue(queue_path or os.path.join(path, "_work_queue.sqlite"), version=version)
+    if refresh or not work_queue.outstanding() or work_queue.age() > QUEUE_REFRESH_SECONDS:
+        existing_pkg_dict = existing(path) if not webserver else web_interface.get_current_extracted_pkgs()
+        work_queue.enqueue(*outstanding_artifacts(existing_pkg_dict))
+    work_queue.quarantine(known_bad_packages)
+    print(f"TOTAL OUTSTANDING ARTIFACTS: {work_queue.outstanding()}")
+    sorted_files = work_queue.lease(number_to_reap)
     if single_thread:
-        {
-            fetch_and_run_function(
-                package,
-                dst,
-                src_url,
-                # progress.update
-            ): (package, dst, src_url)
-            for package, dst, src_url in tqdm(sorted_files)
-            if (src_url not in known_bad_packages)
-        }
+        for package, dst, src_url in tqdm(sorted_files):
+            work_queue.run(fetch_and_run_function, package, dst, src_url)
     else:
-        # This uses processes by default, which is most likely ok
-        db.from_sequence(sorted_files).map(lambda x: fetch_and_run_function(*x)).compute()
+        workers = workers or os.cpu_count()
+        with executor("process", workers) as pool:
+            work_queue.run_batch(pool, fetch_and_run_function, sorted_files, workers)
+    print(work_queue.stats())
 
 
 if __name__ == "__main__":
@@ -238,6 +414,9 @@ if __name__ == "__main__":
     )
     parser.add_argument("--n_artifacts", help="number of artifacts to inspect", default=5000)
     parser.add_argument("--local", help="to local disk for storage", default=False)
+    parser.add_argument("--queue", help="path of the work queue, root_path/_work_queue.sqlite by default")
+    parser.add_argument("--refresh", action="store_true", help="diff against upstream even if work is queued")
+    parser.add_argument("--workers", type=int, help="number of processes, one per CPU by default")
 
     args = parser.parse_args()
     print(args)
@@ -253,4 +432,7 @@ if __name__ == "__main__":
         number_to_reap=int(args.n_artifacts),
         single_thread=bool(args.debug),
         webserver=not bool(args.local),
+        queue_path=args.queue,
+        refresh=args.refresh,
+        workers=args.workers,
     )
@@ -2,7 +2,8 @@
 Perform a reverse index of the symbols, creating the symbol table that maps symbols to the artifacts
 that provide them from AST derived symbols.
 """
-from collections import defaultdict
+
+from collections import defaultdict, deque
 
 import requests
 
@@ -37,52 +38,352 @@ CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
 OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
-from concurrent.futures._base import as_completed
+import os
+import pickle
+import tempfile
+import time
+import zlib
 from concurrent.futures.thread import ThreadPoolExecutor
 from itertools import groupby
-from random import shuffle
+from random import shuffle, uniform
 
 from tqdm import tqdm
-import dask.bag as db
-from dask.distributed import Client
 
 from symbol_exporter.ast_symbol_extractor import version
-from symbol_exporter.db_access_model import WebDB
+from symbol_exporter.db_access_model import (
+    apply_symbol_table_delta,
+    open_db,
+    symbol_table_revision,
+    SymbolTableConflict,
+    UnversionedSymbolTable,
+)
+
+# Number of records held in memory by the batch builder before they are spilled to disk
+SPILL_RECORDS = int(os.environ.get("SYMBOL_EXPORTER_INDEX_SPILL_RECORDS", 2_000_000))
+# Number of times a symbol table write is re-merged after losing a race with another writer
+CONFLICT_RETRIES = 10
+
+
+def artifact_records(artifact_name, symbols):
+    """The (top level name, symbol, symbol table entry) records ``artifact_name`` adds to the symbol tables"""
+    for symbol in sorted(symbols):
+        top_level_name = symbol.partition(".")[0].lower()
+        # carve out for star imports which don't have dots
+        if top_level_name == "*":
+            continue
+        entry = {"artifact name": artifact_name}
+        shadows = symbols[symbol].get("data", {}).get("shadows")
+        if shadows:
+            entry.update(shadows=shadows)
+        yield top_level_name, symbol, entry
+
+
+def merge_symbol_table(web_interface, top_level_name, records):
+    """Add the (symbol, entry) ``records`` of artifacts not yet indexed to the table.
+
+    Backends with ``delta_updates`` only receive the new entries. Others get the whole table pushed back with
+    a conditional write which is re-merged and retried when somebody else wrote the table in the meantime.
+    Returns the updated table, or only the new entries for delta updates, None when there was nothing to add.
+    """
+    # download the existing symbol table metadata
+    metadata = web_interface.get_symbol_table_metadata(top_level_name=top_level_name, revalidate=True)
+    indexed_artifacts = set(metadata.get("indexed artifacts", []))
+    records = [(symbol, entry) for symbol, entry in records if entry["artifact name"] not in indexed_artifacts]
+    if not records:
+        return None
+    new_artifacts = {}
+    delta_table = {}
+    for symbol, entry in records:
+        delta_table.setdefault(symbol, []).append(entry)
+        new_artifacts.setdefault(entry["artifact name"])
+    delta = {"symbol table": delta_table, "metadata": {"version": version, "indexed artifacts": list(new_artifacts)}}
+    if getattr(web_interface, "delta_updates", False):
+        try:
+            web_interface.push_symbol_table_delta(top_level_name, delta)
+        except requests.RequestException as e:
+            print(e)
+        return delta_table
+    # read, merge and write back until nobody else wrote the table in between
+    for attempt in range(CONFLICT_RETRIES + 1):
+        try:
+            symbol_table, table_version = web_interface.get_symbol_table_versioned(top_level_name)
+        except UnversionedSymbolTable as e:
+            print(f"Failure: {top_level_name}, no version to merge against {e!r}")
+            return None
+        indexed_artifacts = set(symbol_table.get("metadata", {}).get("indexed artifacts", []))
+        if indexed_artifacts.issuperset(new_artifacts):
+            return None
+        symbol_table = apply_symbol_table_delta(symbol_table, delta)
+        try:
+            web_interface.push_symbol_table(top_level_name, symbol_table, if_match=table_version)
+        except SymbolTableConflict:
+            time.sleep(uniform(0, 0.1 * 2**attempt))
+            continue
+        except requests.RequestException as e:
+            print(e)
+        return symbol_table["symbol table"]
+    print(f"Failure: {top_level_name}, still conflicting after {CONFLICT_RETRIES} retries")
+    return None
 
 
 def inner_loop(artifact_name):
-    web_interface = WebDB()
+    web_interface = open_db()
     symbols = web_interface.get_artifact_symbols(artifact_name)
     all_symbol_tables = {}
-    for top_level_name, keys in groupby(sorted(symbols), lambda x: x.partition(".")[0].lower()):
+    for top_level_name, records in groupby(artifact_records(artifact_name, symbols), lambda x: x[0]):
         print(top_level_name)
-        # carve out for star imports which don't have dots
-        if top_level_name == "*":
-            continue
-        # download the existing symbol table metadata
-        metadata = web_interface.get_symbol_table_metadata(top_level_name=top_level_name)
-        if artifact_name in metadata.get("indexed artifacts", []):
+        symbol_table = merge_symbol_table(web_interface, top_level_name, [r[1:] for r in records])
+        if symbol_table is not None:
+            all_symbol_tables[top_level_name] = symbol_table
+    return all_symbol_tables
+
+
+class RecordSpool:
+    """Symbol table records grouped by top level name into ``n_partitions`` partitions.
+
+    A top level name always lands in the same partition so partitions can be reduced independently. Once more
+    than ``max_records`` are buffered they are appended to one spill file per partition.
+    """
+
+    def __init__(self, n_partitions, max_records=SPILL_RECORDS, directory=None):
+        self.n_partitions = n_partitions
+        self.max_records = max_records
+        self._tmpdir = tempfile.TemporaryDirectory(prefix="symbol-table-records-", dir=directory)
+        self._buffers = [{} for _ in range(n_partitions)]
+        self._buffered = 0
+        self.spills = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._tmpdir.cleanup()
+
+    def partition(self, top_level_name):
+        return zlib.crc32(top_level_name.encode()) % self.n_partitions
+
+    def _spill_path(self, partition):
+        return os.path.join(self._tmpdir.name, f"{partition}.pkl")
+
+    def add(self, top_level_name, symbol, entry):
+        self._buffers[self.partition(top_level_name)].setdefault(top_level_name, []).append((symbol, entry))
+        self._buffered += 1
+        if self._buffered >= self.max_records:
+            self.spill()
+
+    def spill(self):
+        for partition, buffer in enumerate(self._buffers):
+            if buffer:
+                with open(self._spill_path(partition), "ab") as f:
+                    pickle.dump(buffer, f, protocol=pickle.HIGHEST_PROTOCOL)
+                self._buffers[partition] = {}
+        self._buffered = 0
+        self.spills += 1
+
+    def read_partition(self, partition):
+        """All the records of ``partition`` by top level name, in the order they were added"""
+        records = {}
+        if os.path.exists(self._spill_path(partition)):
+            with open(self._spill_path(partition), "rb") as f:
+                while True:
+                    try:
+                        chunk = pickle.load(f)
+                    except EOFError:
+                        break
+                    for top_level_name, chunk_records in chunk.items():
+                        records.setdefault(top_level_name, []).extend(chunk_records)
+        for top_level_name, buffered_records in self._buffers[partition].items():
+            records.setdefault(top_level_name, []).extend(buffered_records)
+        return records
+
+
+def bounded_map(pool, func, items, window):
+    """Same results as ``pool.map(func, items)`` with at most ``window`` calls submitted ahead of the ones consumed,
+    ``pool.map`` submits everything at once and holds on to every result that wasn't consumed yet"""
+    pending = deque()
+    for item in items:
+        if len(pending) >= window:
+            yield pending.popleft().result()
+        pending.append(pool.submit(func, item))
+    while pending:
+        yield pending.popleft().result()
+
+
+def build_symbol_tables(artifact_names, web_interface=None, workers=8, n_partitions=None, max_records=SPILL_RECORDS):
+    """Index ``artifact_names`` in one pass, each symbol table is read, merged and pushed at most once.
+
+    The map step fetches the symbols of the artifacts and spools their records by top level name, the reduce
+    step hands each worker whole partitions so no two workers ever touch the same symbol table.
+    Returns the top level names that were updated.
+    """
+    web_interface = web_interface or open_db()
+    artifact_names = list(artifact_names)
+    n_partitions = n_partitions or workers * 4
+    updated = []
+    with RecordSpool(n_partitions, max_records) as spool, ThreadPoolExecutor(workers) as pool:
+
+        def fetch(artifact_name):
+            try:
+                return web_interface.get_artifact_symbols(artifact_name)
+            except Exception as e:
+                print(f"Failure: {artifact_name}, {e}")
+                return {}
+
+        # in the order of the artifacts so the tables come out the same on every run, and only a few fetches
+        # ahead of the spool so memory doesn't grow with the number of artifacts
+        symbols_by_artifact = bounded_map(pool, fetch, artifact_names, 2 * workers)
+        for artifact_name, symbols in tqdm(
+            zip(artifact_names, symbols_by_artifact), total=len(artifact_names), desc="map"
+        ):
+            for record in artifact_records(artifact_name, symbols):
+                spool.add(*record)
+
+        def reduce_partition(partition):
+            return [
+                top_level_name
+                for top_level_name, records in spool.read_partition(partition).items()
+                if merge_symbol_table(web_interface, top_level_name, records) is not None
+            ]
+
+        for names in tqdm(pool.map(reduce_partition, range(n_partitions)), total=n_partitions, desc="reduce"):
+            updated.extend(names)
+    print(f"Symbol table writes: {web_interface.write_stats()}")
+    return updated
+
+
+def longest_prefix(symbol, symbol_table):
+    """The longest prefix of ``symbol`` in ``symbol_table``, the children it leaves over and its entries"""
+    children_symbols = ()
+    while True:
+        supply = symbol_table.get("symbol table", {}).get(symbol)
+        if supply is not None or "." not in symbol:
+            return symbol, children_symbols, supply
+        symbol, _, child_symbol = symbol.rpartition(".")
+        children_symbols = (child_symbol,) + children_symbols
+
+
+class ShadowClosure:
+    """Resolves shadows chains, the re-exports of imports, across symbol tables.
+
+    Symbols are the nodes of a graph with an edge from a symbol to what each of its shadows entries points at.
+    Its strongly connected components are found with an iterative Tarjan walk and resolved in reverse
+    topological order, so every symbol is resolved once whatever the number of chains going through it.
+    The members of a cycle of re-exports all resolve to what the whole cycle supplies. Otherwise the results
+    are the ones of ``api_match.recursive_get_from_table``.
+    """
+
+    def __init__(self, get_symbol_table):
+        self.get_symbol_table = get_symbol_table
+        self.tables = {}
+        # symbol -> (supply, top level names of the tables it was read from)
+        self.resolved = {}
+
+    def table(self, top_level_name):
+        if top_level_name not in self.tables:
+            self.tables[top_level_name] = self.get_symbol_table(top_level_name)
+        return self.tables[top_level_name]
+
+    def _node(self, symbol):
+        top_level_name = symbol.partition(".")[0]
+        parent_symbol, children_symbols, supply = longest_prefix(symbol, self.table(top_level_name))
+        successors = [".".join((s["shadows"],) + children_symbols) for s in supply or [] if s.get("shadows")]
+        return top_level_name, parent_symbol, children_symbols, supply or [], successors
+
+    def resolve(self, symbol):
+        """The supply of ``symbol`` and the top level names it depends on"""
+        if symbol in self.resolved:
+            return self.resolved[symbol]
+        index, low, nodes = {}, {}, {}
+        stack, on_stack = [], set()
+        work = [(symbol, 0)]
+        while work:
+            v, i = work.pop()
+            if i == 0:
+                index[v] = low[v] = len(index)
+                stack.append(v)
+                on_stack.add(v)
+                nodes[v] = self._node(v)
+            successors = nodes[v][4]
+            for j in range(i, len(successors)):
+                w = successors[j]
+                if w in self.resolved:
+                    continue
+                if w not in index:
+                    work.extend([(v, j + 1), (w, 0)])
+                    break
+                if w in on_stack:
+                    low[v] = min(low[v], index[w])
+            else:
+                if low[v] == index[v]:
+                    component = []
+                    while not component or component[-1] != v:
+                        component.append(stack.pop())
+                        on_stack.discard(component[-1])
+                    self._resolve_component(component, nodes)
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[v])
+        return self.resolved[symbol]
+
+    def _resolve_component(self, component, nodes):
+        members = set(component)
+        outputs = {}
+        top_level_names = set()
+        for v in component:
+            top_level_name, parent_symbol, children_symbols, supply, _ = nodes[v]
+            top_level_names.add(top_level_name)
+            output_supply = outputs[v] = {}
+            for suplier in supply:
+                shadow = suplier.get("shadows")
+                if shadow:
+                    new_symbol = ".".join((shadow,) + children_symbols)
+                    if new_symbol in members:
+                        output_supply.setdefault(parent_symbol, []).append(suplier["artifact name"])
+                        continue
+                    results, dependencies = self.resolved[new_symbol]
+                    top_level_names |= dependencies
+                    if results:
+                        output_supply.setdefault(parent_symbol, []).append(suplier["artifact name"])
+                        output_supply.update({k: list(artifacts) for k, artifacts in results.items()})
+                elif not children_symbols:
+                    output_supply.setdefault(parent_symbol, []).append(suplier["artifact name"])
+        top_level_names = frozenset(top_level_names)
+        if len(component) == 1:
+            self.resolved[component[0]] = outputs[component[0]], top_level_names
+            return
+        cycle_supply = {}
+        for output_supply in outputs.values():
+            cycle_supply.update(output_supply)
+        for v in component:
+            self.resolved[v] = dict(cycle_supply, **outputs[v]), top_level_names
+
+
+def close_shadow_chains(web_interface, top_level_names):
+    """Store the resolution of every symbol with shadows entries with the tables of ``top_level_names``.
+
+    The closure records the revisions of all the tables it was read from, readers ignore it once one of them
+    changes. Returns the top level names that got a closure.
+    """
+    closure = ShadowClosure(web_interface.get_symbol_table)
+    closed = []
+    for top_level_name in tqdm(top_level_names, desc="shadows"):
+        symbol_table = closure.table(top_level_name)
+        resolved = {}
+        dependencies = {top_level_name}
+        for symbol, supply in symbol_table.get("symbol table", {}).items():
+            if any(s.get("shadows") for s in supply):
+                resolved[symbol], symbol_dependencies = closure.resolve(symbol)
+                dependencies |= symbol_dependencies
+        if not resolved:
             continue
-        # download the existing symbol table
-        symbol_table_with_metadata = web_interface.get_symbol_table(top_level_name)
-        symbol_table = symbol_table_with_metadata.get("symbol table", {})
-        # update the symbol table
-        for k in list(keys):
-            symbol_table_entry_value = {"artifact name": artifact_name}
-            shadows = symbols[k].get("data", {}).get("shadows")
-            if shadows:
-                symbol_table_entry_value.update(shadows=shadows)
-            symbol_table.setdefault(k, []).append(symbol_table_entry_value)
-        # add artifacts to metadata
-        metadata["version"] = version
-        metadata.setdefault("indexed artifacts", []).append(artifact_name)
-        # push back to server
+        revisions = {name: symbol_table_revision(closure.table(name)) for name in sorted(dependencies)}
         try:
-            web_interface.push_symbol_table(top_level_name, {"symbol table": symbol_table, "metadata": metadata})
+            web_interface.push_shadow_closure(top_level_name, {"revisions": revisions, "symbols": resolved})
         except requests.RequestException as e:
             print(e)
-        all_symbol_tables[top_level_name] = symbol_table
-    return all_symbol_tables
+            continue
+        closed.append(top_level_name)
+    return closed
 
 
 def invert_dict(d: dict):
@@ -94,12 +395,10 @@ def invert_dict(d: dict):
 
 
 if __name__ == "__main__":
-    web_interface = WebDB()
+    web_interface = open_db()
     indexed_artifacts_by_top_symbol = web_interface.get_current_symbol_table_artifacts_by_top_level()
     all_artifacts = web_interface.get_all_extracted_artifacts()
-    with Client(threads_per_worker=100):
-        compute = db.from_sequence(all_artifacts).map(web_interface.get_top_level_symbols).compute()
-    all_symbols_by_artifact = {k: v for k, v in zip(all_artifacts, compute)}
+    all_symbols_by_artifact = web_interface.get_top_level_symbols_many(all_artifacts)
     all_artifacts_by_symbol = invert_dict(all_symbols_by_artifact)
 
     artifacts_to_index = set()
@@ -108,21 +407,9 @@ if __name__ == "__main__":
     artifacts_to_index = list(artifacts_to_index)
     print(f"Number of artifacts to index: {len(artifacts_to_index)}")
 
-    # The shuffle here is to try to not have two threads running on the same symbol table json at once if possible
+    # The shuffle here is to not always index the same artifacts first when there are more than the limit
     shuffle(artifacts_to_index)
-    pool = ThreadPoolExecutor()
-    # Note that this is a race condition here, two threads could try to write to the same symbol table
-    # however one of those will win so next round there will be one added safely and this continues
-    # until none are left to be added
-    print("issuing futures")
-    futures = {
-        pool.submit(inner_loop, artifact_name): artifact_name for artifact_name in tqdm(artifacts_to_index[:10000])
-    }
-    print("awaiting futures")
-    for future in tqdm(as_completed(futures), total=len(futures)):
-        print(futures[future])
-        try:
-            future.result()
-        except Exception as e:
-            print(e)
-    pool.shutdown()
+    updated = build_symbol_tables(artifacts_to_index[:10000])
+    print(f"Updated {len(updated)} symbol tables")
+    closed = close_shadow_chains(web_interface, updated)
+    print(f"Resolved the shadows of {len(closed)} symbol tables")
@@ -1,4 +1,5 @@
 import ast
+import fnmatch
 import logging
 from collections import defaultdict
 from graphlib import TopologicalSorter, CycleError
@@ -12,25 +13,134 @@ from symbol_exporter.ast_symbol_extractor import (
     is_relative_star_import,
     RELATIVE_IMPORT_IDENTIFIER,
 )
+from symbol_exporter.parse_cache import ParseCache
 
 logger = logging.getLogger("package_symbol_extractor")
 logger.setLevel(logging.ERROR)
 
+# Shared on disk cache of parsed modules, enabled by setting SYMBOL_EXPORTER_PARSE_CACHE to a directory
+parse_cache = ParseCache.from_env()
+
 
 def get_symbol_type(symbol) -> SymbolType:
     return symbol["type"]
 
 
+class InMemoryTree:
+    """Read only file tree held in memory, eg the interesting members of an artifact"""
+
+    def __init__(self):
+        self.files = {}
+        self.children = defaultdict(set)
+
+    def add_file(self, name: str, data: bytes):
+        parts = tuple(p for p in name.split("/") if p not in {"", "."})
+        self.files[parts] = data
+        for i in range(len(parts)):
+            self.children[parts[:i]].add(parts[i])
+
+    def directories(self):
+        return sorted(self.children)
+
+    def path(self, parts=()):
+        return InMemoryPath(self, tuple(parts))
+
+
+class InMemoryPath:
+    """Minimal stand in for ``pathlib.Path`` over an ``InMemoryTree``.
+
+    Only implements what the symbol finders need so packages can be inspected without writing them to disk.
+    """
+
+    def __init__(self, tree: InMemoryTree, parts: tuple):
+        self._tree = tree
+        self.parts = parts
+
+    def __truediv__(self, other):
+        return InMemoryPath(self._tree, self.parts + tuple(p for p in str(other).split("/") if p))
+
+    def __str__(self):
+        return "/".join(self.parts)
+
+    def __repr__(self):
+        return f"InMemoryPath({str(self)!r})"
+
+    def __eq__(self, other):
+        return isinstance(other, InMemoryPath) and self._tree is other._tree and self.parts == other.parts
+
+    def __hash__(self):
+        return hash(self.parts)
+
+    @property
+    def name(self):
+        return self.parts[-1] if self.parts else ""
+
+    @property
+    def stem(self):
+        stem, dot, _ = self.name.rpartition(".")
+        return stem if dot and stem else self.name
+
+    @property
+    def suffix(self):
+        stem, dot, suffix = self.name.rpartition(".")
+        return f".{suffix}" if dot and stem else ""
+
+    def exists(self):
+        return self.is_file() or self.is_dir()
+
+    def is_file(self):
+        return self.parts in self._tree.files
+
+    def is_dir(self):
+        return self.parts in self._tree.children
+
+    def iterdir(self):
+        for child in sorted(self._tree.children.get(self.parts, ())):
+            yield self / child
+
+    def glob(self, pattern):
+        return (p for p in self.iterdir() if fnmatch.fnmatchcase(p.name, pattern))
+
+    def rglob(self, pattern):
+        for p in self.iterdir():
+            if p.is_file() and fnmatch.fnmatchcase(p.name, pattern):
+                yield p
+            elif p.is_dir():
+                yield from p.rglob(pattern)
+
+    def relative_to(self, other):
+        if self.parts[: len(other.parts)] != other.parts:
+            raise ValueError(f"{self} is not in the subpath of {other}")
+        return "/".join(self.parts[len(other.parts) :])
+
+    def read_bytes(self):
+        return self._tree.files[self.parts]
+
+    def read_text(self, encoding="utf-8"):
+        return self.read_bytes().decode(encoding)
+
+    def resolve(self):
+        return self
+
+
 def is_package(directory: Path) -> bool:
     # Only handles regular packages, not namespace packages. See PEP-420.
     return (directory / "__init__.py").exists()
 
 
-def parse_code(code: str, module_name: str) -> dict:
+def parse_code(code: str, module_name: str, cache: ParseCache = None) -> dict:
+    cache = cache or parse_cache
+    if cache is not None:
+        symbols = cache.get(code, module_name)
+        if symbols is not None:
+            return symbols
     tree = ast.parse(code)
     z = SymbolFinder(module_name=module_name)
     z.visit(tree)
-    return z.post_process_symbols()
+    symbols = z.post_process_symbols()
+    if cache is not None:
+        cache.put(code, module_name, symbols)
+    return symbols
 
 
 def parse(module: Path, module_path: str) -> dict:
@@ -183,8 +293,8 @@ class _RelativeImportsResolver:
 
 
 class DirectorySymbolFinder:
-    def __init__(self, directory_name: Union[str, Path], parent: str = None):
-        self._directory = Path(directory_name)
+    def __init__(self, directory_name: Union[str, Path, InMemoryPath], parent: str = None):
+        self._directory = directory_name if isinstance(directory_name, InMemoryPath) else Path(directory_name)
         self._is_package = is_package(self._directory)
         if self._directory.is_dir():
             self._module_path = f"{parent}.{self._directory.name}" if parent else self._directory.name
@@ -79,6 +79,45 @@ class SymbolType(OrderedEnum):
         return f"{self.name.lower().replace('_', '-')}"
 
 
+class ScopeTable:
+    """Hashed lookup tables used by the SymbolFinder to resolve names.
+
+    Keeps the imported symbols in a set, indexes the module's surface area by the name relative to the module
+    (so ``f`` resolves to ``module.f`` without building the fully qualified name) and tracks one frame of
+    argument names per function scope.
+    """
+
+    def __init__(self, module_name):
+        self._prefix = f"{module_name}."
+        self.imported_symbols = set()
+        self.unshadowed_surface_area = {}
+        self.frames = []
+
+    def add_import(self, symbol):
+        self.imported_symbols.add(symbol)
+
+    def add_surface_symbol(self, full_symbol_name, data):
+        if not full_symbol_name.startswith(self._prefix):
+            return
+        symbol = full_symbol_name[len(self._prefix) :]
+        if "shadows" in data:
+            self.unshadowed_surface_area.pop(symbol, None)
+        else:
+            self.unshadowed_surface_area[symbol] = full_symbol_name
+
+    def resolve_surface_symbol(self, symbol):
+        return self.unshadowed_surface_area.get(symbol)
+
+    def push_frame(self, names):
+        self.frames.append(names)
+
+    def pop_frame(self):
+        self.frames.pop(-1)
+
+    def in_current_frame(self, symbol):
+        return bool(self.frames) and symbol in self.frames[-1]
+
+
 class SymbolFinder(ast.NodeVisitor):
     def __init__(self, module_name):
         self._module_name = module_name
@@ -95,7 +134,7 @@ class SymbolFinder(ast.NodeVisitor):
         self.aliases = {}
         self.undeclared_symbols = set()
         self.used_builtins = set()
-        self.current_args_kwargs_stack = []
+        self._scope_table = ScopeTable(module_name)
         self._relative_import_stack = []
 
     @property
@@ -106,8 +145,8 @@ class SymbolFinder(ast.NodeVisitor):
         super().visit(node)
 
     def visit_Import(self, node: ast.Import) -> Any:
-        self.imported_symbols.extend(k.name for k in node.names)
         for k in node.names:
+            self._add_imported_symbol(k.name)
             self._add_symbol_to_volume(self._symbol_stack_to_symbol_name(), k.name, lineno=node.lineno)
             if not k.asname:
                 self._add_symbol_to_surface_area(SymbolType.IMPORT, symbol=k.name, shadows=k.name)
@@ -119,7 +158,7 @@ class SymbolFinder(ast.NodeVisitor):
             if k.name != "*":
                 module_name = f"{node.module}.{k.name}" if node.module else k.name
                 self.aliases[k.name] = module_name
-                self.imported_symbols.append(module_name)
+                self._add_imported_symbol(module_name)
                 # TODO: clean up if statements with common module_name var between forks
                 if not k.asname:
                     if not relative_import:
@@ -214,7 +253,7 @@ class SymbolFinder(ast.NodeVisitor):
         symbol_name = self._symbol_stack_to_symbol_name()
         args_kwargs_dict = self._create_args_kwargs_dict(node.args)
         # TODO: add args kwargs dict to symbols description
-        self.current_args_kwargs_stack.append(args_kwargs_dict)
+        self._scope_table.push_frame(args_kwargs_dict)
         self._add_symbol_to_surface_area(
             SymbolType.FUNCTION,
             symbol_name,
@@ -222,7 +261,7 @@ class SymbolFinder(ast.NodeVisitor):
         )
         self.generic_visit(node)
         self.current_symbol_stack.pop(-1)
-        self.current_args_kwargs_stack.pop(-1)
+        self._scope_table.pop_frame()
 
     def visit_ClassDef(self, node: ast.ClassDef) -> Any:
         self.current_symbol_stack.append(node.name)
@@ -268,21 +307,18 @@ class SymbolFinder(ast.NodeVisitor):
 
     def _symbol_previously_seen(self, symbol):
         return (
-            symbol in self.imported_symbols
+            symbol in self._scope_table.imported_symbols
             or symbol in self.undeclared_symbols
             or symbol in builtin_symbols
             or self._symbol_in_unshadowed_surface_area(symbol)
         )
 
     def _symbol_in_unshadowed_surface_area(self, symbol):
-        fully_qualified_symbol_name = f"{self._module_name}.{symbol}"
+        return self._scope_table.resolve_surface_symbol(symbol)
 
-        if fully_qualified_symbol_name in self._symbols and "shadows" not in self._symbols[
-            fully_qualified_symbol_name
-        ].get("data", {}):
-            return fully_qualified_symbol_name
-        else:
-            return None
+    def _add_imported_symbol(self, symbol):
+        self.imported_symbols.append(symbol)
+        self._scope_table.add_import(symbol)
 
     def _add_symbol_to_surface_area(self, symbol_type: SymbolType, symbol, **kwargs):
         imports = (SymbolType.IMPORT, SymbolType.RELATIVE_IMPORT)
@@ -291,6 +327,7 @@ class SymbolFinder(ast.NodeVisitor):
             return
         full_symbol_name = f"{self._module_name}.{symbol}" if symbol_type in imports else symbol
         self._symbols[full_symbol_name] = dict(type=symbol_type, data=kwargs)
+        self._scope_table.add_surface_symbol(full_symbol_name, kwargs)
 
     def _add_symbol_to_volume(self, surface_symbol, volume_symbol, lineno):
         data = self._symbols[surface_symbol]["data"]
@@ -300,7 +337,9 @@ class SymbolFinder(ast.NodeVisitor):
 
     def _add_symbol_to_star_imports(self, imported_symbol, symbol_type: SymbolType):
         default = dict(type=symbol_type, data=dict(imports=set()))
-        self._symbols.setdefault(f"{self._module_name}.*", default)["data"]["imports"].add(imported_symbol)
+        symbol_name = f"{self._module_name}.*"
+        self._symbols.setdefault(symbol_name, default)["data"]["imports"].add(imported_symbol)
+        self._scope_table.add_surface_symbol(symbol_name, default["data"])
 
     def _add_symbol_to_relative_star_imports(self, imported_symbol, symbol_type: SymbolType, level: int):
         default = dict(type=symbol_type, data=dict(imports=[]))
@@ -308,6 +347,7 @@ class SymbolFinder(ast.NodeVisitor):
         self._symbols.setdefault(symbol_name, default)["data"]["imports"].append(
             dict(shadows=imported_symbol, level=level, module=self._module_name)
         )
+        self._scope_table.add_surface_symbol(symbol_name, default["data"])
 
     def post_process_symbols(self):
         stripped_names = {
@@ -357,7 +397,7 @@ class SymbolFinder(ast.NodeVisitor):
         return output
 
     def _symbol_in_args_kwargs(self, id):
-        return self.current_args_kwargs_stack and id in self.current_args_kwargs_stack[-1]
+        return self._scope_table.in_current_frame(id)
 
 
 # 1. get all the imports and their aliases (which includes imported things)
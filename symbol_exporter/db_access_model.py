@@ -1,46 +1,295 @@
-from functools import lru_cache
+import asyncio
 import hashlib
 import hmac
-import json
 import os
+import threading
+import time
+import uuid
 from datetime import datetime
-from enum import Enum
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
-import dask.bag as db
-from dask.distributed import Client
 import requests
 from requests.exceptions import ChunkedEncodingError
 
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
 from symbol_exporter.ast_symbol_extractor import version
+from symbol_exporter.disk_cache import ResponseCache
+from symbol_exporter.serialization import make_json_friendly  # noqa: F401 re-exported for older imports
+from symbol_exporter.serialization import (
+    dumps_canonical,
+    encode_body,
+    get_serializer,
+    iter_encoded_chunks,
+    loads_content,
+    SignedChunks,
+)
+from symbol_exporter.sessions import get_session, make_session, TIMEOUTS, RETRIES, BACKOFF_FACTOR, RETRY_STATUSES
+
+DEFAULT_HOST = "https://cf-ast-symbol-table.web.cern.ch"
+# Number of requests the async client keeps in flight at once
+DEFAULT_CONCURRENCY = 64
+# Number of decoded documents kept in memory on top of the on disk cache
+DECODED_CACHE_SIZE = 256
+# Content-Encoding of uploaded bodies, the server has to accept it before this can be turned on
+UPLOAD_ENCODING = os.environ.get("SYMBOL_EXPORTER_UPLOAD_ENCODING", "identity")
+# Where symbols live, the web service by default, an http(s) url for another server or the path of a SQLite database
+DB_LOCATION_ENV = "SYMBOL_EXPORTER_DB"
+# Stream uploads in chunks and sign them in a follow up commit call, needs server support as well
+STREAMING_UPLOAD = os.environ.get("SYMBOL_EXPORTER_STREAMING_UPLOAD", "") not in {"", "0"}
+# Add to symbol tables by uploading only the new entries next to the table, needs server support as well
+DELTA_UPDATES = os.environ.get("SYMBOL_EXPORTER_DELTA_UPDATES", "") not in {"", "0"}
+# Leave the metadata of uploads out of the query string, the server then reads it from the body, needs server support
+BODY_METADATA = os.environ.get("SYMBOL_EXPORTER_BODY_METADATA", "") not in {"", "0"}
+# Number of pending deltas after which a symbol table is compacted
+DELTA_COMPACTION_THRESHOLD = int(os.environ.get("SYMBOL_EXPORTER_DELTA_COMPACTION_THRESHOLD", 16))
+
+
+def open_db(location=None):
+    """``WebDB`` or ``LocalDB`` for ``location``, which defaults to ``SYMBOL_EXPORTER_DB``"""
+    location = location or os.environ.get(DB_LOCATION_ENV) or DEFAULT_HOST
+    if location.startswith(("http://", "https://")):
+        return WebDB(host=location)
+    from symbol_exporter.local_db import LocalDB
+
+    return LocalDB(location)
+
+
+class SymbolTableConflict(Exception):
+    """The symbol table was written by somebody else since it was read"""
+
+
+class UnversionedSymbolTable(Exception):
+    """The server sent a symbol table without an ETag, writing it back could silently overwrite somebody else"""
+
+
+def apply_symbol_table_delta(symbol_table, delta):
+    """``symbol_table`` with the entries of ``delta`` appended, neither argument is modified.
+
+    Entries of artifacts the table already indexes are skipped so applying a delta twice is harmless.
+    """
+    metadata = dict(symbol_table.get("metadata") or {})
+    indexed_artifacts = list(metadata.get("indexed artifacts", []))
+    already_indexed = set(indexed_artifacts)
+    table = dict(symbol_table.get("symbol table", {}))
+    for symbol, entries in delta.get("symbol table", {}).items():
+        new_entries = [entry for entry in entries if entry["artifact name"] not in already_indexed]
+        if new_entries:
+            table[symbol] = table.get(symbol, []) + new_entries
+    delta_metadata = delta.get("metadata", {})
+    indexed_artifacts.extend(a for a in delta_metadata.get("indexed artifacts", []) if a not in already_indexed)
+    metadata.update({k: v for k, v in delta_metadata.items() if k != "indexed artifacts"})
+    metadata["indexed artifacts"] = indexed_artifacts
+    return dict(symbol_table, **{"symbol table": table, "metadata": metadata})
+
+
+def symbol_table_revision(symbol_table):
+    """Identifies the content of a symbol table, which only changes when artifacts are indexed into it"""
+    h = hashlib.sha256()
+    for artifact_name in sorted(symbol_table.get("metadata", {}).get("indexed artifacts", [])):
+        h.update(artifact_name.encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def accept_headers(serializer):
+    if serializer.content_type == "application/json":
+        return None
+    return {"Accept": f"{serializer.content_type}, application/json;q=0.9"}
 
 
 class WebDB:
-    def __init__(self, host="https://cf-ast-symbol-table.web.cern.ch"):
+    def __init__(
+        self,
+        host=DEFAULT_HOST,
+        session=None,
+        cache=None,
+        upload_encoding=None,
+        streaming_upload=None,
+        serializer=None,
+        delta_updates=None,
+        body_metadata=None,
+    ):
+        """``cache`` defaults to the on disk cache configured by ``SYMBOL_EXPORTER_WEBDB_CACHE``, which
+        revalidates every read with the server unless ``SYMBOL_EXPORTER_WEBDB_CACHE_MAX_AGE`` says otherwise,
+        ``False`` disables caching. ``serializer`` is the format of uploaded bodies and the preferred format of
+        downloaded ones, the metadata is always canonical json. ``delta_updates`` stores additions to symbol
+        tables as deltas under ``<table>/deltas/`` which are folded into the table every
+        ``DELTA_COMPACTION_THRESHOLD`` deltas. ``body_metadata`` stops sending the metadata as the ``metadata``
+        query parameter of uploads as well as in their body"""
         self.host = host
+        self.serializer = get_serializer(serializer)
+        self.upload_encoding = upload_encoding or UPLOAD_ENCODING
+        self.streaming_upload = STREAMING_UPLOAD if streaming_upload is None else streaming_upload
+        self.delta_updates = DELTA_UPDATES if delta_updates is None else delta_updates
+        self.body_metadata = BODY_METADATA if body_metadata is None else body_metadata
         raw_token = os.environ.get("STORAGE_SECRET_TOKEN", "")
         if raw_token == "":
             print("No token only pulls allowed")
         self.secret_token = raw_token.encode("utf-8")
+        self._session = session
+        # tables change under readers, only unchanged bodies are worth serving from disk
+        self.cache = ResponseCache.from_env("webdb", max_age=0) if cache is None else cache or None
+        self._decoded = OrderedDict()
+        self._decoded_lock = threading.Lock()
+        self._write_stats = {"writes": 0, "conflicts": 0}
+
+    def __getstate__(self):
+        # the decoded documents can be large, don't ship them to other workers
+        state = dict(self.__dict__, _decoded=OrderedDict(), _upload_session_=None)
+        del state["_decoded_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._decoded_lock = threading.Lock()
+
+    @property
+    def session(self):
+        return self._session or get_session()
+
+    @property
+    def _accept_headers(self):
+        return accept_headers(self.serializer)
+
+    def _get(self, url, endpoint):
+        return self.session.get(f"{self.host}{url}", headers=self._accept_headers, timeout=TIMEOUTS[endpoint])
+
+    def _get_json(self, url, endpoint, revalidate=False):
+        if self.cache is None:
+            r = self._get(url, endpoint)
+            return loads_content(r.content, r.headers.get("Content-Type"))
+        full_url = f"{self.host}{url}"
+        meta, body_path = self.cache.fetch(
+            self.session, full_url, timeout=TIMEOUTS[endpoint], revalidate=revalidate, headers=self._accept_headers
+        )
+        if meta["status"] != 200:
+            return None
+        if revalidate:
+            # callers that revalidate are about to modify the document, don't hand out the shared copy
+            return loads_content(body_path.read_bytes(), meta.get("content type"))
+        digest, decoded = self._decoded.get(full_url, (None, None))
+        if digest != meta["digest"]:
+            decoded = loads_content(body_path.read_bytes(), meta.get("content type"))
+        # readers can be on several threads
+        with self._decoded_lock:
+            self._decoded[full_url] = (meta["digest"], decoded)
+            self._decoded.move_to_end(full_url)
+            if len(self._decoded) > DECODED_CACHE_SIZE:
+                self._decoded.popitem(last=False)
+        return decoded
+
+    def _invalidate(self, *urls):
+        for url in urls:
+            with self._decoded_lock:
+                self._decoded.pop(f"{self.host}{url}", None)
+            if self.cache is not None:
+                self.cache.invalidate(f"{self.host}{url}")
+
+    def cache_stats(self):
+        return self.cache.stats() if self.cache is not None else {}
 
     def _dumps(self, data):
-        return json.dumps(data, default=make_json_friendly, sort_keys=True)
+        return dumps_canonical(data)
 
-    def _push(self, data, url):
-        dumped_data = self._dumps(data)
+    def _push(self, data, url, if_match=None):
+        """PUT ``data`` at ``url``, ``if_match`` makes the write conditional, see ``push_symbol_table``"""
+        conditions = {}
+        if if_match == "":
+            conditions["If-None-Match"] = "*"
+        elif if_match is not None:
+            conditions["If-Match"] = if_match
+        if self.streaming_upload:
+            return self._push_streaming(data, url, conditions)
+        body = encode_body(self.serializer.dumps(data), self.upload_encoding)
         dumped_metadata = self._dumps(data["metadata"] if data else None)
-        r = requests.put(
+        headers = self._setup_headers(body, url=url, dumped_metadata=dumped_metadata)
+        headers["Content-Type"] = self.serializer.content_type
+        headers.update(conditions)
+        if self.upload_encoding != "identity":
+            headers["Content-Encoding"] = self.upload_encoding
+        r = self.session.put(
             f"{self.host}{url}",
-            data=dumped_data,
-            headers=self._setup_headers(dumped_data, url=url, dumped_metadata=dumped_metadata),
-            params=dict(metadata=dumped_metadata),
+            data=body,
+            headers=headers,
+            params=self._metadata_params(dumped_metadata),
+            timeout=TIMEOUTS["push"],
         )
+        self._raise_for_status(r, url)
+
+    def _metadata_params(self, dumped_metadata):
+        # the server checks the headers signature against the parameter unless it reads the metadata from the body
+        return None if self.body_metadata else dict(metadata=dumped_metadata)
+
+    @staticmethod
+    def _raise_for_status(r, url):
+        if r.status_code == 412:
+            raise SymbolTableConflict(url)
         r.raise_for_status()
 
-    def _setup_headers(self, dumped_data, url, dumped_metadata):
+    def _push_streaming(self, data, url, conditions=None):
+        """Upload ``data`` without ever holding its serialised form in memory.
+
+        The body is serialised, compressed and signed chunk by chunk into a chunked transfer PUT. The signature is
+        only known once the body has been sent so it goes in a follow up ``POST <url>/commit``, the server keeps
+        the upload staged until the commit checks out.
+        """
+        dumped_metadata = self._dumps(data["metadata"] if data else None)
+        timestamp = datetime.utcnow().isoformat()
+        headers = {
+            "X-Upload-Id": uuid.uuid4().hex,
+            "X-Signature-Timestamp": timestamp,
+            "Content-Type": self.serializer.content_type,
+        }
+        if self.upload_encoding != "identity":
+            headers["Content-Encoding"] = self.upload_encoding
+        # a generator body can't be replayed by the transport so retries happen here with a fresh stream
+        for attempt in range(RETRIES + 1):
+            chunks = iter_encoded_chunks(self.serializer.iter_chunks(data), self.upload_encoding)
+            signed = SignedChunks(chunks, self.secret_token)
+            try:
+                r = self._upload_session.put(
+                    f"{self.host}{url}", data=iter(signed), headers=headers, timeout=TIMEOUTS["push"]
+                )
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if attempt == RETRIES:
+                    raise
+            else:
+                if r.status_code not in RETRY_STATUSES or attempt == RETRIES:
+                    r.raise_for_status()
+                    break
+            time.sleep(BACKOFF_FACTOR * 2**attempt)
+        commit_headers = dict(
+            self._signature_headers(signed.hexdigest(), url, timestamp, dumped_metadata),
+            **{"X-Upload-Id": headers["X-Upload-Id"]},
+            **(conditions or {}),
+        )
+        r = self.session.post(
+            f"{self.host}{url}/commit",
+            headers=commit_headers,
+            params=self._metadata_params(dumped_metadata),
+            timeout=TIMEOUTS["push"],
+        )
+        self._raise_for_status(r, url)
+
+    @property
+    def _upload_session(self):
+        if getattr(self, "_upload_session_", None) is None:
+            self._upload_session_ = make_session(retries=0)
+        return self._upload_session_
+
+    def _setup_headers(self, body: bytes, url, dumped_metadata):
+        # the body signature covers the bytes on the wire, ie after compression
+        body_signature = hmac.new(self.secret_token, body, hashlib.sha256).hexdigest()
+        return self._signature_headers(body_signature, url, datetime.utcnow().isoformat(), dumped_metadata)
+
+    def _signature_headers(self, body_signature, url, timestamp, dumped_metadata):
         headers = {
-            "X-Signature-Timestamp": datetime.utcnow().isoformat(),
-            "X-Body-Signature": hmac.new(self.secret_token, dumped_data.encode(), hashlib.sha256).hexdigest(),
+            "X-Signature-Timestamp": timestamp,
+            "X-Body-Signature": body_signature,
         }
         headers["X-Headers-Signature"] = hmac.new(
             self.secret_token,
@@ -56,69 +305,219 @@ class WebDB:
         ).hexdigest()
         return headers
 
-    def push_symbol_table(self, top_level_name, symbol_table):
+    def _delete(self, url):
+        headers = self._setup_headers(b"", url=url, dumped_metadata=self._dumps(None))
+        r = self.session.delete(f"{self.host}{url}", headers=headers, timeout=TIMEOUTS["push"])
+        # already gone is fine, eg a compaction that raced with another one
+        if r.status_code != 404:
+            r.raise_for_status()
+
+    def push_symbol_table(self, top_level_name, symbol_table, if_match=None):
+        """Replace the symbol table.
+
+        ``if_match`` is the version returned by ``get_symbol_table_versioned``, when it is given the write only
+        happens if nobody else wrote the table since, otherwise ``SymbolTableConflict`` is raised.
+        """
         url = f"/api/v{version}/symbol_table/{top_level_name}"
-        self._push(symbol_table, url)
+        try:
+            self._push(symbol_table, url, if_match=if_match)
+        except SymbolTableConflict:
+            self._count_write(conflict=True)
+            raise
+        finally:
+            self._invalidate(url, f"{url}/metadata")
+        self._count_write()
+
+    def get_symbol_table_versioned(self, top_level_name):
+        """The symbol table straight from the server and its version, the ETag or "" when there is no table.
+        ``UnversionedSymbolTable`` is raised when a table comes without an ETag."""
+        url = f"/api/v{version}/symbol_table/{top_level_name.lower()}"
+        if self.cache is None:
+            r = self._get(url, "symbol table")
+            if r.status_code == 404:
+                return {}, ""
+            r.raise_for_status()
+            body, etag = r.content, r.headers.get("ETag")
+            content_type = r.headers.get("Content-Type")
+        else:
+            meta, body_path = self.cache.fetch(
+                self.session,
+                f"{self.host}{url}",
+                timeout=TIMEOUTS["symbol table"],
+                revalidate=True,
+                headers=self._accept_headers,
+            )
+            if meta["status"] != 200:
+                return {}, ""
+            body, etag, content_type = body_path.read_bytes(), meta["etag"], meta.get("content type")
+        # without a version the conditional write would turn into an unconditional one
+        if not etag:
+            raise UnversionedSymbolTable(url)
+        return loads_content(body, content_type) or {}, etag
+
+    def _count_write(self, conflict=False):
+        with self._decoded_lock:
+            self._write_stats["writes"] += 1
+            self._write_stats["conflicts"] += conflict
+
+    def write_stats(self):
+        writes, conflicts = self._write_stats["writes"], self._write_stats["conflicts"]
+        return {"writes": writes, "conflicts": conflicts, "conflict rate": conflicts / writes if writes else 0.0}
+
+    def push_shadow_closure(self, top_level_name, closure):
+        """Store the resolved shadows chains of the symbol table as a document of their own next to it, see
+        ``ast_index.close_shadow_chains``. The table itself is neither read nor rewritten."""
+        url = f"/api/v{version}/symbol_table/{top_level_name.lower()}/shadow_closure"
+        self._push(dict(closure, metadata=None), url)
+        self._invalidate(url)
+        self._count_write()
+
+    def get_shadow_closure(self, top_level_name):
+        """The closure stored by ``push_shadow_closure``, ``None`` when there is none"""
+        url = f"/api/v{version}/symbol_table/{top_level_name.lower()}/shadow_closure"
+        try:
+            closure = self._get_json(url, "symbol table")
+        except (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.RetryError,
+            requests.exceptions.Timeout,
+            ChunkedEncodingError,
+            ValueError,
+        ):
+            return None
+        if not closure:
+            return None
+        return {"revisions": closure["revisions"], "symbols": closure["symbols"]}
+
+    def push_symbol_table_delta(self, top_level_name, delta):
+        """Append ``delta``, a symbol table with only the new entries and artifacts, to the symbol table"""
+        url = f"/api/v{version}/symbol_table/{top_level_name}"
+        # ids sort in the order the deltas were written
+        delta_id = f"{time.time_ns():020d}-{uuid.uuid4().hex[:8]}"
+        self._push(delta, f"{url}/deltas/{delta_id}")
+        self._invalidate(f"{url}/deltas")
+        self._count_write()
+        if len(self.get_symbol_table_deltas(top_level_name)) >= DELTA_COMPACTION_THRESHOLD:
+            self.compact_symbol_table(top_level_name)
+
+    def get_symbol_table_deltas(self, top_level_name):
+        """Ids of the deltas not yet folded into the symbol table, oldest first"""
+        url = f"/api/v{version}/symbol_table/{top_level_name.lower()}/deltas"
+        names = self._get_json(url, "listing", revalidate=True) or []
+        return sorted({name.split("/")[0] for name in names})
+
+    def _apply_deltas(self, top_level_name, symbol_table, delta_ids=None):
+        url = f"/api/v{version}/symbol_table/{top_level_name.lower()}/deltas"
+        delta_ids = self.get_symbol_table_deltas(top_level_name) if delta_ids is None else delta_ids
+        for delta_id in delta_ids:
+            # deltas never change once written so they are served from the cache
+            symbol_table = apply_symbol_table_delta(
+                symbol_table, self._get_json(f"{url}/{delta_id}", "symbol table") or {}
+            )
+        return symbol_table
+
+    def compact_symbol_table(self, top_level_name):
+        """Fold the pending deltas into the symbol table and remove them"""
+        delta_ids = self.get_symbol_table_deltas(top_level_name)
+        if not delta_ids:
+            return
+        url = f"/api/v{version}/symbol_table/{top_level_name.lower()}"
+        try:
+            symbol_table, table_version = self.get_symbol_table_versioned(top_level_name)
+        except UnversionedSymbolTable as e:
+            # the deltas stay pending rather than risk losing a concurrent write
+            print(f"Not compacting {top_level_name}: {e!r}")
+            return
+        symbol_table = self._apply_deltas(top_level_name, symbol_table, delta_ids)
+        try:
+            self.push_symbol_table(top_level_name.lower(), symbol_table, if_match=table_version)
+        except SymbolTableConflict:
+            # somebody else compacted or rewrote the table, the deltas stay pending
+            return
+        # deltas written since the listing are left for the next compaction
+        for delta_id in delta_ids:
+            self._delete(f"{url}/deltas/{delta_id}")
+        self._invalidate(f"{url}/deltas")
 
     def get_current_symbol_table_artifacts_by_top_level(self):
-        all_indexted_pkgs = {}
-        extracted_symbols = self.get_symbol_table("")
-        with Client(threads_per_worker=100):
-            [
-                all_indexted_pkgs.update({k: set(v)})
-                for k, v in zip(
-                    extracted_symbols,
-                    db.from_sequence(extracted_symbols)
-                    .map(self.get_symbol_table_metadata)
-                    .map(lambda x: x.get("indexed artifacts", {}))
-                    .compute(),
-                )
-            ]
-        return all_indexted_pkgs
+        # the listing can include the deltas stored under the tables
+        extracted_symbols = [name for name in self.get_symbol_table("", revalidate=True) if "/" not in name]
+        metadata_by_top_level = self.get_symbol_table_metadata_many(extracted_symbols)
+        return {k: set(v.get("indexed artifacts", {})) for k, v in metadata_by_top_level.items()}
+
+    def _run_bulk(self, method_name, names, concurrency=DEFAULT_CONCURRENCY):
+        async def run():
+            async with AsyncWebDB(
+                self.host, concurrency=concurrency, serializer=self.serializer.name, delta_updates=self.delta_updates
+            ) as async_db:
+                return await getattr(async_db, method_name)(names)
+
+        return asyncio.run(run())
+
+    def get_symbol_tables(self, top_level_names, concurrency=DEFAULT_CONCURRENCY):
+        return self._run_bulk("get_symbol_tables", top_level_names, concurrency)
+
+    def get_symbol_table_metadata_many(self, top_level_names, concurrency=DEFAULT_CONCURRENCY):
+        return self._run_bulk("get_symbol_table_metadata_many", top_level_names, concurrency)
 
-    @lru_cache(256)
-    def get_symbol_table(self, top_level_name):
+    def get_artifact_metadata_many(self, artifact_names, concurrency=DEFAULT_CONCURRENCY):
+        return self._run_bulk("get_artifact_metadata_many", artifact_names, concurrency)
+
+    def get_top_level_symbols_many(self, artifact_names, concurrency=DEFAULT_CONCURRENCY):
+        return self._run_bulk("get_top_level_symbols_many", artifact_names, concurrency)
+
+    def get_symbol_table(self, top_level_name, revalidate=False):
         symbol_table_url = f"/api/v{version}/symbol_table/{top_level_name.lower()}"
         try:
-            return requests.get(f"{self.host}{symbol_table_url}").json()
+            symbol_table = self._get_json(symbol_table_url, "symbol table", revalidate=revalidate) or {}
+            if self.delta_updates:
+                symbol_table = self._apply_deltas(top_level_name, symbol_table)
+            return symbol_table
         except (
             requests.exceptions.ConnectionError,
+            requests.exceptions.RetryError,
+            requests.exceptions.Timeout,
             ChunkedEncodingError,
-            json.decoder.JSONDecodeError,
+            ValueError,
         ):
             return {}
 
-    def get_symbol_table_metadata(self, top_level_name):
+    def get_symbol_table_metadata(self, top_level_name, revalidate=False):
         symbol_table_url = f"/api/v{version}/symbol_table/{top_level_name.lower()}/metadata"
         try:
-            return requests.get(f"{self.host}{symbol_table_url}").json()
+            metadata = self._get_json(symbol_table_url, "metadata", revalidate=revalidate) or {}
+            if self.delta_updates:
+                metadata = self._apply_deltas(top_level_name, {"metadata": metadata})["metadata"]
+            return metadata
         except (
             requests.exceptions.ConnectionError,
+            requests.exceptions.RetryError,
+            requests.exceptions.Timeout,
             ChunkedEncodingError,
-            json.decoder.JSONDecodeError,
+            ValueError,
         ):
             return {}
 
     def get_artifact_metadata(self, artifact_name):
         artifact_symbols_url = f"/api/v{version}/symbols/{artifact_name}/metadata"
-        result = requests.get(f"{self.host}{artifact_symbols_url}").json()
+        result = self._get_json(artifact_symbols_url, "metadata")
         return result or {}
 
     def get_top_level_symbols(self, artifact_name):
         artifact_symbols_url = f"/api/v{version}/symbols/{artifact_name}/metadata"
-        result = requests.get(f"{self.host}{artifact_symbols_url}").json()
+        result = self._get_json(artifact_symbols_url, "metadata")
         if not result:
             return set()
         return result.get("top level symbols")
 
     def get_artifact_symbols(self, artifact_name):
         artifact_symbols_url = f"/api/v{version}/symbols/{artifact_name}"
-        result = requests.get(f"{self.host}{artifact_symbols_url}").json()
+        result = self._get_json(artifact_symbols_url, "symbols")
         return result.get("symbols", {}) if result else {}
 
     def get_current_extracted_pkgs(self):
         url = f"/api/v{version}/symbols"
-        paths = requests.get(f"{self.host}{url}").json()
+        paths = self._get_json(url, "listing", revalidate=True)
         path_by_pkg = defaultdict(set)
         for path in paths:
             pkg = path.split("/")[0]
@@ -127,7 +526,7 @@ class WebDB:
 
     def get_all_extracted_artifacts(self):
         url = f"/api/v{version}/symbols"
-        paths = requests.get(f"{self.host}{url}").json()
+        paths = self._get_json(url, "listing", revalidate=True)
         return paths
 
     def send_to_webserver(self, data, package, dst_path):
@@ -166,11 +565,104 @@ class WebDB:
         url = f"/api/v{version}/symbols/{package}/{dst_path}".replace(".json", "")
         # Upload the data
         self._push(data, url)
+        self._invalidate(url, f"{url}/metadata")
+
+
+class AsyncWebDB:
+    """asyncio client for bulk reads from the web service.
+
+    Fans out thousands of small GETs from a single event loop with at most ``concurrency`` requests in flight.
+    Must be used as an async context manager, ``WebDB`` has synchronous wrappers for the bulk methods.
+    Failed reads return the same empty values as ``WebDB``.
+    """
+
+    def __init__(
+        self, host=DEFAULT_HOST, concurrency=DEFAULT_CONCURRENCY, retries=RETRIES, serializer=None, delta_updates=False
+    ):
+        if aiohttp is None:
+            raise ImportError("aiohttp is required for the async client")
+        self.host = host
+        self.serializer = get_serializer(serializer)
+        self.delta_updates = delta_updates
+        self.concurrency = concurrency
+        self.retries = retries
+        self._session = None
+        self._semaphore = None
+
+    async def __aenter__(self):
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.concurrency))
+        return self
+
+    async def __aexit__(self, *exc):
+        await self._session.close()
+
+    async def _get_json(self, url, endpoint):
+        connect_timeout, read_timeout = TIMEOUTS[endpoint]
+        timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        for attempt in range(self.retries + 1):
+            try:
+                async with self._semaphore:
+                    headers = accept_headers(self.serializer)
+                    async with self._session.get(f"{self.host}{url}", headers=headers, timeout=timeout) as r:
+                        if r.status not in RETRY_STATUSES:
+                            return loads_content(await r.read(), r.headers.get("Content-Type"))
+            except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError):
+                pass
+            except ValueError:
+                # undecodable body
+                return None
+            if attempt < self.retries:
+                await asyncio.sleep(BACKOFF_FACTOR * 2**attempt)
+        return None
+
+    async def _apply_deltas(self, top_level_name, symbol_table):
+        if not self.delta_updates:
+            return symbol_table
+        url = f"/api/v{version}/symbol_table/{top_level_name.lower()}/deltas"
+        delta_ids = sorted({name.split("/")[0] for name in await self._get_json(url, "listing") or []})
+        deltas = await asyncio.gather(*(self._get_json(f"{url}/{delta_id}", "symbol table") for delta_id in delta_ids))
+        for delta in deltas:
+            symbol_table = apply_symbol_table_delta(symbol_table, delta or {})
+        return symbol_table
+
+    async def get_symbol_table(self, top_level_name):
+        symbol_table_url = f"/api/v{version}/symbol_table/{top_level_name.lower()}"
+        symbol_table = await self._get_json(symbol_table_url, "symbol table") or {}
+        return await self._apply_deltas(top_level_name, symbol_table)
+
+    async def get_symbol_table_metadata(self, top_level_name):
+        symbol_table_url = f"/api/v{version}/symbol_table/{top_level_name.lower()}/metadata"
+        metadata = await self._get_json(symbol_table_url, "metadata") or {}
+        return (await self._apply_deltas(top_level_name, {"metadata": metadata}))["metadata"]
+
+    async def get_artifact_metadata(self, artifact_name):
+        artifact_symbols_url = f"/api/v{version}/symbols/{artifact_name}/metadata"
+        return await self._get_json(artifact_symbols_url, "metadata") or {}
+
+    async def get_top_level_symbols(self, artifact_name):
+        result = await self.get_artifact_metadata(artifact_name)
+        if not result:
+            return set()
+        return result.get("top level symbols")
+
+    async def get_artifact_symbols(self, artifact_name):
+        artifact_symbols_url = f"/api/v{version}/symbols/{artifact_name}"
+        result = await self._get_json(artifact_symbols_url, "symbols")
+        return result.get("symbols", {}) if result else {}
+
+    async def _gather(self, func, names):
+        names = list(names)
+        return dict(zip(names, await asyncio.gather(*(func(name) for name in names))))
+
+    async def get_symbol_tables(self, top_level_names):
+        return await self._gather(self.get_symbol_table, top_level_names)
+
+    async def get_symbol_table_metadata_many(self, top_level_names):
+        return await self._gather(self.get_symbol_table_metadata, top_level_names)
 
+    async def get_artifact_metadata_many(self, artifact_names):
+        return await self._gather(self.get_artifact_metadata, artifact_names)
 
-def make_json_friendly(data):
-    if isinstance(data, set):
-        return list(sorted(data))
-    if isinstance(data, Enum):
-        return str(data)
-    return data
+    async def get_top_level_symbols_many(self, artifact_names):
+        return await self._gather(self.get_top_level_symbols, artifact_names)
@@ -0,0 +1,225 @@
+"""Size capped on disk caches that can be shared by all the workers on a machine"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+from pathlib import Path
+
+import requests
+
+logger = logging.getLogger("disk_cache")
+logger.setLevel(logging.ERROR)
+
+DEFAULT_CACHE_ROOT = os.path.join(os.environ.get("XDG_CACHE_HOME", "~/.cache"), "symbol-exporter")
+
+
+class DiskCache:
+    """Directory of cache entries evicted in least recently used order once they grow past ``max_size`` bytes.
+
+    Entries are written atomically so any number of processes can share the directory.
+    """
+
+    suffix = ".bin"
+    # Scanning the whole cache is expensive so eviction only runs after writing this fraction of the cap
+    eviction_check_fraction = 0.05
+
+    def __init__(self, directory, max_size):
+        self.directory = Path(directory).expanduser()
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._bytes_since_eviction_check = 0
+
+    @staticmethod
+    def key(*parts: str) -> str:
+        h = hashlib.sha256()
+        for part in parts:
+            h.update(part.encode("utf-8", "surrogatepass"))
+            h.update(b"\0")
+        return h.hexdigest()
+
+    def _path(self, key, suffix=None):
+        return self.directory / key[:2] / f"{key}{suffix or self.suffix}"
+
+    def _write(self, path: Path, data: bytes):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_name, path)
+        except Exception:
+            Path(tmp_name).unlink(missing_ok=True)
+            raise
+        self._bytes_since_eviction_check += len(data)
+        if self._bytes_since_eviction_check > self.max_size * self.eviction_check_fraction:
+            self.evict()
+
+    @staticmethod
+    def _touch(path: Path):
+        # bump the modification time so eviction is least recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _entries(self):
+        if not self.directory.is_dir():
+            return
+        for shard in os.scandir(self.directory):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if not entry.name.endswith(self.suffix):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                yield entry.path, stat.st_mtime, stat.st_size
+
+    def size(self):
+        return sum(size for _, _, size in self._entries())
+
+    def evict(self):
+        """Remove the least recently used entries until the cache is below 90% of ``max_size``"""
+        self._bytes_since_eviction_check = 0
+        entries = sorted(self._entries(), key=lambda x: x[1])
+        total = sum(size for _, _, size in entries)
+        if total <= self.max_size:
+            return
+        target = self.max_size * 0.9
+        for path, _, size in entries:
+            if total <= target:
+                break
+            self._remove(path)
+            total -= size
+            self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class ResponseCache(DiskCache):
+    """Cache of HTTP GET responses revalidated with ETag/Last-Modified.
+
+    Responses younger than ``max_age`` seconds are served without touching the network, older ones are
+    revalidated with a conditional request. Not found responses are cached for ``negative_ttl`` seconds.
+    Transient failures are never cached, a stale copy is served instead when there is one.
+    """
+
+    suffix = ".body"
+
+    def __init__(self, directory, max_size=4 * 1024**3, max_age=3600, negative_ttl=600):
+        super().__init__(directory, max_size)
+        self.max_age = max_age
+        self.negative_ttl = negative_ttl
+        self.revalidated = 0
+
+    @classmethod
+    def from_env(cls, name, **defaults):
+        """Cache under ``SYMBOL_EXPORTER_{NAME}_CACHE`` (default ``~/.cache/symbol-exporter/{name}``),
+        setting that variable to an empty string disables the cache. ``defaults`` are the arguments used when
+        ``SYMBOL_EXPORTER_{NAME}_CACHE_{ARG}`` is not set"""
+        prefix = f"SYMBOL_EXPORTER_{name.upper()}"
+        directory = os.environ.get(f"{prefix}_CACHE", os.path.join(DEFAULT_CACHE_ROOT, name))
+        if not directory:
+            return None
+        kwargs = dict(defaults)
+        for arg in ["max_size", "max_age", "negative_ttl"]:
+            value = os.environ.get(f"{prefix}_CACHE_{arg.upper()}")
+            if value:
+                kwargs[arg] = int(value)
+        return cls(directory, **kwargs)
+
+    def _meta_path(self, body_path: Path):
+        return body_path.with_suffix(".meta")
+
+    def _remove(self, path):
+        super()._remove(path)
+        super()._remove(self._meta_path(Path(path)))
+
+    def lookup(self, url):
+        """Metadata and path of the body of the cached response for ``url``"""
+        body_path = self._path(self.key(url))
+        try:
+            meta = json.loads(self._meta_path(body_path).read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None, body_path
+        if not body_path.exists():
+            return None, body_path
+        return meta, body_path
+
+    def store(self, url, response: requests.Response, body: bytes = None):
+        body_path = self._path(self.key(url))
+        body = response.content if body is None else body
+        meta = {
+            "url": url,
+            "digest": hashlib.sha256(body).hexdigest(),
+            "status": response.status_code,
+            "etag": response.headers.get("ETag"),
+            "last modified": response.headers.get("Last-Modified"),
+            "content type": response.headers.get("Content-Type"),
+            "stored": time.time(),
+        }
+        self._write(body_path, body)
+        self._write(self._meta_path(body_path), json.dumps(meta).encode())
+        return meta, body_path
+
+    def invalidate(self, url):
+        self._remove(self._path(self.key(url)))
+
+    def is_fresh(self, meta):
+        ttl = self.max_age if meta["status"] == 200 else self.negative_ttl
+        return time.time() - meta["stored"] < ttl
+
+    def fetch(self, session, url, timeout=None, revalidate=False, headers=None, **kwargs):
+        """GET ``url`` through the cache, returns the cached metadata and the path of the body"""
+        meta, body_path = self.lookup(url)
+        if meta is not None and not revalidate and self.is_fresh(meta):
+            self.hits += 1
+            self._touch(body_path)
+            return meta, body_path
+        headers = dict(headers or {})
+        if meta is not None and meta["status"] == 200:
+            if meta["etag"]:
+                headers["If-None-Match"] = meta["etag"]
+            if meta["last modified"]:
+                headers["If-Modified-Since"] = meta["last modified"]
+        try:
+            r = session.get(url, headers=headers, timeout=timeout, **kwargs)
+        except requests.exceptions.RequestException:
+            if meta is not None and meta["status"] == 200:
+                logger.warning(f"Serving stale {url} after a failed request")
+                return meta, body_path
+            raise
+        if r.status_code == 304 and meta is not None:
+            self.hits += 1
+            self.revalidated += 1
+            meta["stored"] = time.time()
+            self._write(self._meta_path(body_path), json.dumps(meta).encode())
+            self._touch(body_path)
+            return meta, body_path
+        self.misses += 1
+        # errors other than not found are not worth remembering
+        if r.status_code != 404:
+            r.raise_for_status()
+        return self.store(url, r)
+
+    def stats(self):
+        return dict(super().stats(), revalidated=self.revalidated)
@@ -0,0 +1,313 @@
+"""SQLite store with the same interface as ``WebDB`` so the whole pipeline can run offline on one machine"""
+
+import json
+import os
+import sqlite3
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+from symbol_exporter.db_access_model import SymbolTableConflict
+from symbol_exporter.serialization import dumps_canonical
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS artifacts (
+    name TEXT PRIMARY KEY,
+    package TEXT NOT NULL,
+    metadata TEXT
+);
+CREATE INDEX IF NOT EXISTS artifacts_package ON artifacts (package);
+
+CREATE TABLE IF NOT EXISTS artifact_symbols (
+    artifact TEXT NOT NULL REFERENCES artifacts (name) ON DELETE CASCADE,
+    symbol TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (artifact, symbol)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS artifact_symbols_symbol ON artifact_symbols (symbol);
+
+CREATE TABLE IF NOT EXISTS symbol_table_metadata (
+    top_level TEXT PRIMARY KEY,
+    metadata TEXT NOT NULL,
+    revision INTEGER NOT NULL DEFAULT 0,
+    shadow_closure TEXT
+);
+
+CREATE TABLE IF NOT EXISTS symbol_table (
+    id INTEGER PRIMARY KEY,
+    top_level TEXT NOT NULL,
+    symbol TEXT NOT NULL,
+    artifact TEXT NOT NULL,
+    shadows TEXT
+);
+CREATE INDEX IF NOT EXISTS symbol_table_top_level ON symbol_table (top_level);
+CREATE INDEX IF NOT EXISTS symbol_table_symbol ON symbol_table (symbol);
+CREATE INDEX IF NOT EXISTS symbol_table_artifact ON symbol_table (artifact);
+"""
+
+# Writes the metadata and revision of a symbol table, the closure stays, readers check it against the revisions it
+# records. INSERT OR REPLACE would delete the row and the closure with it
+PUSH_SYMBOL_TABLE_METADATA = """
+INSERT INTO symbol_table_metadata (top_level, metadata, revision) VALUES (?, ?, ?)
+ON CONFLICT (top_level) DO UPDATE SET metadata = excluded.metadata, revision = excluded.revision
+"""
+
+
+class LocalDB:
+    """Symbols and symbol tables in a SQLite database at ``path``.
+
+    Documents come back exactly as ``WebDB`` decodes them from the web service, sets as sorted lists and symbol
+    types as strings. Every thread and process gets its own connection, writes are serialised by SQLite.
+    """
+
+    # symbol tables are stored row by row so adding to them never rewrites them
+    delta_updates = True
+
+    def __init__(self, path):
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self._local = threading.local()
+        self._write_stats = {"writes": 0, "conflicts": 0}
+        self._stats_lock = threading.Lock()
+        self.connection.executescript(SCHEMA)
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(symbol_table_metadata)")]
+        for column, declaration in [("revision", "INTEGER NOT NULL DEFAULT 0"), ("shadow_closure", "TEXT")]:
+            if column not in columns:
+                self.connection.execute(f"ALTER TABLE symbol_table_metadata ADD COLUMN {column} {declaration}")
+
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.path = state["path"]
+        self._local = threading.local()
+        self._write_stats = {"writes": 0, "conflicts": 0}
+        self._stats_lock = threading.Lock()
+
+    def __repr__(self):
+        return f"LocalDB({self.path!r})"
+
+    @property
+    def connection(self):
+        conn = getattr(self._local, "connection", None)
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            self._local.connection = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self.connection
+        # take the write lock up front so concurrent read-modify-writes don't deadlock on upgrade
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def close(self):
+        conn = getattr(self._local, "connection", None)
+        if conn is not None:
+            conn.close()
+            self._local.connection = None
+
+    def cache_stats(self):
+        return {}
+
+    def _artifact_name(self, package, dst_path):
+        return f"{package}/{dst_path}".replace(".json", "")
+
+    def _revision(self, conn, top_level_name):
+        row = conn.execute(
+            "SELECT revision FROM symbol_table_metadata WHERE top_level = ?", (top_level_name,)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def _count_write(self, conflict=False):
+        with self._stats_lock:
+            self._write_stats["writes"] += 1
+            self._write_stats["conflicts"] += conflict
+
+    def write_stats(self):
+        writes, conflicts = self._write_stats["writes"], self._write_stats["conflicts"]
+        return {"writes": writes, "conflicts": conflicts, "conflict rate": conflicts / writes if writes else 0.0}
+
+    def get_symbol_table_versioned(self, top_level_name):
+        """The symbol table and its revision, 0 when there is no table"""
+        conn = self.connection
+        # one read transaction so the revision matches the rows
+        conn.execute("BEGIN")
+        try:
+            return self.get_symbol_table(top_level_name), self._revision(conn, top_level_name.lower())
+        finally:
+            conn.execute("COMMIT")
+
+    def push_symbol_table(self, top_level_name, symbol_table, if_match=None):
+        """Replace the symbol table, only if it is still at revision ``if_match`` when that is given"""
+        top_level_name = top_level_name.lower()
+        rows = [
+            (top_level_name, symbol, entry["artifact name"], entry.get("shadows"))
+            for symbol, entries in symbol_table.get("symbol table", {}).items()
+            for entry in entries
+        ]
+        with self._transaction() as conn:
+            revision = self._revision(conn, top_level_name)
+            if if_match is not None and if_match != revision:
+                self._count_write(conflict=True)
+                raise SymbolTableConflict(top_level_name)
+            conn.execute("DELETE FROM symbol_table WHERE top_level = ?", (top_level_name,))
+            conn.executemany(
+                "INSERT INTO symbol_table (top_level, symbol, artifact, shadows) VALUES (?, ?, ?, ?)", rows
+            )
+            conn.execute(
+                PUSH_SYMBOL_TABLE_METADATA,
+                (top_level_name, dumps_canonical(symbol_table.get("metadata", {})), revision + 1),
+            )
+        self._count_write()
+
+    def push_symbol_table_delta(self, top_level_name, delta):
+        """Append the entries of ``delta`` in place, there is nothing to compact afterwards"""
+        top_level_name = top_level_name.lower()
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT metadata FROM symbol_table_metadata WHERE top_level = ?", (top_level_name,)
+            ).fetchone()
+            metadata = json.loads(row[0]) if row else {}
+            already_indexed = set(metadata.get("indexed artifacts", []))
+            conn.executemany(
+                "INSERT INTO symbol_table (top_level, symbol, artifact, shadows) VALUES (?, ?, ?, ?)",
+                [
+                    (top_level_name, symbol, entry["artifact name"], entry.get("shadows"))
+                    for symbol, entries in delta.get("symbol table", {}).items()
+                    for entry in entries
+                    if entry["artifact name"] not in already_indexed
+                ],
+            )
+            delta_metadata = delta.get("metadata", {})
+            metadata.update({k: v for k, v in delta_metadata.items() if k != "indexed artifacts"})
+            metadata["indexed artifacts"] = metadata.get("indexed artifacts", []) + [
+                a for a in delta_metadata.get("indexed artifacts", []) if a not in already_indexed
+            ]
+            conn.execute(
+                PUSH_SYMBOL_TABLE_METADATA,
+                (top_level_name, dumps_canonical(metadata), self._revision(conn, top_level_name) + 1),
+            )
+        self._count_write()
+
+    def push_shadow_closure(self, top_level_name, closure):
+        """Store the resolved shadows chains of the symbol table, it stays at the same revision"""
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE symbol_table_metadata SET shadow_closure = ? WHERE top_level = ?",
+                (dumps_canonical(closure), top_level_name.lower()),
+            )
+
+    def get_symbol_table_deltas(self, top_level_name):
+        return []
+
+    def compact_symbol_table(self, top_level_name):
+        pass
+
+    def get_symbol_table(self, top_level_name, revalidate=False):
+        top_level_name = top_level_name.lower()
+        metadata = self.get_symbol_table_metadata(top_level_name)
+        table = {}
+        for symbol, artifact, shadows in self.connection.execute(
+            "SELECT symbol, artifact, shadows FROM symbol_table WHERE top_level = ? ORDER BY id", (top_level_name,)
+        ):
+            entry = {"artifact name": artifact}
+            if shadows is not None:
+                entry["shadows"] = shadows
+            table.setdefault(symbol, []).append(entry)
+        if not table and not metadata:
+            return {}
+        return {"symbol table": table, "metadata": metadata}
+
+    def get_shadow_closure(self, top_level_name):
+        row = self.connection.execute(
+            "SELECT shadow_closure FROM symbol_table_metadata WHERE top_level = ?", (top_level_name.lower(),)
+        ).fetchone()
+        return json.loads(row[0]) if row and row[0] is not None else None
+
+    def get_symbol_table_metadata(self, top_level_name, revalidate=False):
+        row = self.connection.execute(
+            "SELECT metadata FROM symbol_table_metadata WHERE top_level = ?", (top_level_name.lower(),)
+        ).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def get_current_symbol_table_artifacts_by_top_level(self):
+        return {
+            top_level: set(json.loads(metadata).get("indexed artifacts", {}))
+            for top_level, metadata in self.connection.execute("SELECT top_level, metadata FROM symbol_table_metadata")
+        }
+
+    def get_artifact_metadata(self, artifact_name):
+        row = self.connection.execute("SELECT metadata FROM artifacts WHERE name = ?", (artifact_name,)).fetchone()
+        return (json.loads(row[0]) or {}) if row else {}
+
+    def get_top_level_symbols(self, artifact_name):
+        metadata = self.get_artifact_metadata(artifact_name)
+        if not metadata:
+            return set()
+        return metadata.get("top level symbols")
+
+    def get_artifact_symbols(self, artifact_name):
+        return {
+            symbol: json.loads(data)
+            for symbol, data in self.connection.execute(
+                "SELECT symbol, data FROM artifact_symbols WHERE artifact = ?", (artifact_name,)
+            )
+        }
+
+    def get_artifacts_providing(self, symbol):
+        """Names of the artifacts that define ``symbol``, straight from the extracted symbols"""
+        return [
+            artifact
+            for (artifact,) in self.connection.execute(
+                "SELECT artifact FROM artifact_symbols WHERE symbol = ? ORDER BY artifact", (symbol,)
+            )
+        ]
+
+    def get_current_extracted_pkgs(self):
+        path_by_pkg = defaultdict(set)
+        for package, name in self.connection.execute("SELECT package, name FROM artifacts"):
+            path_by_pkg[package].add(name)
+        return path_by_pkg
+
+    def get_all_extracted_artifacts(self):
+        return [name for (name,) in self.connection.execute("SELECT name FROM artifacts ORDER BY name")]
+
+    def send_to_webserver(self, data, package, dst_path):
+        name = self._artifact_name(package, dst_path)
+        # round trip through json so the stored documents match what the web service hands back
+        data = json.loads(dumps_canonical(data or None))
+        metadata = data["metadata"] if data else None
+        symbols = data.get("symbols", {}) if data else {}
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM artifacts WHERE name = ?", (name,))
+            conn.execute(
+                "INSERT INTO artifacts (name, package, metadata) VALUES (?, ?, ?)",
+                (name, package, json.dumps(metadata)),
+            )
+            conn.executemany(
+                "INSERT INTO artifact_symbols (artifact, symbol, data) VALUES (?, ?, ?)",
+                [(name, symbol, dumps_canonical(value)) for symbol, value in symbols.items()],
+            )
+
+    def get_symbol_tables(self, top_level_names, concurrency=None):
+        return {name: self.get_symbol_table(name) for name in top_level_names}
+
+    def get_symbol_table_metadata_many(self, top_level_names, concurrency=None):
+        return {name: self.get_symbol_table_metadata(name) for name in top_level_names}
+
+    def get_artifact_metadata_many(self, artifact_names, concurrency=None):
+        return {name: self.get_artifact_metadata(name) for name in artifact_names}
+
+    def get_top_level_symbols_many(self, artifact_names, concurrency=None):
+        return {name: self.get_top_level_symbols(name) for name in artifact_names}
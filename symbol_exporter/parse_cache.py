@@ -0,0 +1,56 @@
+"""On disk cache of parsed module symbols keyed by the content of the source"""
+import logging
+import os
+import pickle
+
+from symbol_exporter.ast_symbol_extractor import version
+from symbol_exporter.disk_cache import DiskCache
+
+logger = logging.getLogger("parse_cache")
+logger.setLevel(logging.ERROR)
+
+# Environment variable holding the directory of the cache shared by all the workers on a machine
+PARSE_CACHE_ENV = "SYMBOL_EXPORTER_PARSE_CACHE"
+PARSE_CACHE_SIZE_ENV = "SYMBOL_EXPORTER_PARSE_CACHE_SIZE"
+DEFAULT_MAX_SIZE = 2 * 1024**3
+
+
+class ParseCache(DiskCache):
+    """Stores the output of ``parse_code`` on disk.
+
+    Entries are keyed by sha256(source) + module name + extractor version so byte identical files across builds,
+    python variants and vendored copies are only parsed once.
+    """
+
+    suffix = ".pkl"
+
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE):
+        super().__init__(directory, max_size)
+
+    @classmethod
+    def from_env(cls):
+        directory = os.environ.get(PARSE_CACHE_ENV)
+        if not directory:
+            return None
+        return cls(directory, max_size=int(os.environ.get(PARSE_CACHE_SIZE_ENV, DEFAULT_MAX_SIZE)))
+
+    def get(self, code: str, module_name: str):
+        path = self._path(self.key(code, module_name, version))
+        try:
+            with open(path, "rb") as f:
+                symbols = pickle.load(f)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except Exception as e:
+            logger.warning(f"Dropping unreadable cache entry {path}. {repr(e)}")
+            self._remove(path)
+            self.misses += 1
+            return None
+        self._touch(path)
+        self.hits += 1
+        return symbols
+
+    def put(self, code: str, module_name: str, symbols: dict):
+        path = self._path(self.key(code, module_name, version))
+        self._write(path, pickle.dumps(symbols, protocol=pickle.HIGHEST_PROTOCOL))
@@ -0,0 +1,60 @@
+"""Shared HTTP sessions with connection pooling and retries"""
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+POOL_SIZE = int(os.environ.get("SYMBOL_EXPORTER_HTTP_POOL_SIZE", 64))
+RETRIES = int(os.environ.get("SYMBOL_EXPORTER_HTTP_RETRIES", 5))
+BACKOFF_FACTOR = 0.5
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# (connect, read) timeouts in seconds by kind of endpoint
+TIMEOUTS = {
+    "symbol table": (10, 120),
+    "metadata": (10, 30),
+    "symbols": (10, 120),
+    "listing": (10, 300),
+    "push": (10, 600),
+    "artifact": (10, 120),
+    "repodata": (10, 300),
+}
+
+_sessions = {}
+_lock = threading.Lock()
+
+
+def make_session(pool_size=POOL_SIZE, retries=RETRIES, backoff_factor=BACKOFF_FACTOR):
+    """Session that keeps up to ``pool_size`` connections alive per host.
+
+    Connection errors and transient statuses are retried with exponential backoff, requests wait for a free
+    connection instead of opening more than ``pool_size`` to the same host. With ``retries=0`` error statuses
+    are handed back to the caller, for bodies that can't be replayed and need retrying by hand.
+    """
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=RETRY_STATUSES if retries else (),
+        allowed_methods=frozenset({"GET", "HEAD", "PUT"}),
+        raise_on_status=True,
+        respect_retry_after_header=True,
+    )
+    adapter = HTTPAdapter(pool_connections=8, pool_maxsize=pool_size, pool_block=True, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session():
+    """Session shared by everything in this process, connection pools are not shared across a fork"""
+    pid = os.getpid()
+    session = _sessions.get(pid)
+    if session is None:
+        with _lock:
+            session = _sessions.get(pid)
+            if session is None:
+                session = _sessions[pid] = make_session()
+    return session
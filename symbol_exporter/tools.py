@@ -4,14 +4,22 @@ from concurrent.futures.process import ProcessPoolExecutor
 from concurrent.futures.thread import ThreadPoolExecutor
 
 from collections import defaultdict
-import requests
+from functools import lru_cache
+from pathlib import Path
 import json
 import bz2
-import io
 import os
 import glob
+import pickle
+import re
+import tempfile
+
+import requests
 from xonsh.tools import expand_path
 
+from symbol_exporter.disk_cache import ResponseCache
+from symbol_exporter.sessions import get_session, TIMEOUTS
+
 try:
     from conda.models.version import normalized_version
 except ImportError:
@@ -148,23 +156,273 @@ channel_list = [
 ]
 
 
-def fetch_arch(arch, conditional=None):
-    # Generate a set a urls to generate for an channel/arch combo
-    print(f"Fetching {arch}")
-    r = requests.get(f"{arch}/repodata.json.bz2")
-    repodata = json.load(bz2.BZ2File(io.BytesIO(r.content)))
-    for p, v in repodata["packages"].items():
-        package_url = f"{arch}/{p}"
-        file_name = package_url.replace("https://conda.anaconda.org/", "").replace(".tar.bz2", ".json")
+def artifact_format(url):
+    return ".conda" if url.endswith(".conda") else ".tar.bz2"
+
+
+def artifact_json_name(package_url):
+    return package_url.replace("https://conda.anaconda.org/", "").removesuffix(artifact_format(package_url)) + ".json"
+
+
+REPODATA_KEYS = ("packages", "packages.conda")
+# Characters of repodata read at a time by the streaming parser
+REPODATA_CHUNK_SIZE = 1024 * 1024
+
+
+def select_repodata(arch, records, conditional=None):
+    """The ``(name, file name, url, size)`` of the ``(key, artifact, record)`` accepted by ``conditional``.
+
+    Only the accepted records and the names of the .conda builds are kept, so ``records`` can be streamed.
+    """
+    conda_builds = set()
+    selected = []
+    for key, p, v in records:
+        if key == "packages.conda":
+            conda_builds.add(p.removesuffix(".conda"))
         if conditional is None or conditional(v):
-            yield v["name"], file_name, package_url
+            selected.append((key, p, v["name"], v.get("size")))
+    for key, p, name, size in selected:
+        # prefer the .conda build of an artifact, zstd decompresses several times faster than bz2
+        if key == "packages" and p.removesuffix(".tar.bz2") in conda_builds:
+            continue
+        package_url = f"{arch}/{p}"
+        yield name, artifact_json_name(package_url), package_url, size
+
+
+def iter_repodata(arch, repodata, conditional=None):
+    records = ((key, p, v) for key in REPODATA_KEYS for p, v in repodata.get(key, {}).items())
+    return select_repodata(arch, records, conditional)
+
+
+class _JSONStream:
+    """Reads the json values of a text stream one by one, only buffering the value being decoded"""
+
+    _decoder = json.JSONDecoder()
+    _whitespace = re.compile(r"[ \t\n\r]*")
+
+    def __init__(self, fileobj, chunk_size):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        # read at least as much as is buffered so a value spanning many chunks is decoded in linear time
+        chunk = self.fileobj.read(max(self.chunk_size, len(self.buffer) - self.pos))
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos :] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """The next character that isn't whitespace"""
+        while True:
+            self.pos = self._whitespace.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                raise ValueError("Unexpected end of the json stream")
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"Expected {char!r} in the json stream, found {found!r}")
+        self.pos += 1
+
+    def skip(self, char):
+        """Consume ``char`` if it is next"""
+        if self.peek() == char:
+            self.pos += 1
+            return True
+        return False
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if self._fill():
+                    continue
+                raise
+            # a number at the end of the buffer may go on in the next chunk
+            if end == len(self.buffer) and not self.eof and self._fill():
+                continue
+            self.pos = end
+            return value
+
+
+def iter_repodata_records(fileobj, chunk_size=REPODATA_CHUNK_SIZE, keys=REPODATA_KEYS):
+    """Yield the ``(key, artifact, record)`` of the ``keys`` of the repodata.json read from ``fileobj``.
+
+    Records are decoded one at a time and the rest of the document is skipped over, so memory doesn't grow with
+    the size of the repodata.
+    """
+    stream = _JSONStream(fileobj, chunk_size)
+    stream.expect("{")
+    if stream.skip("}"):
+        return
+    while True:
+        key = stream.value()
+        stream.expect(":")
+        if key in keys and stream.skip("{"):
+            while not stream.skip("}"):
+                artifact = stream.value()
+                stream.expect(":")
+                yield key, artifact, stream.value()
+                if not stream.skip(","):
+                    stream.expect("}")
+                    break
+        else:
+            stream.value()
+        if not stream.skip(","):
+            stream.expect("}")
+            return
+
+
+def parse_repodata(body: bytes):
+    repodata = json.loads(bz2.decompress(body))
+    return {k: repodata.get(k, {}) for k in REPODATA_KEYS}
 
 
-def fetch_upstream(conditional=None):
+def _selection_name(conditional):
+    if conditional is None:
+        return "all"
+    qualname = getattr(conditional, "__qualname__", "<unnamed>")
+    # lambdas and nested functions can't be told apart by name
+    if "<" in qualname:
+        return None
+    return f"{conditional.__module__}.{qualname}"
+
+
+class RepodataCache(ResponseCache):
+    """Cache of the repodata responses which also keeps the parsed repodata of each one.
+
+    A response that is still fresh, or revalidated with a 304, is loaded from the pickle without decompressing
+    and parsing the bz2 body again.
+    """
+
+    def _parsed_path(self, body_path):
+        return Path(body_path).with_suffix(".pkl")
+
+    # bumped when the tuples of a selection change
+    selection_format = 2
+
+    def _selection_path(self, body_path, name):
+        return Path(body_path).with_suffix(f".{name}.sel")
+
+    def _remove(self, path):
+        super()._remove(path)
+        super(ResponseCache, self)._remove(self._parsed_path(path))
+        for selection_path in Path(path).parent.glob(f"{Path(path).stem}.*.sel"):
+            super(ResponseCache, self)._remove(selection_path)
+
+    def _fetch_ok(self, session, url, timeout):
+        meta, body_path = self.fetch(session, url, timeout=timeout)
+        if meta["status"] != 200:
+            raise requests.HTTPError(f"{meta['status']} for {url}")
+        return meta, body_path
+
+    def _read_derived(self, path, digest):
+        try:
+            with open(path, "rb") as f:
+                # the digest is pickled first so a stale entry is found without loading the rest
+                if pickle.load(f) == digest:
+                    return pickle.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Dropping unreadable {path}. {repr(e)}")
+        return None
+
+    def _write_derived(self, path, digest, data):
+        self._write(
+            path,
+            pickle.dumps(digest, protocol=pickle.HIGHEST_PROTOCOL)
+            + pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL),
+        )
+
+    def load(self, session, url, timeout=None):
+        meta, body_path = self._fetch_ok(session, url, timeout)
+        parsed_path = self._parsed_path(body_path)
+        repodata = self._read_derived(parsed_path, meta["digest"])
+        if repodata is None:
+            repodata = parse_repodata(body_path.read_bytes())
+            self._write_derived(parsed_path, meta["digest"], repodata)
+        return repodata
+
+    def select(self, session, url, arch, conditional=None, timeout=None):
+        """The artifacts of the repodata at ``url`` accepted by ``conditional``, see ``select_repodata``.
+
+        The body is streamed through ``iter_repodata_records`` and the selection is kept under the name of
+        ``conditional``, so it is only computed again when the repodata changed.
+        """
+        meta, body_path = self._fetch_ok(session, url, timeout)
+        name = _selection_name(conditional)
+        selection_path = self._selection_path(body_path, name) if name else None
+        key = (meta["digest"], self.selection_format)
+        selection = self._read_derived(selection_path, key) if name else None
+        if selection is None:
+            with bz2.open(body_path, "rt", encoding="utf-8") as f:
+                selection = list(select_repodata(arch, iter_repodata_records(f), conditional))
+            if name:
+                self._write_derived(selection_path, key, selection)
+        return selection
+
+
+@lru_cache(maxsize=None)
+def repodata_cache():
+    """The repodata cache set up by the ``SYMBOL_EXPORTER_REPODATA_CACHE*`` variables, see ``ResponseCache.from_env``"""
+    return RepodataCache.from_env("repodata")
+
+
+def load_repodata(arch, cache=None):
+    """The packages of the repodata of a channel/arch, only downloaded and parsed again when it changed"""
+    url = f"{arch}/repodata.json.bz2"
+    cache = cache or repodata_cache()
+    if cache is None:
+        r = get_session().get(url, timeout=TIMEOUTS["repodata"])
+        r.raise_for_status()
+        return parse_repodata(r.content)
+    return cache.load(get_session(), url, timeout=TIMEOUTS["repodata"])
+
+
+def existing_versions(channels=None, cache=None):
+    """The versions of every package on ``channels``, ``channel_list`` by default"""
+    versions_by_package = defaultdict(set)
+    for channel in channels or channel_list:
+        repodata = load_repodata(channel, cache=cache)
+        for packages in repodata.values():
+            for v in packages.values():
+                versions_by_package[v["name"]].add(v["version"])
+    return dict(versions_by_package)
+
+
+def fetch_arch(arch, conditional=None):
+    # Generate a set a urls to generate for an channel/arch combo
+    print(f"Fetching {arch}")
+    url = f"{arch}/repodata.json.bz2"
+    cache = repodata_cache()
+    if cache is not None:
+        yield from cache.select(get_session(), url, arch, conditional, timeout=TIMEOUTS["repodata"])
+        return
+    with get_session().get(url, timeout=TIMEOUTS["repodata"], stream=True) as r:
+        r.raise_for_status()
+        with bz2.open(r.raw, "rt", encoding="utf-8") as f:
+            yield from select_repodata(arch, iter_repodata_records(f), conditional)
+
+
+def fetch_upstream(conditional=None, sizes=None):
+    """The urls of the artifacts of each package by file name, ``sizes`` is filled with the size of each url"""
     package_urls = defaultdict(dict)
     for channel_arch in channel_list:
-        for package_name, filename, url in fetch_arch(channel_arch, conditional=conditional):
+        for package_name, filename, url, size in fetch_arch(channel_arch, conditional=conditional):
             package_urls[package_name][filename] = url
+            if sizes is not None:
+                sizes[url] = size
     return package_urls
 
 
@@ -181,10 +439,68 @@ def recursive_ls(root):
             yield p, f.replace(f"{root}/{p}/", "")
 
 
-def existing(path, recursive_ls=recursive_ls):
+class Manifest:
+    """Append-only list of the files written under ``root`` so finding what is already there is a single read.
+
+    Writers ``add`` the path of a file, relative to ``root``, once the file is complete. Every entry is a single
+    ``write`` to a file opened for appending, so entries from several processes don't interleave. Files written
+    before the manifest existed, or lost by a crash between the two writes, are picked up by ``rebuild``.
+    """
+
+    file_name = "_manifest.txt"
+
+    def __init__(self, root):
+        self.root = root
+        self.path = os.path.join(root, self.file_name)
+
+    def add(self, relative_path):
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, f"{relative_path}\n".encode())
+        finally:
+            os.close(fd)
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def paths(self):
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return set()
+        # a line without its newline is an entry still being written
+        return set(data.decode().split("\n")[:-1])
+
+    def files_on_disk(self):
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for file_name in filenames:
+                if (dirpath == self.root and file_name.startswith("_")) or file_name.endswith(".tmp"):
+                    continue
+                yield os.path.relpath(os.path.join(dirpath, file_name), self.root)
+
+    def rebuild(self):
+        """Replace the manifest with the files found on disk, nothing should be writing under ``root`` meanwhile"""
+        paths = sorted(self.files_on_disk())
+        fd, tmp_name = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            f.writelines(f"{path}\n" for path in paths)
+        os.replace(tmp_name, self.path)
+        return set(paths)
+
+
+def existing(path, recursive_ls=None):
+    """The extracted artifacts under ``path`` by package, from its manifest which is built on first use"""
     existing_dict = defaultdict(set)
-    for pak, path in recursive_ls(path):
-        existing_dict[pak].add(path)
+    if recursive_ls is not None:
+        for pak, path in recursive_ls(path):
+            existing_dict[pak].add(path)
+        return existing_dict
+    manifest = Manifest(path)
+    for relative_path in manifest.paths() if manifest.exists() else manifest.rebuild():
+        pak, _, dst_path = relative_path.partition("/")
+        if dst_path.endswith(".json"):
+            existing_dict[pak].add(dst_path)
     return existing_dict
 
 
@@ -198,29 +514,78 @@ def expand_file_and_mkdirs(x):
     return x
 
 
+@lru_cache(maxsize=2**18)
+def parse_version(version: str):
+    return normalized_version(version)
+
+
+class VersionIndex:
+    """The versions of a package parsed and sorted once, to turn sets of acceptable versions into ranges"""
+
+    def __init__(self, all_versions):
+        self.versions = sorted(map(parse_version, all_versions))
+
+    def ranges(self, acceptable_versions):
+        """Ranges of consecutive acceptable versions, eg ``>=1.0,<=1.1.1|1.1.3|>=1.1.5``"""
+        acceptable = sorted(map(parse_version, acceptable_versions))
+        range_endpoints = []
+        current_range = None
+        j = 0
+        # both lists are sorted so one pass over each tells which versions are acceptable
+        for version in self.versions:
+            while j < len(acceptable) and acceptable[j] < version:
+                j += 1
+            if j < len(acceptable) and acceptable[j] == version:
+                if current_range is None:
+                    current_range = [version, version]
+                current_range[-1] = version
+            elif current_range is not None:
+                range_endpoints.append(current_range)
+                current_range = None
+        if current_range is not None:
+            range_endpoints.append(current_range)
+        ranges = []
+        for lower, higher in range_endpoints:
+            if higher == self.versions[-1]:
+                ranges.append(f">={lower}")
+            elif lower != higher:
+                ranges.append(f">={lower},<={higher}")
+            else:
+                ranges.append(f"{lower}")
+        return "|".join(ranges)
+
+
+class VersionIndexes:
+    """``VersionIndex`` of every package of ``versions_by_package``, built the first time it is needed"""
+
+    def __init__(self, versions_by_package):
+        self.versions_by_package = versions_by_package
+        self._indexes = {}
+
+    def __getitem__(self, package):
+        if package not in self._indexes:
+            self._indexes[package] = VersionIndex(self.versions_by_package.get(package, ()))
+        return self._indexes[package]
+
+    def find_version_ranges_many(self, acceptable_versions_by_package):
+        return {
+            package: self[package].ranges(acceptable_versions)
+            for package, acceptable_versions in acceptable_versions_by_package.items()
+        }
+
+
 def find_version_ranges(all_versions, acceptable_versions):
-    _all_versions = sorted(map(normalized_version, all_versions))
-    _acceptable_versions = sorted(map(normalized_version, acceptable_versions))
-    range_endpoints = []
-    current_range = []
-    # TODO: speed up this loop by only going over acceptable versions,
-    # and asking if current version is same as previous version index +1 in all versions
-    for version in _all_versions:
-        if version in _acceptable_versions:
-            if not current_range:
-                current_range = [version, version]
-            current_range[-1] = version
-        else:
-            range_endpoints.append(tuple(current_range))
-            current_range = []
-    if current_range:
-        range_endpoints.append(tuple(current_range))
-    ranges = []
-    for lower, higher in filter(bool, range_endpoints):
-        if higher == _all_versions[-1]:
-            ranges.append(f">={lower}")
-        elif lower != higher:
-            ranges.append(f">={lower},<={higher}")
-        else:
-            ranges.append(f"{lower}")
-    return "|".join(ranges)
+    return VersionIndex(all_versions).ranges(acceptable_versions)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    rebuild_parser = subparsers.add_parser("rebuild-manifest", help="rebuild the manifest of an output directory")
+    rebuild_parser.add_argument("root_path", help="output directory of a local reap or of the audit")
+
+    args = parser.parse_args()
+    manifest = Manifest(args.root_path)
+    print(f"{len(manifest.rebuild())} files in {manifest.path}")
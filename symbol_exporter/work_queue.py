@@ -0,0 +1,416 @@
+"""Durable queue of the artifacts to reap so runs resume where the last one stopped"""
+
+import os
+import sqlite3
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, wait
+from contextlib import contextmanager
+
+from tqdm import tqdm
+
+# Seconds a worker has to finish an artifact before it is handed out again
+LEASE_SECONDS = int(os.environ.get("SYMBOL_EXPORTER_LEASE_SECONDS", 3600))
+# Attempts after which an artifact is quarantined instead of retried
+MAX_ATTEMPTS = int(os.environ.get("SYMBOL_EXPORTER_MAX_ATTEMPTS", 3))
+# An artifact still running this many times longer than expected, and at least STRAGGLER_SECONDS, is a straggler
+STRAGGLER_FACTOR = float(os.environ.get("SYMBOL_EXPORTER_STRAGGLER_FACTOR", 3))
+STRAGGLER_SECONDS = float(os.environ.get("SYMBOL_EXPORTER_STRAGGLER_SECONDS", 60))
+
+PENDING, LEASED, DONE, FAILED = "pending", "leased", "done", "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS work (
+    dst TEXT PRIMARY KEY,
+    package TEXT NOT NULL,
+    src_url TEXT NOT NULL,
+    priority INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    lease_expires REAL,
+    last_error TEXT,
+    seen INTEGER NOT NULL DEFAULT 0,
+    size INTEGER,
+    seconds REAL,
+    started INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS work_state ON work (state, priority);
+CREATE INDEX IF NOT EXISTS work_src_url ON work (src_url);
+
+CREATE TABLE IF NOT EXISTS queue_metadata (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+def _timed(func, package, dst, src_url):
+    start = time.perf_counter()
+    func(package, dst, src_url)
+    return time.perf_counter() - start
+
+
+def abandon(pool):
+    """Shut ``pool`` down without waiting for the tasks still running, the worker processes of a
+    ``ProcessPoolExecutor`` running them are terminated. Threads can't be stopped, they are left to finish."""
+    processes = list((getattr(pool, "_processes", None) or {}).values())
+    pool.shutdown(wait=False, cancel_futures=True)
+    for process in processes:
+        process.terminate()
+
+
+class CostModel:
+    """Expected seconds to reap an artifact from the extraction times of its package, or of every package.
+
+    ``history`` maps packages to their total seconds, total size and number of reaped artifacts.
+    """
+
+    def __init__(self, history=None):
+        self.history = defaultdict(lambda: [0.0, 0, 0])
+        for package, totals in (history or {}).items():
+            self.history[package] = list(totals)
+        self.total = [sum(totals[i] for totals in self.history.values()) for i in range(3)]
+
+    def observe(self, package, size, seconds):
+        for totals in [self.history[package], self.total]:
+            totals[0] += seconds
+            totals[1] += size or 0
+            totals[2] += 1
+
+    def seconds(self, package, size):
+        """Expected seconds, ``None`` when there is nothing to go by"""
+        totals = self.history.get(package)
+        if totals and totals[2]:
+            seconds, total_size, count = totals
+            return seconds / total_size * size if size and total_size else seconds / count
+        seconds, total_size, _ = self.total
+        if size and total_size:
+            return seconds / total_size * size
+        return None
+
+
+class WorkQueue:
+    """Artifacts to reap in a SQLite database at ``path``, each ``pending``, ``leased``, ``done`` or ``failed``.
+
+    ``lease`` hands out the pending artifacts with the lowest priority, and those whose lease expired, ``start``
+    counts an attempt once a worker picks a leased artifact up. ``fail`` puts an artifact back until it has been
+    attempted ``max_attempts`` times, after which it is quarantined as ``failed`` with its last error. A lease
+    that expires after the artifact was started counts as a failure too, one that was never started doesn't.
+    When a ``version`` is given, the work of a different extractor version is dropped as the queue is opened.
+    """
+
+    def __init__(self, path, version=None, max_attempts=MAX_ATTEMPTS, lease_seconds=LEASE_SECONDS):
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+        self._local = threading.local()
+        self.connection.executescript(SCHEMA)
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(work)")]
+        for column, declaration in [
+            ("size", "INTEGER"),
+            ("seconds", "REAL"),
+            ("started", "INTEGER NOT NULL DEFAULT 0"),
+        ]:
+            if column not in columns:
+                self.connection.execute(f"ALTER TABLE work ADD COLUMN {column} {declaration}")
+        if version is None:
+            return
+        with self._transaction() as conn:
+            row = conn.execute("SELECT value FROM queue_metadata WHERE key = 'version'").fetchone()
+            if row is None or row[0] != version:
+                conn.execute("DELETE FROM work")
+                conn.execute("INSERT OR REPLACE INTO queue_metadata VALUES ('version', ?)", (version,))
+
+    def __getstate__(self):
+        return {"path": self.path, "max_attempts": self.max_attempts, "lease_seconds": self.lease_seconds}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def __repr__(self):
+        return f"WorkQueue({self.path!r})"
+
+    @property
+    def connection(self):
+        conn = getattr(self._local, "connection", None)
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self.connection
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def close(self):
+        conn = getattr(self._local, "connection", None)
+        if conn is not None:
+            conn.close()
+            self._local.connection = None
+
+    def enqueue(self, items, sizes=None):
+        """Replace the outstanding work with ``items``, ``(package, dst, src_url)`` in order of priority.
+        ``sizes`` maps the urls to the size of their artifact.
+
+        Artifacts that are already queued keep their state and attempts, except finished ones that are missing
+        again. Pending artifacts that aren't in ``items`` any more are done.
+        """
+        with self._transaction() as conn:
+            (seen,) = conn.execute("SELECT COALESCE(MAX(seen), 0) + 1 FROM work").fetchone()
+            conn.executemany(
+                """
+                INSERT INTO work (dst, package, src_url, priority, state, seen, size) VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (dst) DO UPDATE SET
+                    package = excluded.package,
+                    src_url = excluded.src_url,
+                    priority = excluded.priority,
+                    size = excluded.size,
+                    state = CASE WHEN state = ? THEN ? ELSE state END,
+                    seen = excluded.seen
+                """,
+                (
+                    (dst, package, src_url, priority, PENDING, seen, (sizes or {}).get(src_url), DONE, PENDING)
+                    for priority, (package, dst, src_url) in enumerate(items)
+                ),
+            )
+            conn.execute("UPDATE work SET state = ? WHERE state = ? AND seen != ?", (DONE, PENDING, seen))
+            conn.execute("INSERT OR REPLACE INTO queue_metadata VALUES ('enqueued', ?)", (str(time.time()),))
+
+    def age(self):
+        """Seconds since the last ``enqueue``"""
+        row = self.connection.execute("SELECT value FROM queue_metadata WHERE key = 'enqueued'").fetchone()
+        return time.time() - float(row[0]) if row else float("inf")
+
+    def quarantine(self, src_urls, reason="known bad"):
+        with self._transaction() as conn:
+            conn.executemany(
+                "UPDATE work SET state = ?, last_error = ?, lease_expires = NULL WHERE src_url = ?",
+                ((FAILED, reason, src_url) for src_url in src_urls),
+            )
+
+    def _expire_leases(self, conn, now):
+        # artifacts that were never started go back untouched, nothing was tried on them
+        conn.execute(
+            "UPDATE work SET state = ?, lease_expires = NULL WHERE state = ? AND NOT started AND lease_expires <= ?",
+            (PENDING, LEASED, now),
+        )
+        conn.execute(
+            """
+            UPDATE work SET
+                state = CASE WHEN attempts >= ? THEN ? ELSE ? END,
+                last_error = 'lease expired',
+                lease_expires = NULL
+            WHERE state = ? AND started AND lease_expires <= ?
+            """,
+            (self.max_attempts, FAILED, PENDING, LEASED, now),
+        )
+
+    def lease(self, n):
+        """Lease up to ``n`` artifacts, returns their ``(package, dst, src_url)``"""
+        now = time.time()
+        with self._transaction() as conn:
+            self._expire_leases(conn, now)
+            rows = conn.execute(
+                "SELECT package, dst, src_url FROM work WHERE state = ? ORDER BY priority LIMIT ?", (PENDING, n)
+            ).fetchall()
+            conn.executemany(
+                "UPDATE work SET state = ?, started = 0, lease_expires = ? WHERE dst = ?",
+                ((LEASED, now + self.lease_seconds, dst) for _, dst, _ in rows),
+            )
+        return rows
+
+    def start(self, dst):
+        """Count an attempt on a leased artifact that is about to run, its lease runs from now"""
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE work SET attempts = attempts + 1, started = 1, lease_expires = ? WHERE dst = ? AND state = ?",
+                (time.time() + self.lease_seconds, dst, LEASED),
+            )
+
+    def complete(self, dst, seconds=None):
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE work SET state = ?, last_error = NULL, lease_expires = NULL, seconds = ? WHERE dst = ?",
+                (DONE, seconds, dst),
+            )
+
+    def fail(self, dst, error):
+        with self._transaction() as conn:
+            conn.execute(
+                """
+                UPDATE work SET
+                    state = CASE WHEN attempts >= ? THEN ? ELSE ? END,
+                    last_error = ?,
+                    lease_expires = NULL
+                WHERE dst = ?
+                """,
+                (self.max_attempts, FAILED, PENDING, error, dst),
+            )
+
+    def release(self, dst=None):
+        """Give quarantined artifacts, all of them by default, a fresh set of attempts"""
+        query = "UPDATE work SET state = ?, attempts = 0 WHERE state = ?"
+        args = (PENDING, FAILED)
+        if dst is not None:
+            query, args = query + " AND dst = ?", args + (dst,)
+        with self._transaction() as conn:
+            return conn.execute(query, args).rowcount
+
+    def outstanding(self):
+        """Number of artifacts pending or leased"""
+        (count,) = self.connection.execute(
+            "SELECT COUNT(*) FROM work WHERE state IN (?, ?)", (PENDING, LEASED)
+        ).fetchone()
+        return count
+
+    def failures(self):
+        """The ``(src_url, attempts, last error)`` of the quarantined artifacts"""
+        return self.connection.execute(
+            "SELECT src_url, attempts, last_error FROM work WHERE state = ? ORDER BY src_url", (FAILED,)
+        ).fetchall()
+
+    def cost_model(self):
+        rows = self.connection.execute("""
+            SELECT package, SUM(seconds), SUM(COALESCE(size, 0)), COUNT(*) FROM work
+            WHERE seconds IS NOT NULL GROUP BY package
+            """)
+        return CostModel({package: totals for package, *totals in rows})
+
+    def sizes(self, dsts):
+        """The size of the artifacts of ``dsts`` that have one"""
+        sizes = {}
+        for dst in dsts:
+            row = self.connection.execute("SELECT size FROM work WHERE dst = ?", (dst,)).fetchone()
+            if row and row[0] is not None:
+                sizes[dst] = row[0]
+        return sizes
+
+    def stats(self):
+        counts = dict.fromkeys([PENDING, LEASED, DONE, FAILED], 0)
+        counts.update(self.connection.execute("SELECT state, COUNT(*) FROM work GROUP BY state"))
+        return counts
+
+    def run(self, func, package, dst, src_url):
+        """Call ``func`` on a leased artifact and record how it went"""
+        self.start(dst)
+        try:
+            seconds = _timed(func, package, dst, src_url)
+        except Exception as e:
+            print(f"Failure: {package}, {src_url}, {repr(e)}")
+            self.fail(dst, repr(e))
+        else:
+            self.complete(dst, seconds)
+
+    def schedule(self, items):
+        """``items`` most expensive first, with the seconds each is expected to take"""
+        model = self.cost_model()
+        sizes = self.sizes(dst for _, dst, _ in items)
+        expected = {dst: model.seconds(package, sizes.get(dst)) for package, dst, _ in items}
+        # by size alone when nothing was reaped yet, unknown costs go last
+        order = sorted(
+            items,
+            key=lambda item: (expected[item[1]] is not None, expected[item[1]] or 0, sizes.get(item[1], 0)),
+            reverse=True,
+        )
+        return order, expected, sizes, model
+
+    def run_batch(
+        self, pool, func, items, max_workers, straggler_factor=STRAGGLER_FACTOR, straggler_seconds=STRAGGLER_SECONDS
+    ):
+        """Call ``func`` on the leased ``items`` in the executor ``pool`` and record how it went.
+
+        Only ``max_workers`` artifacts are submitted at a time, most expensive first, so each worker takes the
+        next largest as it frees up and no big artifact is left for the end. Once nothing is left to submit,
+        idle workers run a second copy of the stragglers, the artifacts taking ``straggler_factor`` times longer
+        than expected, and the first copy that succeeds wins. The pool is ``abandon``ed if copies that lost are
+        still running when every artifact is settled, so a hung straggler doesn't hold up the batch.
+        """
+        order, expected, sizes, model = self.schedule(items)
+        todo = deque(order)
+        running = {}
+        copies = defaultdict(int)
+        speculated = set()
+        finished = set()
+
+        def submit(item):
+            # the second copy of a straggler is part of the same attempt
+            if not copies[item[1]]:
+                self.start(item[1])
+            running[pool.submit(_timed, func, *item)] = (item, time.monotonic())
+            copies[item[1]] += 1
+
+        def straggler():
+            now = time.monotonic()
+            candidates = [
+                (now - started, item)
+                for item, started in running.values()
+                if item[1] not in speculated
+                and item[1] not in finished
+                and now - started
+                > max(straggler_seconds, straggler_factor * (model.seconds(item[0], sizes.get(item[1])) or 0))
+            ]
+            return max(candidates)[1] if candidates else None
+
+        with tqdm(total=len(items)) as progress:
+            while len(finished) < len(order):
+                while todo and len(running) < max_workers:
+                    submit(todo.popleft())
+                while not todo and len(running) < max_workers:
+                    item = straggler()
+                    if item is None:
+                        break
+                    print(f"Speculating on {item[2]}, expected {expected[item[1]]} seconds")
+                    speculated.add(item[1])
+                    submit(item)
+                done, _ = wait(running, timeout=1, return_when=FIRST_COMPLETED)
+                for future in done:
+                    (package, dst, src_url), _ = running.pop(future)
+                    copies[dst] -= 1
+                    if dst in finished:
+                        continue
+                    try:
+                        seconds = future.result()
+                    except Exception as e:
+                        # another copy may still make it
+                        if copies[dst]:
+                            continue
+                        print(f"Failure: {package}, {src_url}, {repr(e)}")
+                        self.fail(dst, repr(e))
+                    else:
+                        self.complete(dst, seconds)
+                        model.observe(package, sizes.get(dst), seconds)
+                    finished.add(dst)
+                    progress.update()
+        if running:
+            abandon(pool)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("queue_path")
+    parser.add_argument("--failures", action="store_true", help="list the quarantined artifacts")
+    parser.add_argument("--release", action="store_true", help="retry the quarantined artifacts")
+
+    args = parser.parse_args()
+    work_queue = WorkQueue(args.queue_path)
+    if args.failures:
+        for src_url, attempts, error in work_queue.failures():
+            print(f"{src_url}  {attempts} attempts  {error}")
+    if args.release:
+        print(f"Released {work_queue.release()} artifacts")
+    print(work_queue.stats())
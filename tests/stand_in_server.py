@@ -0,0 +1,187 @@
+"""Local stand in for the symbol table web service used to test the clients without the network"""
+import gzip
+import hashlib
+import hmac
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import msgpack
+import zstandard
+
+
+class StandInServer:
+    """In memory store of json documents served over HTTP.
+
+    ``PUT <path>`` stores the body at ``<path>`` and the ``metadata`` query parameter at ``<path>/metadata``, or
+    without the parameter the ``metadata`` entry of the body when it has one,
+    ``GET`` returns a stored document or, for collections, the names of the documents under it, ``DELETE``
+    removes a document.
+    ``fail_next`` makes the next requests answer with an error status to exercise retries.
+    Responses carry an ETag unless ``send_etags`` is turned off, conditional GETs are answered with 304 when the
+    document is unchanged and writes with a failing If-Match/If-None-Match with 412.
+    A ``PUT`` with an ``X-Upload-Id`` header is only staged, ``POST <path>/commit`` checks its signature against
+    ``secret`` and stores it.
+    Bodies are json or msgpack according to their Content-Type, responses are msgpack when the Accept header
+    asks for it first.
+    """
+
+    def __init__(self, secret=b""):
+        self.secret = secret
+        self.send_etags = True
+        self.store = {}
+        self.staged = {}
+        self.requests = []
+        self.raw_bodies = []
+        self._failures = []
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _reply(self, status, body):
+                content_type = "application/json"
+                if self.headers.get("Accept", "").startswith("application/msgpack"):
+                    content_type = "application/msgpack"
+                    data = msgpack.packb(body)
+                else:
+                    data = json.dumps(body).encode()
+                etag = server.etag(body)
+                if status == 200 and self.command == "GET" and self.headers.get("If-None-Match") == etag:
+                    status, data = 304, b""
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                if status in {200, 304} and server.send_etags:
+                    self.send_header("ETag", etag)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _read_chunked(self):
+                chunks = []
+                while True:
+                    size = int(self.rfile.readline().split(b";")[0], 16)
+                    chunks.append(self.rfile.read(size))
+                    self.rfile.readline()
+                    if size == 0:
+                        return b"".join(chunks)
+
+            def _read_body(self):
+                if self.headers.get("Transfer-Encoding") == "chunked":
+                    body = self._read_chunked()
+                else:
+                    body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                server.raw_bodies.append((self.headers, body))
+                return body
+
+            def do_GET(self):
+                status, body = server.handle("GET", self.path, self.headers, b"")
+                self._reply(status, body)
+
+            def do_PUT(self):
+                status, body = server.handle("PUT", self.path, self.headers, self._read_body())
+                self._reply(status, body)
+
+            def do_DELETE(self):
+                status, body = server.handle("DELETE", self.path, self.headers, b"")
+                self._reply(status, body)
+
+            def do_POST(self):
+                status, body = server.handle("POST", self.path, self.headers, self._read_body())
+                self._reply(status, body)
+
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self._httpd.server_address[1]}"
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def fail_next(self, n, status=503):
+        with self._lock:
+            self._failures.extend([status] * n)
+
+    @staticmethod
+    def _decode(body, headers):
+        encoding = headers.get("Content-Encoding", "identity")
+        if encoding == "gzip":
+            return gzip.decompress(body)
+        if encoding == "zstd":
+            return zstandard.ZstdDecompressor().decompressobj().decompress(body)
+        return body
+
+    @staticmethod
+    def _parse(body, headers):
+        if headers.get("Content-Type") == "application/msgpack":
+            return msgpack.unpackb(body)
+        return json.loads(body)
+
+    @staticmethod
+    def etag(document):
+        return f'"{hashlib.sha256(json.dumps(document, sort_keys=True).encode()).hexdigest()}"'
+
+    def _precondition_failed(self, path, headers):
+        if "If-Match" in headers:
+            return path not in self.store or self.etag(self.store[path]) != headers["If-Match"]
+        return headers.get("If-None-Match") == "*" and path in self.store
+
+    def _commit(self, path, parsed, headers):
+        staged_path, raw_body, body = self.staged.pop(headers.get("X-Upload-Id"), (None, None, None))
+        if staged_path != path:
+            return 404, None
+        signature = hmac.new(self.secret, raw_body, hashlib.sha256).hexdigest()
+        if not hmac.compare_digest(signature, headers.get("X-Body-Signature", "")):
+            return 403, None
+        if self._precondition_failed(path, headers):
+            return 412, None
+        self._put(path, parsed, body)
+        return 200, None
+
+    def _put(self, path, parsed, document):
+        self.store[path] = document
+        metadata = parse_qs(parsed.query).get("metadata")
+        if metadata:
+            self.store[f"{path}/metadata"] = json.loads(metadata[0])
+        elif isinstance(document, dict) and document.get("metadata") is not None:
+            self.store[f"{path}/metadata"] = document["metadata"]
+
+    def handle(self, method, raw_path, headers, raw_body):
+        body = self._decode(raw_body, headers)
+        parsed = urlparse(raw_path)
+        path = parsed.path.rstrip("/")
+        with self._lock:
+            self.requests.append((method, path))
+            if self._failures:
+                return self._failures.pop(0), None
+            if method == "PUT" and "X-Upload-Id" in headers:
+                self.staged[headers["X-Upload-Id"]] = (path, raw_body, self._parse(body, headers))
+                return 200, None
+            if method == "POST" and path.endswith("/commit"):
+                return self._commit(path[: -len("/commit")], parsed, headers)
+            if method == "DELETE":
+                if path not in self.store:
+                    return 404, None
+                del self.store[path]
+                self.store.pop(f"{path}/metadata", None)
+                return 200, None
+            if method == "PUT":
+                if self._precondition_failed(path, headers):
+                    return 412, None
+                self._put(path, parsed, self._parse(body, headers))
+                return 200, None
+            if path in self.store:
+                return 200, self.store[path]
+            children = sorted(
+                {k[len(path) + 1 :].rsplit("/metadata", 1)[0] for k in self.store if k.startswith(f"{path}/")}
+            )
+            if children:
+                return 200, children
+            return 404, None
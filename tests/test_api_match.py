@@ -1,4 +1,14 @@
-from symbol_exporter.api_match import find_supplying_version_set, recursive_get_from_table
+import threading
+import time
+
+from symbol_exporter.api_match import (
+    ArtifactBitsets,
+    extract_artifacts_from_deps,
+    find_supplying_version_set,
+    recursive_get_from_table,
+    ResolutionCache,
+    SymbolResolver,
+)
 
 SAMPLE_TABLE = {
     "academic": {
@@ -180,3 +190,126 @@ def test_cycle():
 
     intersection, bad = find_supplying_version_set(volume, get_symbol_table_func=get_symbol_table_dummy_func)
     assert intersection == {"astropy": {"cchardet/conda-forge/linux-64/cchardet-2.1.1-py27_0"}}
+
+
+def test_resolver_matches_recursive_get_from_table():
+    resolver = SymbolResolver(get_symbol_table_dummy_func)
+    symbols = [
+        symbol
+        for table in SAMPLE_TABLE.values()
+        for prefix in table
+        for symbol in [prefix, f"{prefix}.child", f"{prefix}.child.grandchild"]
+    ] + ["missing.symbol", "shadow_academic.cli.AcademicError", "cchardet._cchardet.detect_with_confidence"]
+    for _ in range(2):
+        for symbol in symbols:
+            assert resolver.resolve(symbol) == recursive_get_from_table(symbol, get_symbol_table_dummy_func)
+    assert resolver.stats()["hits"] >= len(symbols)
+
+
+def test_resolver_follows_table_changes(tmp_path):
+    tables = {"pkg": {"symbol table": {"pkg.f": [{"artifact name": "a"}]}, "metadata": {"indexed artifacts": ["a"]}}}
+    fetched = []
+
+    def get_symbol_table(top_level_name):
+        fetched.append(top_level_name)
+        return tables.get(top_level_name, {})
+
+    resolver = SymbolResolver(get_symbol_table, cache=ResolutionCache(tmp_path))
+    assert resolver.resolve("pkg.f") == {"pkg.f": ["a"]}
+    # the table is only fetched once outside of prefetched
+    assert resolver.resolve("pkg.g") == {}
+    assert fetched == ["pkg"]
+    resolver.save()
+
+    restarted = SymbolResolver(lambda top: tables.get(top, {}), cache=ResolutionCache(tmp_path))
+    assert restarted.resolve("pkg.f") == {"pkg.f": ["a"]}
+    assert restarted.stats()["misses"] == 0
+
+    tables["pkg"] = {
+        "symbol table": {"pkg.f": [{"artifact name": "a"}, {"artifact name": "b"}]},
+        "metadata": {"indexed artifacts": ["a", "b"]},
+    }
+    assert resolver.resolve("pkg.f") == {"pkg.f": ["a"]}
+    with resolver.prefetched(["pkg.f"]):
+        assert resolver.resolve("pkg.f") == {"pkg.f": ["a", "b"]}
+    assert resolver.resolve("pkg.f") == {"pkg.f": ["a", "b"]}
+    with restarted.prefetched(["pkg.f"]):
+        assert restarted.resolve("pkg.f") == {"pkg.f": ["a", "b"]}
+
+
+def test_resolver_keeps_a_bounded_number_of_tables(tmp_path):
+    resolver = SymbolResolver(get_symbol_table_dummy_func, cache=ResolutionCache(tmp_path), max_tables=2)
+    symbols = ["academic.cli", "zappy", "astropy.A", "cchardet", "shadow_academic.cli.AcademicError"]
+    for symbol in symbols:
+        assert resolver.resolve(symbol) == recursive_get_from_table(symbol, get_symbol_table_dummy_func)
+        assert len(resolver._tables) <= 2
+        assert set(resolver._prefixes) <= set(resolver._tables)
+    resolver.save()
+
+    # the resolutions of the evicted tables were saved with them
+    restarted = SymbolResolver(get_symbol_table_dummy_func, cache=ResolutionCache(tmp_path))
+    for symbol in symbols:
+        restarted.resolve(symbol)
+    assert restarted.stats()["misses"] == 0
+
+
+def test_artifact_bitsets():
+    bitsets = ArtifactBitsets()
+    artifacts = [f"pkg/conda-forge/noarch/pkg-{i}-py_0" for i in range(20)]
+    everything = bitsets.bitset("pkg", artifacts)
+    evens = bitsets.bitset("pkg", artifacts[::2])
+    assert bitsets.bitset("pkg", artifacts) == everything == 2**20 - 1
+    assert bitsets.names("pkg", everything & evens) == set(artifacts[::2])
+    assert bitsets.names("pkg", evens & bitsets.bitset("pkg", ["pkg/conda-forge/noarch/pkg-new-py_0"])) == set()
+    assert bitsets.bitset("other", artifacts[5:6]) == 1
+
+
+def test_resolver_shared_between_volumes():
+    resolver = SymbolResolver(get_symbol_table_dummy_func)
+    for _ in range(2):
+        intersection, bad = find_supplying_version_set(
+            {"academic.cli", "academic.cli.AcademicError", "zappy.missing"}, resolver=resolver
+        )
+        assert intersection == {
+            "academic": {"academic-0.5.1-py_0", "academic-0.6.1-py_0", "academic-0.6.2-py_0", "academic-0.7.0-py_0"}
+        }
+        assert bad == {"zappy.missing"}
+
+
+def test_extract_artifacts_from_deps():
+    deps = {
+        "academic": {
+            "academic/conda-forge/noarch/academic-0.5.1-py_0",
+            "academic/conda-forge/noarch/academic-0.6.1-py_0",
+        }
+    }
+    assert extract_artifacts_from_deps(deps) == {"academic": {"0.5.1", "0.6.1"}}
+
+
+def test_prefetch_fetches_tables_concurrently():
+    in_flight = []
+    fetched = []
+    lock = threading.Lock()
+
+    def slow_get_symbol_table(top_level_name):
+        with lock:
+            in_flight.append(top_level_name)
+            fetched.append((top_level_name, len(in_flight)))
+        time.sleep(0.05)
+        with lock:
+            in_flight.remove(top_level_name)
+        return get_symbol_table_dummy_func(top_level_name)
+
+    resolver = SymbolResolver(slow_get_symbol_table)
+    volume = {"academic.cli", "zappy", "shadow_academic.cli.AcademicError", "cchardet", "astropy.A", "missing.f"}
+    with resolver.prefetched(volume) as tables:
+        assert sorted(tables) == ["academic", "astropy", "cchardet", "missing", "shadow_academic", "zappy"]
+        assert max(n for _, n in fetched) > 1
+        fetched.clear()
+        assert resolver.resolve("shadow_academic.cli.AcademicError") == recursive_get_from_table(
+            "shadow_academic.cli.AcademicError", get_symbol_table_dummy_func
+        )
+        assert fetched == []
+    assert find_supplying_version_set(volume, resolver=resolver) == find_supplying_version_set(
+        volume, get_symbol_table_dummy_func
+    )
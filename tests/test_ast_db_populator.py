@@ -1,10 +1,28 @@
+import functools
+import io
 import json
 import pytest
 import logging
+import tarfile
+import threading
+import zipfile
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
 
-from symbol_exporter.ast_db_populator import fetch_and_run, fetch_artifact, harvest_imports
+import zstandard
+
+from symbol_exporter import ast_db_populator
+from symbol_exporter.ast_db_populator import (
+    fetch_and_run,
+    fetch_artifact,
+    harvest_imports,
+    reap,
+    reap_imports,
+    ResponseStream,
+)
+from symbol_exporter.ast_symbol_extractor import SymbolType
 from symbol_exporter.python_so_extractor import logger
+from symbol_exporter.tools import existing
 
 logger.setLevel(logging.ERROR)
 
@@ -37,3 +55,183 @@ def test_harvest(pkg_path, expected_set):
     harvested_data = harvest_imports(filelike)
     for k in expected_set:
         assert k in harvested_data["symbols"]
+
+
+def make_tar(files, links=(), mode="w:bz2"):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode=mode) as tf:
+        for name, code in files.items():
+            data = code.encode()
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tf.addfile(info, io.BytesIO(data))
+        for name, target in links:
+            info = tarfile.TarInfo(name)
+            info.type = tarfile.SYMTYPE
+            info.linkname = target
+            tf.addfile(info)
+    return buffer.getvalue()
+
+
+def make_artifact(files, links=()):
+    return io.BytesIO(make_tar(files, links))
+
+
+def make_conda_artifact(files):
+    buffer = io.BytesIO()
+    compressor = zstandard.ZstdCompressor()
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_STORED) as zf:
+        zf.writestr("metadata.json", '{"conda_pkg_format_version": 2}')
+        zf.writestr("info-pkg-1.0-py_0.tar.zst", b"not a valid archive")
+        zf.writestr("pkg-pkg-1.0-py_0.tar.zst", compressor.compress(make_tar(files, mode="w")))
+    buffer.seek(0)
+    return buffer
+
+
+def test_harvest_site_packages_in_memory():
+    filelike = make_artifact(
+        {
+            "info/index.json": "{}",
+            "lib/python3.9/site-packages/pkg/__init__.py": "from .core import f\n",
+            "lib/python3.9/site-packages/pkg/core.py": "import os\ndef f():\n    return os.sep\n",
+            "lib/python3.9/site-packages/single.py": "x = 1\n",
+            "bin/script.py": "import sys\n",
+        },
+        links=[("lib/python3.9/site-packages/pkg/linked.py", "core.py")],
+    )
+    harvested_data = harvest_imports(filelike)
+    symbols = harvested_data["symbols"]
+    assert harvested_data["metadata"]["top level symbols"] == {"pkg", "single"}
+    assert symbols["pkg.f"] == {"type": SymbolType.RELATIVE_IMPORT, "data": {"shadows": "pkg.core.f"}}
+    assert symbols["pkg.core.f"]["data"]["symbols_in_volume"] == {"os.sep": {"line number": [3]}}
+    assert "pkg.linked.f" in symbols
+    assert "single.x" in symbols
+
+
+def test_harvest_python_stdlib_in_memory():
+    filelike = make_artifact(
+        {
+            "lib/python3.9/json/__init__.py": "def dumps():\n    pass\n",
+            "lib/python3.9/os.py": "sep = '/'\n",
+        }
+    )
+    symbols = harvest_imports(filelike)["symbols"]
+    assert {"json", "json.dumps", "os", "os.sep"} <= set(symbols)
+
+
+def test_harvest_no_site_packages():
+    assert harvest_imports(make_artifact({"bin/script.py": "import sys\n"})) is None
+
+
+def test_harvest_conda_format():
+    filelike = make_conda_artifact(
+        {
+            "site-packages/pkg/__init__.py": "from .core import f\n",
+            "site-packages/pkg/core.py": "def f():\n    pass\n",
+        }
+    )
+    harvested_data = harvest_imports(filelike, ".conda")
+    assert harvested_data["metadata"]["top level symbols"] == {"pkg"}
+    assert {"pkg", "pkg.f", "pkg.core", "pkg.core.f"} <= set(harvested_data["symbols"])
+
+
+@pytest.fixture
+def artifact_server(tmp_path):
+    handler = functools.partial(SimpleHTTPRequestHandler, directory=str(tmp_path))
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield tmp_path, f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+FILES = {
+    "site-packages/pkg/__init__.py": "from .core import f\n",
+    "site-packages/pkg/core.py": "def f():\n    pass\n",
+}
+
+
+def test_fetch_artifact_streams_tar_bz2(artifact_server):
+    root, url = artifact_server
+    (root / "pkg-1.0-py_0.tar.bz2").write_bytes(make_tar(FILES))
+    filelike = fetch_artifact(f"{url}/pkg-1.0-py_0.tar.bz2", max_memory=1)
+    assert isinstance(filelike, ResponseStream)
+    with filelike:
+        harvested_data = harvest_imports(filelike)
+    assert {"pkg.f", "pkg.core.f"} <= set(harvested_data["symbols"])
+
+
+def test_fetch_artifact_spools_conda(artifact_server):
+    root, url = artifact_server
+    (root / "pkg-1.0-py_0.conda").write_bytes(make_conda_artifact(FILES).getvalue())
+    with fetch_artifact(f"{url}/pkg-1.0-py_0.conda", max_memory=16) as filelike:
+        harvested_data = harvest_imports(filelike, ".conda")
+    assert {"pkg.f", "pkg.core.f"} <= set(harvested_data["symbols"])
+
+
+class FakeResponse:
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.closed = False
+
+    def iter_content(self, chunk_size):
+        for chunk in self.chunks:
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+
+    def close(self):
+        self.closed = True
+
+
+def test_response_stream_bounded_read():
+    resp = FakeResponse([b"abc", b"", b"defg", b"h"])
+    stream = ResponseStream(resp, max_buffer=1, chunk_size=1)
+    assert stream.read(2) == b"ab"
+    assert stream.read() == b"cdefgh"
+    assert stream.read() == b""
+    assert resp.closed
+
+
+def test_response_stream_propagates_errors():
+    stream = ResponseStream(FakeResponse([b"abc", ConnectionError("dropped")]))
+    assert stream.read(3) == b"abc"
+    with pytest.raises(ConnectionError):
+        stream.read()
+
+
+def test_reap_imports_updates_manifest(tmp_path):
+    filelike = make_artifact({"lib/python3.9/site-packages/pkg/__init__.py": "import os\n"})
+    src_url = "https://conda.anaconda.org/conda-forge/noarch/pkg-1.0-py_0.tar.bz2"
+    reap_imports(str(tmp_path), "pkg", "conda-forge/noarch/pkg-1.0-py_0.json", src_url, filelike)
+    assert (tmp_path / "pkg/conda-forge/noarch/pkg-1.0-py_0.json").exists()
+    assert existing(str(tmp_path)) == {"pkg": {"conda-forge/noarch/pkg-1.0-py_0.json"}}
+
+
+def test_reap_resumes_from_the_work_queue(tmp_path, monkeypatch):
+    artifacts = [(p, f"conda-forge/noarch/{p}-1.0-py_0.json", f"https://x/noarch/{p}-1.0-py_0.conda") for p in "abc"]
+    diffs, reaped = [], []
+
+    def outstanding_artifacts(existing_pkg_dict):
+        diffs.append(existing_pkg_dict)
+        return artifacts, {}
+
+    def fetch_and_run(path, package, dst, src_url):
+        reaped.append(package)
+        if package == "b":
+            raise ValueError("corrupt")
+
+    monkeypatch.setattr(ast_db_populator, "outstanding_artifacts", outstanding_artifacts)
+    monkeypatch.setattr(ast_db_populator, "fetch_and_run", fetch_and_run)
+    for _ in range(3):
+        reap(str(tmp_path), {artifacts[2][2]}, number_to_reap=2, single_thread=True, webserver=False)
+    # diffed once, "c" is known bad and "b" is quarantined after three attempts
+    assert len(diffs) == 1
+    assert reaped == ["a", "b", "b", "b"]
+    assert (tmp_path / "_work_queue.sqlite").exists()
+
+    # once the queue runs dry it is diffed again, quarantined artifacts stay put
+    reap(str(tmp_path), (), number_to_reap=2, single_thread=True, webserver=False)
+    assert len(diffs) == 2
+    assert reaped == ["a", "b", "b", "b", "a"]
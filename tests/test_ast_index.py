@@ -0,0 +1,208 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from symbol_exporter.api_match import recursive_get_from_table, SymbolResolver
+from symbol_exporter.ast_index import (
+    artifact_records,
+    bounded_map,
+    build_symbol_tables,
+    close_shadow_chains,
+    inner_loop,
+    merge_symbol_table,
+    RecordSpool,
+    ShadowClosure,
+)
+from symbol_exporter.local_db import LocalDB
+from tests.test_api_match import SAMPLE_TABLE
+
+
+class CountingDB(LocalDB):
+    def __init__(self, path, delta_updates=True):
+        super().__init__(path)
+        self.delta_updates = delta_updates
+        self.pushes = []
+
+    def push_symbol_table(self, top_level_name, symbol_table, if_match=None):
+        self.pushes.append(top_level_name)
+        super().push_symbol_table(top_level_name, symbol_table, if_match)
+
+    def push_symbol_table_delta(self, top_level_name, delta):
+        self.pushes.append(top_level_name)
+        super().push_symbol_table_delta(top_level_name, delta)
+
+
+def add_artifacts(db, n):
+    for i in range(n):
+        symbols = {f"pkg{j}.f{i}": {"type": "function", "data": {}} for j in range(5)}
+        symbols["pkg0.alias"] = {"type": "import", "data": {"shadows": "other.thing"}}
+        symbols["*"] = {"type": "star-import", "data": {}}
+        db.send_to_webserver(
+            {"metadata": {"top level symbols": sorted({k.partition(".")[0] for k in symbols})}, "symbols": symbols},
+            "pkg",
+            f"conda-forge/noarch/pkg-{i}-py_0.json",
+        )
+
+
+@pytest.mark.parametrize("delta_updates", [True, False])
+@pytest.mark.parametrize("max_records", [3, 1000])
+def test_build_matches_per_artifact_indexing(tmp_path, monkeypatch, max_records, delta_updates):
+    batch_db = CountingDB(tmp_path / "batch.sqlite", delta_updates)
+    add_artifacts(batch_db, 6)
+    artifacts = batch_db.get_all_extracted_artifacts()
+    # a table that already knows about one of the artifacts
+    batch_db.push_symbol_table(
+        "pkg1",
+        {
+            "symbol table": {"pkg1.f0": [{"artifact name": artifacts[0]}]},
+            "metadata": {"indexed artifacts": [artifacts[0]]},
+        },
+    )
+    batch_db.pushes.clear()
+
+    monkeypatch.setenv("SYMBOL_EXPORTER_DB", str(tmp_path / "serial.sqlite"))
+    serial_db = LocalDB(tmp_path / "serial.sqlite")
+    add_artifacts(serial_db, 6)
+    serial_db.push_symbol_table(
+        "pkg1",
+        {
+            "symbol table": {"pkg1.f0": [{"artifact name": artifacts[0]}]},
+            "metadata": {"indexed artifacts": [artifacts[0]]},
+        },
+    )
+    for artifact in artifacts:
+        inner_loop(artifact)
+
+    updated = build_symbol_tables(artifacts, batch_db, workers=3, max_records=max_records)
+    assert sorted(updated) == sorted(batch_db.pushes) == [f"pkg{j}" for j in range(5)]
+    for j in range(5):
+        batch_table = batch_db.get_symbol_table(f"pkg{j}")
+        serial_table = serial_db.get_symbol_table(f"pkg{j}")
+        assert batch_table["metadata"]["indexed artifacts"] == serial_table["metadata"]["indexed artifacts"]
+        assert {k: sorted(v, key=str) for k, v in batch_table["symbol table"].items()} == {
+            k: sorted(v, key=str) for k, v in serial_table["symbol table"].items()
+        }
+    assert {"artifact name": artifacts[0], "shadows": "other.thing"} in batch_db.get_symbol_table("pkg0")[
+        "symbol table"
+    ]["pkg0.alias"]
+
+    # nothing left to do on a second run
+    batch_db.pushes.clear()
+    assert build_symbol_tables(artifacts, batch_db, workers=3) == []
+    assert batch_db.pushes == []
+
+
+def test_record_spool_spills_and_partitions(tmp_path):
+    with RecordSpool(4, max_records=5, directory=tmp_path) as spool:
+        for i in range(23):
+            spool.add(f"top{i % 7}", f"top{i % 7}.s{i}", {"artifact name": f"a{i}"})
+        assert spool.spills == 4
+        seen = {}
+        for partition in range(4):
+            for top_level_name, records in spool.read_partition(partition).items():
+                assert spool.partition(top_level_name) == partition
+                assert top_level_name not in seen
+                seen[top_level_name] = records
+    assert sorted(seen) == [f"top{i}" for i in range(7)]
+    assert [symbol for symbol, _ in seen["top0"]] == ["top0.s0", "top0.s7", "top0.s14", "top0.s21"]
+    assert not list(tmp_path.iterdir())
+
+
+def test_concurrent_merges_lose_nothing(tmp_path):
+    db = CountingDB(tmp_path / "db.sqlite", delta_updates=False)
+    add_artifacts(db, 16)
+    artifacts = db.get_all_extracted_artifacts()
+
+    def merge(artifact):
+        symbols = db.get_artifact_symbols(artifact)
+        records = [(symbol, entry) for top, symbol, entry in artifact_records(artifact, symbols) if top == "pkg0"]
+        return merge_symbol_table(db, "pkg0", records)
+
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(merge, artifacts))
+    table = db.get_symbol_table("pkg0")
+    assert sorted(table["metadata"]["indexed artifacts"]) == artifacts
+    assert sorted(e["artifact name"] for e in table["symbol table"]["pkg0.alias"]) == artifacts
+    stats = db.write_stats()
+    assert stats["writes"] - stats["conflicts"] == len(artifacts)
+
+
+def test_shadow_closure_matches_recursive_resolution():
+    tables = dict(SAMPLE_TABLE)
+    # a longer cycle with an exit and a chain going into it
+    tables["ring"] = {
+        "ring.a": [{"artifact name": "ring-1", "shadows": "ring.b"}],
+        "ring.b": [{"artifact name": "ring-1", "shadows": "ring.c"}, {"artifact name": "ring-2"}],
+        "ring.c": [{"artifact name": "ring-1", "shadows": "ring.a"}],
+    }
+    tables["into_ring"] = {"into_ring": [{"artifact name": "into-1", "shadows": "ring"}]}
+
+    def get_symbol_table(top_level_name):
+        return {"symbol table": tables.get(top_level_name, {}), "metadata": {}}
+
+    closure = ShadowClosure(get_symbol_table)
+    for symbol in ["shadow_academic.cli.AcademicError", "cchardet._cchardet", "astropy.A", "astropy.B", "ring.b"]:
+        assert closure.resolve(symbol)[0] == recursive_get_from_table(symbol, get_symbol_table)
+    ring = {"ring.a": ["ring-1"], "ring.b": ["ring-1", "ring-2"], "ring.c": ["ring-1"]}
+    for symbol in ["ring.a", "ring.c"]:
+        assert closure.resolve(symbol)[0] == ring
+    assert closure.resolve("into_ring.a")[0] == dict(ring, into_ring=["into-1"])
+    assert closure.resolve("into_ring.a")[1] == {"into_ring", "ring"}
+
+
+def test_close_shadow_chains(tmp_path):
+    db = LocalDB(tmp_path / "db.sqlite")
+    db.push_symbol_table(
+        "alias",
+        {
+            "symbol table": {"alias": [{"artifact name": "alias-1", "shadows": "pkg"}], "alias.f": []},
+            "metadata": {"indexed artifacts": ["alias-1"]},
+        },
+    )
+    db.push_symbol_table(
+        "pkg",
+        {
+            "symbol table": {"pkg": [{"artifact name": "pkg-1"}], "pkg.f": [{"artifact name": "pkg-1"}]},
+            "metadata": {"indexed artifacts": ["pkg-1"]},
+        },
+    )
+    assert close_shadow_chains(db, ["alias", "pkg"]) == ["alias"]
+    assert "shadow closure" not in db.get_symbol_table("alias")
+    closure = db.get_shadow_closure("alias")
+    assert closure["symbols"] == {"alias": {"alias": ["alias-1"], "pkg": ["pkg-1"]}}
+
+    resolver = SymbolResolver(db.get_symbol_table)
+    assert resolver.resolve("alias.f") == {"alias": ["alias-1"], "pkg.f": ["pkg-1"]}
+    assert resolver.resolve("alias") == {"alias": ["alias-1"], "pkg": ["pkg-1"]}
+    assert resolver.stats() == {"hits": 1, "misses": 2, "hit rate": 1 / 3}
+
+    # indexing more artifacts into pkg makes the closure out of date
+    db.push_symbol_table_delta(
+        "pkg", {"symbol table": {"pkg.g": [{"artifact name": "pkg-2"}]}, "metadata": {"indexed artifacts": ["pkg-2"]}}
+    )
+    assert SymbolResolver(db.get_symbol_table).resolve("alias.g") == {"alias": ["alias-1"], "pkg.g": ["pkg-2"]}
+    resolver = SymbolResolver(db.get_symbol_table)
+    assert resolver._closure("alias", "alias", resolver._table("alias")[1]) is None
+
+
+def test_bounded_map_keeps_a_window():
+    lock = threading.Lock()
+    started = []
+    consumed = 0
+    ahead = []
+
+    def func(i):
+        with lock:
+            started.append(i)
+            ahead.append(len(started) - consumed)
+        return i * i
+
+    with ThreadPoolExecutor(8) as pool:
+        results = []
+        for result in bounded_map(pool, func, range(100), 4):
+            results.append(result)
+            with lock:
+                consumed += 1
+    assert results == [i * i for i in range(100)]
+    assert max(ahead) <= 5
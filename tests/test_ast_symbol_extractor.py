@@ -731,3 +731,32 @@ def test_symbols_in_volume_names():
         "mm.ast": {"data": {"shadows": "ast"}, "type": SymbolType.IMPORT},
         "mm.z": {"data": {"lineno": 4}, "type": SymbolType.CONSTANT},
     }
+
+
+def test_scope_table_shadowed_surface_symbols():
+    code = """
+    def f():
+        pass
+
+    from abc import f
+    from xyz import g as f2
+    """
+    z = process_code_str(code)
+    assert z._symbol_in_unshadowed_surface_area("f") is None
+    assert z._symbol_in_unshadowed_surface_area("f2") is None
+    assert z._scope_table.imported_symbols == {"abc.f", "xyz.g"}
+
+
+def test_scope_table_function_frames():
+    code = """
+    def f(a, *args, b=None, **kwargs):
+        a()
+        kwargs()
+        c()
+
+    def g():
+        a()
+    """
+    z = process_code_str(code)
+    assert z.undeclared_symbols == {"c", "a"}
+    assert not z._scope_table.frames
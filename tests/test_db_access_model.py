@@ -0,0 +1,344 @@
+import asyncio
+import hashlib
+import hmac
+
+import pytest
+import requests
+
+from symbol_exporter.ast_index import merge_symbol_table
+from symbol_exporter.ast_symbol_extractor import version
+from symbol_exporter.db_access_model import (
+    AsyncWebDB,
+    symbol_table_revision,
+    SymbolTableConflict,
+    UnversionedSymbolTable,
+    WebDB,
+)
+from symbol_exporter.disk_cache import ResponseCache
+from symbol_exporter.sessions import get_session, make_session
+
+from .stand_in_server import StandInServer
+
+
+@pytest.fixture
+def server():
+    with StandInServer() as server:
+        yield server
+
+
+@pytest.fixture
+def web_db(server):
+    return WebDB(host=server.url, session=make_session(pool_size=4, backoff_factor=0), cache=False)
+
+
+@pytest.fixture
+def cached_web_db(server, tmp_path):
+    cache = ResponseCache(tmp_path, max_age=3600, negative_ttl=3600)
+    return WebDB(host=server.url, session=make_session(pool_size=4, backoff_factor=0), cache=cache)
+
+
+def test_shared_session():
+    assert get_session() is get_session()
+
+
+def test_push_and_get_symbol_table(server, web_db):
+    table = {"symbol table": {"pkg.f": [{"artifact name": "a"}]}, "metadata": {"indexed artifacts": ["a"]}}
+    urls = []
+    web_db.session.hooks["response"].append(lambda r, *args, **kwargs: urls.append(r.request.url))
+    web_db.push_symbol_table("pkg", table)
+    assert web_db.get_symbol_table("pkg") == table
+    assert web_db.get_symbol_table_metadata("pkg") == {"indexed artifacts": ["a"]}
+    assert [url for url in urls if "?metadata=" in url] == [
+        f"{server.url}/api/v{version}/symbol_table/pkg?metadata=%7B%22indexed+artifacts%22%3A%5B%22a%22%5D%7D"
+    ]
+
+
+@pytest.mark.parametrize("streaming_upload", [False, True])
+def test_body_metadata(server, streaming_upload):
+    web_db = WebDB(
+        host=server.url,
+        session=make_session(backoff_factor=0),
+        cache=False,
+        streaming_upload=streaming_upload,
+        body_metadata=True,
+    )
+    urls = []
+    web_db.session.hooks["response"].append(lambda r, *args, **kwargs: urls.append(r.request.url))
+    web_db.push_symbol_table("pkg", {"symbol table": {}, "metadata": {"indexed artifacts": ["a"]}})
+    assert web_db.get_symbol_table_metadata("pkg") == {"indexed artifacts": ["a"]}
+    assert not [url for url in urls if "?" in url]
+
+
+def test_get_retries_transient_errors(server, web_db):
+    server.store[f"/api/v{version}/symbols/pkg/conda-forge/noarch/pkg-1.0-py_0"] = {"symbols": {"pkg": {}}}
+    server.fail_next(2)
+    assert web_db.get_artifact_symbols("pkg/conda-forge/noarch/pkg-1.0-py_0") == {"pkg": {}}
+    assert len(server.requests) == 3
+
+
+def test_get_gives_up_after_retries(server):
+    web_db = WebDB(host=server.url, session=make_session(retries=1, backoff_factor=0), cache=False)
+    server.fail_next(5)
+    assert web_db.get_symbol_table_metadata("pkg") == {}
+    assert len(server.requests) == 2
+
+
+def test_send_to_webserver(server, web_db):
+    data = {"metadata": {"top level symbols": {"pkg"}}, "symbols": {"pkg": {}}}
+    web_db.send_to_webserver(data, "pkg", "conda-forge/noarch/pkg-1.0-py_0.json")
+    assert web_db.get_all_extracted_artifacts() == ["pkg/conda-forge/noarch/pkg-1.0-py_0"]
+    assert web_db.get_top_level_symbols("pkg/conda-forge/noarch/pkg-1.0-py_0") == ["pkg"]
+
+
+def add_artifact(server, artifact_name, top_level_symbols):
+    server.store[f"/api/v{version}/symbols/{artifact_name}"] = {"symbols": {}}
+    server.store[f"/api/v{version}/symbols/{artifact_name}/metadata"] = {"top level symbols": top_level_symbols}
+
+
+def test_bulk_metadata(server, web_db):
+    for i in range(20):
+        add_artifact(server, f"pkg{i}/conda-forge/noarch/pkg{i}-1.0-py_0", [f"pkg{i}"])
+    names = web_db.get_all_extracted_artifacts() + ["missing/conda-forge/noarch/missing-1.0-py_0"]
+    top_level_symbols = web_db.get_top_level_symbols_many(names, concurrency=4)
+    assert list(top_level_symbols) == names
+    assert top_level_symbols["pkg3/conda-forge/noarch/pkg3-1.0-py_0"] == ["pkg3"]
+    assert top_level_symbols["missing/conda-forge/noarch/missing-1.0-py_0"] == set()
+
+
+def test_bulk_symbol_tables(server, web_db):
+    for name in ["a", "b"]:
+        web_db.push_symbol_table(name, {"symbol table": {name: []}, "metadata": {"indexed artifacts": [name]}})
+    assert web_db.get_symbol_tables(["a", "b", "c"]) == {
+        "a": {"symbol table": {"a": []}, "metadata": {"indexed artifacts": ["a"]}},
+        "b": {"symbol table": {"b": []}, "metadata": {"indexed artifacts": ["b"]}},
+        "c": {},
+    }
+    assert web_db.get_current_symbol_table_artifacts_by_top_level() == {"a": {"a"}, "b": {"b"}}
+
+
+def test_async_client_retries(server):
+    add_artifact(server, "pkg/conda-forge/noarch/pkg-1.0-py_0", ["pkg"])
+
+    async def run():
+        async with AsyncWebDB(server.url, retries=2) as async_db:
+            server.fail_next(2)
+            return await async_db.get_artifact_metadata("pkg/conda-forge/noarch/pkg-1.0-py_0")
+
+    assert asyncio.run(run()) == {"top level symbols": ["pkg"]}
+    assert len(server.requests) == 3
+
+
+def test_cached_reads_avoid_network(server, cached_web_db):
+    table = {"symbol table": {"pkg.f": [{"artifact name": "a"}]}, "metadata": {}}
+    server.store[f"/api/v{version}/symbol_table/pkg"] = table
+    assert cached_web_db.get_symbol_table("pkg") == table
+    assert cached_web_db.get_symbol_table("pkg") == table
+    assert len(server.requests) == 1
+    assert cached_web_db.cache_stats()["hits"] == 1
+
+
+def test_cache_revalidates_with_etag(server, cached_web_db):
+    table = {"symbol table": {}, "metadata": {}}
+    server.store[f"/api/v{version}/symbol_table/pkg"] = table
+    cached_web_db.get_symbol_table("pkg")
+    assert cached_web_db.get_symbol_table("pkg", revalidate=True) == table
+    assert cached_web_db.cache.revalidated == 1
+    server.store[f"/api/v{version}/symbol_table/pkg"] = {"symbol table": {"pkg": []}, "metadata": {}}
+    assert cached_web_db.get_symbol_table("pkg", revalidate=True)["symbol table"] == {"pkg": []}
+    assert cached_web_db.get_symbol_table("pkg")["symbol table"] == {"pkg": []}
+
+
+def test_default_cache_sees_other_writers(server, tmp_path, monkeypatch):
+    monkeypatch.setenv("SYMBOL_EXPORTER_WEBDB_CACHE", str(tmp_path))
+    web_db = WebDB(host=server.url, session=make_session(backoff_factor=0))
+    server.store[f"/api/v{version}/symbol_table/pkg"] = {"symbol table": {}, "metadata": {}}
+    web_db.get_symbol_table("pkg")
+    server.store[f"/api/v{version}/symbol_table/pkg"] = {"symbol table": {"pkg": []}, "metadata": {}}
+    assert web_db.get_symbol_table("pkg")["symbol table"] == {"pkg": []}
+    assert web_db.cache_stats()["misses"] == 2
+
+    monkeypatch.setenv("SYMBOL_EXPORTER_WEBDB_CACHE_MAX_AGE", "3600")
+    assert WebDB(host=server.url).cache.max_age == 3600
+    monkeypatch.setenv("SYMBOL_EXPORTER_WEBDB_CACHE", "")
+    assert WebDB(host=server.url).cache is None
+
+
+def test_cache_negative_results_but_not_failures(server, cached_web_db):
+    server.fail_next(10)
+    assert cached_web_db.get_symbol_table("pkg") == {}
+    n_requests = len(server.requests)
+    # the failure is not remembered
+    assert cached_web_db.get_symbol_table("pkg") == {}
+    assert len(server.requests) > n_requests
+    n_requests = len(server.requests)
+    # but not found is
+    assert cached_web_db.get_symbol_table("pkg") == {}
+    assert len(server.requests) == n_requests
+
+
+def test_cache_invalidated_by_push(server, cached_web_db):
+    cached_web_db.push_symbol_table("pkg", {"symbol table": {}, "metadata": {"indexed artifacts": ["a"]}})
+    assert cached_web_db.get_symbol_table_metadata("pkg") == {"indexed artifacts": ["a"]}
+    cached_web_db.push_symbol_table("pkg", {"symbol table": {}, "metadata": {"indexed artifacts": ["a", "b"]}})
+    assert cached_web_db.get_symbol_table_metadata("pkg") == {"indexed artifacts": ["a", "b"]}
+
+
+def test_response_cache_eviction(server, tmp_path):
+    cache = ResponseCache(tmp_path, max_size=500)
+    web_db = WebDB(host=server.url, session=make_session(backoff_factor=0), cache=cache)
+    for i in range(20):
+        server.store[f"/api/v{version}/symbol_table/pkg{i}"] = {"symbol table": {f"pkg{i}": ["x" * 50]}}
+        web_db.get_symbol_table(f"pkg{i}")
+    cache.evict()
+    assert cache.size() <= 500
+    assert cache.evictions > 0
+
+
+@pytest.mark.parametrize("encoding", ["identity", "gzip", "zstd"])
+def test_compressed_push(server, encoding):
+    web_db = WebDB(host=server.url, session=make_session(backoff_factor=0), cache=False, upload_encoding=encoding)
+    web_db.secret_token = b"secret"
+    table = {"symbol table": {f"pkg.f{i}": [{"artifact name": "a"}] for i in range(100)}, "metadata": {"x": {1}}}
+    web_db.push_symbol_table("pkg", table)
+    assert web_db.get_symbol_table("pkg") == {"symbol table": table["symbol table"], "metadata": {"x": [1]}}
+    assert web_db.get_symbol_table_metadata("pkg") == {"x": [1]}
+    headers, body = server.raw_bodies[-1]
+    assert headers.get("Content-Encoding", "identity") == encoding
+    assert headers["X-Body-Signature"] == hmac.new(b"secret", body, hashlib.sha256).hexdigest()
+    if encoding != "identity":
+        assert len(body) < len(web_db._dumps(table))
+
+
+@pytest.mark.parametrize("encoding", ["identity", "gzip", "zstd"])
+def test_streaming_push(encoding):
+    with StandInServer(secret=b"secret") as server:
+        web_db = WebDB(host=server.url, cache=False, upload_encoding=encoding, streaming_upload=True)
+        web_db.secret_token = b"secret"
+        table = {"symbol table": {f"pkg.f{i}": [{"artifact name": "a"}] for i in range(5000)}, "metadata": {"x": {1}}}
+        server.fail_next(1)
+        web_db.push_symbol_table("pkg", table)
+        assert server.store[f"/api/v{version}/symbol_table/pkg"] == {
+            "symbol table": table["symbol table"],
+            "metadata": {"x": [1]},
+        }
+        assert server.store[f"/api/v{version}/symbol_table/pkg/metadata"] == {"x": [1]}
+        assert server.requests[-1] == ("POST", f"/api/v{version}/symbol_table/pkg/commit")
+        headers, _ = server.raw_bodies[-2]
+        assert headers["Transfer-Encoding"] == "chunked"
+
+
+def test_streaming_push_rejected_with_bad_signature(server):
+    web_db = WebDB(host=server.url, cache=False, streaming_upload=True)
+    web_db.secret_token = b"not the secret"
+    with pytest.raises(requests.HTTPError):
+        web_db.push_symbol_table("pkg", {"symbol table": {}, "metadata": {}})
+    assert not server.store
+
+
+def test_msgpack_transport(server, tmp_path):
+    web_db = WebDB(host=server.url, cache=ResponseCache(tmp_path), serializer="msgpack")
+    table = {"symbol table": {"pkg.f": [{"artifact name": "a"}]}, "metadata": {"indexed artifacts": {"a"}}}
+    web_db.push_symbol_table("pkg", table)
+    headers, _ = server.raw_bodies[-1]
+    assert headers["Content-Type"] == "application/msgpack"
+    expected = {"symbol table": table["symbol table"], "metadata": {"indexed artifacts": ["a"]}}
+    assert web_db.get_symbol_table("pkg") == expected
+    # served from the cache, decoded according to the stored content type
+    assert WebDB(host=server.url, cache=ResponseCache(tmp_path)).get_symbol_table("pkg") == expected
+    assert web_db.get_symbol_tables(["pkg"]) == {"pkg": expected}
+
+
+def test_symbol_table_deltas(server, monkeypatch):
+    monkeypatch.setattr("symbol_exporter.db_access_model.DELTA_COMPACTION_THRESHOLD", 3)
+    web_db = WebDB(host=server.url, session=make_session(backoff_factor=0), cache=False, delta_updates=True)
+    base = {"symbol table": {"pkg.f": [{"artifact name": "a"}]}, "metadata": {"indexed artifacts": ["a"]}}
+    web_db.push_symbol_table("pkg", base)
+    for artifact in ["b", "c"]:
+        delta = {
+            "symbol table": {"pkg.f": [{"artifact name": artifact}], f"pkg.{artifact}": [{"artifact name": artifact}]},
+            "metadata": {"indexed artifacts": [artifact], "version": version},
+        }
+        web_db.push_symbol_table_delta("pkg", delta)
+    # the base table is untouched, readers see it with the deltas applied
+    assert server.store[f"/api/v{version}/symbol_table/pkg"] == base
+    assert len(web_db.get_symbol_table_deltas("pkg")) == 2
+    expected = {
+        "symbol table": {
+            "pkg.f": [{"artifact name": "a"}, {"artifact name": "b"}, {"artifact name": "c"}],
+            "pkg.b": [{"artifact name": "b"}],
+            "pkg.c": [{"artifact name": "c"}],
+        },
+        "metadata": {"indexed artifacts": ["a", "b", "c"], "version": version},
+    }
+    assert web_db.get_symbol_table("pkg") == expected
+    assert web_db.get_symbol_table_metadata("pkg") == expected["metadata"]
+    assert web_db.get_current_symbol_table_artifacts_by_top_level() == {"pkg": {"a", "b", "c"}}
+    assert web_db.get_symbol_tables(["pkg"]) == {"pkg": expected}
+
+    # a replayed delta is ignored and the third one triggers compaction
+    web_db.push_symbol_table_delta("pkg", delta)
+    assert web_db.get_symbol_table_deltas("pkg") == []
+    assert server.store[f"/api/v{version}/symbol_table/pkg"] == expected
+    assert web_db.get_symbol_table("pkg") == expected
+
+
+@pytest.mark.parametrize("streaming_upload", [False, True])
+def test_conditional_symbol_table_writes(server, tmp_path, streaming_upload):
+    web_db = WebDB(
+        host=server.url, cache=ResponseCache(tmp_path), streaming_upload=streaming_upload, session=make_session()
+    )
+    other = WebDB(host=server.url, cache=False)
+    table, table_version = web_db.get_symbol_table_versioned("pkg")
+    assert (table, table_version) == ({}, "")
+    web_db.push_symbol_table("pkg", {"symbol table": {}, "metadata": {"indexed artifacts": ["a"]}}, if_match="")
+    with pytest.raises(SymbolTableConflict):
+        other.push_symbol_table("pkg", {"symbol table": {}, "metadata": {}}, if_match="")
+
+    table, table_version = web_db.get_symbol_table_versioned("pkg")
+    assert table["metadata"] == {"indexed artifacts": ["a"]}
+    other.push_symbol_table("pkg", {"symbol table": {}, "metadata": {"indexed artifacts": ["a", "b"]}})
+    with pytest.raises(SymbolTableConflict):
+        web_db.push_symbol_table(
+            "pkg", {"symbol table": {}, "metadata": {"indexed artifacts": ["a", "c"]}}, table_version
+        )
+    table, table_version = web_db.get_symbol_table_versioned("pkg")
+    web_db.push_symbol_table(
+        "pkg", {"symbol table": {}, "metadata": {"indexed artifacts": ["a", "b", "c"]}}, table_version
+    )
+    assert web_db.get_symbol_table_metadata("pkg") == {"indexed artifacts": ["a", "b", "c"]}
+    assert web_db.write_stats() == {"writes": 3, "conflicts": 1, "conflict rate": 1 / 3}
+
+
+@pytest.mark.parametrize("cached", [False, True])
+def test_unversioned_tables_are_not_written_back(server, tmp_path, cached):
+    web_db = WebDB(host=server.url, cache=ResponseCache(tmp_path) if cached else False, session=make_session())
+    server.send_etags = False
+    assert web_db.get_symbol_table_versioned("pkg") == ({}, "")
+    base = {"symbol table": {"pkg.f": [{"artifact name": "a"}]}, "metadata": {"indexed artifacts": ["a"]}}
+    server.store[f"/api/v{version}/symbol_table/pkg"] = base
+    with pytest.raises(UnversionedSymbolTable):
+        web_db.get_symbol_table_versioned("pkg")
+
+    # neither a merge nor a compaction overwrites the table
+    records = [("pkg.g", {"artifact name": "b"})]
+    assert merge_symbol_table(web_db, "pkg", records) is None
+    server.store[f"/api/v{version}/symbol_table/pkg/deltas/1"] = {"symbol table": {}, "metadata": {}}
+    web_db.compact_symbol_table("pkg")
+    assert server.store[f"/api/v{version}/symbol_table/pkg"] == base
+    assert web_db.get_symbol_table_deltas("pkg") == ["1"]
+
+
+def test_push_shadow_closure(cached_web_db):
+    table = {
+        "symbol table": {"pkg": [{"artifact name": "a", "shadows": "other"}]},
+        "metadata": {"indexed artifacts": ["a"]},
+    }
+    assert cached_web_db.get_shadow_closure("pkg") is None
+    cached_web_db.push_symbol_table("pkg", table)
+    closure = {"revisions": {"pkg": symbol_table_revision(table)}, "symbols": {"pkg": {}}}
+    cached_web_db.push_shadow_closure("pkg", closure)
+    assert cached_web_db.get_shadow_closure("pkg") == closure
+    # the closure is a document of its own, the table is neither downloaded nor rewritten for it
+    assert cached_web_db.get_symbol_table("pkg") == table
+    assert cached_web_db.get_current_symbol_table_artifacts_by_top_level() == {"pkg": {"a"}}
+    assert cached_web_db.write_stats()["writes"] == 2
@@ -0,0 +1,108 @@
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from symbol_exporter import ast_index
+from symbol_exporter.api_match import find_supplying_version_set
+from symbol_exporter.ast_symbol_extractor import SymbolType
+from symbol_exporter.db_access_model import open_db, SymbolTableConflict, WebDB
+from symbol_exporter.local_db import LocalDB
+
+
+@pytest.fixture
+def local_db(tmp_path):
+    return LocalDB(tmp_path / "symbols.sqlite")
+
+
+def harvested(*symbols):
+    return {
+        "metadata": {"data model version": "1", "top level symbols": {s.partition(".")[0] for s in symbols}},
+        "symbols": {
+            s: {"type": SymbolType.FUNCTION, "data": {"lineno": 1, "symbols_in_volume": {"os.path"}}} for s in symbols
+        },
+    }
+
+
+def test_open_db(tmp_path):
+    assert isinstance(open_db(str(tmp_path / "db.sqlite")), LocalDB)
+    assert isinstance(open_db("http://localhost:1234"), WebDB)
+
+
+def test_artifacts_round_trip(local_db):
+    local_db.send_to_webserver(harvested("a.f", "a.g"), "a", "conda-forge/noarch/a-1.0-py_0.json")
+    local_db.send_to_webserver(None, "b", "conda-forge/noarch/b-1.0-py_0.json")
+    name = "a/conda-forge/noarch/a-1.0-py_0"
+    assert local_db.get_all_extracted_artifacts() == [name, "b/conda-forge/noarch/b-1.0-py_0"]
+    assert local_db.get_current_extracted_pkgs()["a"] == {name}
+    assert local_db.get_top_level_symbols(name) == ["a"]
+    assert local_db.get_top_level_symbols("b/conda-forge/noarch/b-1.0-py_0") == set()
+    assert local_db.get_artifact_symbols(name)["a.f"] == {
+        "type": "function",
+        "data": {"lineno": 1, "symbols_in_volume": ["os.path"]},
+    }
+    assert local_db.get_artifacts_providing("a.g") == [name]
+    # re-sending replaces the artifact
+    local_db.send_to_webserver(harvested("a.f"), "a", "conda-forge/noarch/a-1.0-py_0.json")
+    assert set(local_db.get_artifact_symbols(name)) == {"a.f"}
+
+
+def test_symbol_table_round_trip(local_db):
+    assert local_db.get_symbol_table("pkg") == {}
+    assert local_db.get_symbol_table_metadata("pkg") == {}
+    table = {
+        "symbol table": {"pkg.f": [{"artifact name": "a"}, {"artifact name": "b", "shadows": "other.f"}]},
+        "metadata": {"indexed artifacts": ["a", "b"]},
+    }
+    local_db.push_symbol_table("Pkg", table)
+    assert local_db.get_symbol_table("pkg") == table
+    assert local_db.get_symbol_tables(["pkg", "missing"]) == {"pkg": table, "missing": {}}
+    assert local_db.get_current_symbol_table_artifacts_by_top_level() == {"pkg": {"a", "b"}}
+    local_db.push_symbol_table("pkg", {"symbol table": {}, "metadata": {"indexed artifacts": []}})
+    assert local_db.get_symbol_table("pkg") == {"symbol table": {}, "metadata": {"indexed artifacts": []}}
+
+
+def test_symbol_table_revisions(local_db):
+    assert local_db.get_symbol_table_versioned("pkg") == ({}, 0)
+    local_db.push_symbol_table("pkg", {"symbol table": {}, "metadata": {"indexed artifacts": ["a"]}}, if_match=0)
+    table, revision = local_db.get_symbol_table_versioned("pkg")
+    assert revision == 1
+    local_db.push_symbol_table_delta("pkg", {"symbol table": {}, "metadata": {"indexed artifacts": ["b"]}})
+    with pytest.raises(SymbolTableConflict):
+        local_db.push_symbol_table("pkg", table, if_match=revision)
+    assert local_db.get_symbol_table_metadata("pkg") == {"indexed artifacts": ["a", "b"]}
+    assert local_db.write_stats() == {"writes": 3, "conflicts": 1, "conflict rate": 1 / 3}
+
+
+def test_pushes_keep_the_shadow_closure(local_db):
+    local_db.push_symbol_table("pkg", {"symbol table": {}, "metadata": {"indexed artifacts": ["a"]}})
+    closure = {"revisions": {"pkg": "r"}, "symbols": {"pkg.f": {"pkg.f": ["a"]}}}
+    local_db.push_shadow_closure("pkg", closure)
+    local_db.push_symbol_table_delta("pkg", {"symbol table": {}, "metadata": {"indexed artifacts": ["b"]}})
+    assert local_db.get_shadow_closure("pkg") == closure
+    local_db.push_symbol_table("pkg", {"symbol table": {}, "metadata": {"indexed artifacts": ["a", "b"]}})
+    assert local_db.get_shadow_closure("pkg") == closure
+    assert local_db.get_symbol_table_versioned("pkg")[1] == 3
+
+
+def test_threads_and_pickling(local_db):
+    def push(i):
+        local_db.push_symbol_table(f"pkg{i}", {"symbol table": {f"pkg{i}.f": [{"artifact name": "a"}]}, "metadata": {}})
+
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(push, range(32)))
+    clone = pickle.loads(pickle.dumps(local_db))
+    assert len(clone.get_current_symbol_table_artifacts_by_top_level()) == 32
+
+
+def test_offline_index_and_match(tmp_path, monkeypatch):
+    monkeypatch.setenv("SYMBOL_EXPORTER_DB", str(tmp_path / "symbols.sqlite"))
+    db = open_db()
+    db.send_to_webserver(harvested("a.f", "a.g"), "a", "conda-forge/noarch/a-1.0-py_0.json")
+    db.send_to_webserver(harvested("a.f"), "a", "conda-forge/noarch/a-0.9-py_0.json")
+    for artifact in db.get_all_extracted_artifacts():
+        ast_index.inner_loop(artifact)
+    assert db.get_current_symbol_table_artifacts_by_top_level() == {"a": set(db.get_all_extracted_artifacts())}
+    supplies, bad = find_supplying_version_set({"a.f", "a.g", "b.h"}, db.get_symbol_table)
+    assert supplies == {"a": {"a/conda-forge/noarch/a-1.0-py_0"}}
+    assert bad == {"b.h"}
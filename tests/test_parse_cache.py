@@ -0,0 +1,45 @@
+from symbol_exporter.ast_package_symbol_extractor import parse_code
+from symbol_exporter.ast_symbol_extractor import SymbolType
+from symbol_exporter.parse_cache import ParseCache
+
+CODE = """
+from abc import *
+import numpy as np
+
+def f():
+    return np.ones(5)
+"""
+
+
+def test_parse_code_uses_cache(tmpdir):
+    cache = ParseCache(tmpdir)
+    first = parse_code(CODE, "mm", cache=cache)
+    second = parse_code(CODE, "mm", cache=cache)
+    assert first == second
+    assert second["mm.*"] == {"type": SymbolType.STAR_IMPORT, "data": {"imports": {"abc"}}}
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_cache_keyed_by_module_name(tmpdir):
+    cache = ParseCache(tmpdir)
+    parse_code(CODE, "mm", cache=cache)
+    symbols = parse_code(CODE, "nn", cache=cache)
+    assert "nn.f" in symbols
+    assert cache.hits == 0
+
+
+def test_cache_shared_between_instances(tmpdir):
+    parse_code(CODE, "mm", cache=ParseCache(tmpdir))
+    cache = ParseCache(tmpdir)
+    parse_code(CODE, "mm", cache=cache)
+    assert cache.hits == 1
+
+
+def test_cache_eviction(tmpdir):
+    cache = ParseCache(tmpdir, max_size=2000)
+    for i in range(20):
+        parse_code(CODE + f"\nx{i} = {i}\n", "mm", cache=cache)
+    cache.evict()
+    assert cache.size() <= 2000
+    assert cache.evictions > 0
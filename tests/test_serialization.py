@@ -0,0 +1,67 @@
+import gzip
+import hashlib
+import hmac
+import json
+from enum import Enum
+
+import pytest
+import zstandard
+
+from symbol_exporter.serialization import (
+    dumps_canonical,
+    get_serializer,
+    iter_encoded_chunks,
+    iter_json_chunks,
+    loads_content,
+    SignedChunks,
+)
+
+
+class Kind(Enum):
+    function = "function"
+
+
+DATA = {
+    "symbol table": {f"pkg.f{i}": [{"artifact name": f"a{i}", "type": Kind.function}] for i in range(300)},
+    "metadata": {"indexed artifacts": {"b", "a"}, "version": 1},
+    "ünïcode": None,
+}
+
+
+def test_json_chunks_match_canonical_dump():
+    assert "".join(iter_json_chunks(DATA)) == dumps_canonical(DATA)
+    assert "".join(iter_json_chunks([1, 2])) == dumps_canonical([1, 2])
+
+
+@pytest.mark.parametrize(
+    "encoding,decompress",
+    [
+        ("identity", lambda b: b),
+        ("gzip", gzip.decompress),
+        ("zstd", lambda b: zstandard.ZstdDecompressor().decompressobj().decompress(b)),
+    ],
+)
+def test_signed_encoded_chunks(encoding, decompress):
+    chunks = get_serializer("json").iter_chunks(DATA)
+    signed = SignedChunks(iter_encoded_chunks(chunks, encoding, chunk_size=1024), b"key")
+    chunks = list(signed)
+    body = b"".join(chunks)
+    if encoding == "identity":
+        assert len(chunks) > 1
+    assert signed.size == len(body)
+    assert signed.hexdigest() == hmac.new(b"key", body, hashlib.sha256).hexdigest()
+    assert decompress(body) == dumps_canonical(DATA).encode()
+
+
+@pytest.mark.parametrize("name", ["json", "msgpack"])
+def test_serializers_round_trip_like_json(name):
+    serializer = get_serializer(name)
+    body = serializer.dumps(DATA)
+    assert b"".join(serializer.iter_chunks(DATA)) == body
+    assert serializer.loads(body) == json.loads(dumps_canonical(DATA))
+    assert loads_content(body, f"{serializer.content_type}; charset=utf-8") == serializer.loads(body)
+
+
+def test_unknown_serializer():
+    with pytest.raises(ValueError):
+        get_serializer("pickle")
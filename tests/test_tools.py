@@ -1,6 +1,25 @@
+import bz2
+import hashlib
+import io
+import json
+
+import pytest
+
+import requests
 from conda.models.version import VersionSpec
 
-from symbol_exporter.tools import find_version_ranges
+from symbol_exporter import tools
+from symbol_exporter.tools import (
+    existing,
+    existing_versions,
+    find_version_ranges,
+    iter_repodata,
+    iter_repodata_records,
+    load_repodata,
+    Manifest,
+    RepodataCache,
+    VersionIndexes,
+)
 
 
 def check_result(all_versions, acceptable_versions, expected_range):
@@ -44,3 +63,137 @@ def test_versions_acceptable_with_two_islands():
 
 def test_versions_acceptable_with_no_compatible():
     check_result(["1.0", "1.1", "1.1.1", "1.1.2", "1.1.3", "1.1.4", "1.1.5"], [], "")
+
+
+def test_iter_repodata_prefers_conda_format():
+    arch = "https://conda.anaconda.org/conda-forge/noarch"
+    repodata = {
+        "packages": {
+            "a-1.0-py_0.tar.bz2": {"name": "a", "size": 30},
+            "b-1.0-py_0.tar.bz2": {"name": "b"},
+        },
+        "packages.conda": {"a-1.0-py_0.conda": {"name": "a", "size": 20}},
+    }
+    assert sorted(iter_repodata(arch, repodata)) == [
+        ("a", "conda-forge/noarch/a-1.0-py_0.json", f"{arch}/a-1.0-py_0.conda", 20),
+        ("b", "conda-forge/noarch/b-1.0-py_0.json", f"{arch}/b-1.0-py_0.tar.bz2", None),
+    ]
+
+
+def test_iter_repodata_records_streams_the_packages():
+    repodata = {
+        "info": {"subdir": "noarch", "nested": [{"}": "{"}]},
+        "packages": {
+            "a-1.0-py_0.tar.bz2": {"name": "a", "size": 123456789, "depends": ['python >=3.6,<4.0a0 "quoted"']},
+            "b-1.0-py_0.tar.bz2": {"name": "b", "timestamp": 1.5e12, "noarch": None, "track": True},
+        },
+        "packages.conda": {},
+        "removed": ["c-1.0-py_0.tar.bz2"] * 50,
+        "repodata_version": 1,
+    }
+    expected = [(k, p, v) for k in ["packages", "packages.conda"] for p, v in repodata[k].items()]
+    for text in [json.dumps(repodata), json.dumps(repodata, indent=1)]:
+        for chunk_size in [1, 7, 1024]:
+            assert list(iter_repodata_records(io.StringIO(text), chunk_size=chunk_size)) == expected
+    assert list(iter_repodata_records(io.StringIO(" { } "))) == []
+    with pytest.raises(ValueError):
+        list(iter_repodata_records(io.StringIO(json.dumps(repodata)[:-20]), chunk_size=7))
+
+
+class RepodataSession:
+    """Serves a bz2 compressed repodata with an ETag, counting the requests and the full responses"""
+
+    def __init__(self, repodata):
+        self.body = bz2.compress(json.dumps(repodata).encode())
+        self.requests = 0
+        self.downloads = 0
+
+    def get(self, url, headers=None, timeout=None):
+        self.requests += 1
+        r = requests.Response()
+        r.url = url
+        etag = f'"{hashlib.sha256(self.body).hexdigest()}"'
+        r.headers["ETag"] = etag
+        if (headers or {}).get("If-None-Match") == etag:
+            r.status_code = 304
+            r._content = b""
+        else:
+            self.downloads += 1
+            r.status_code = 200
+            r._content = self.body
+        return r
+
+
+def test_repodata_cache(tmp_path, monkeypatch):
+    arch = "https://conda.anaconda.org/conda-forge/noarch"
+    repodata = {
+        "info": {"subdir": "noarch"},
+        "packages": {"a-1.0-py_0.tar.bz2": {"name": "a", "version": "1.0"}},
+        "packages.conda": {"a-1.1-py_0.conda": {"name": "a", "version": "1.1"}},
+    }
+    session = RepodataSession(repodata)
+    monkeypatch.setattr(tools, "get_session", lambda: session)
+    cache = RepodataCache(tmp_path, max_age=3600)
+    parsed = load_repodata(arch, cache=cache)
+    assert parsed == {k: repodata[k] for k in ["packages", "packages.conda"]}
+    assert existing_versions([arch], cache=cache) == {"a": {"1.0", "1.1"}}
+    assert session.requests == 1
+
+    # stale entries are revalidated and a 304 is served from the parsed copy
+    monkeypatch.setattr(tools, "parse_repodata", None)
+    cache = RepodataCache(tmp_path, max_age=0)
+    assert load_repodata(arch, cache=cache) == parsed
+    assert (session.requests, session.downloads) == (2, 1)
+
+    # selections are streamed from the body once per repodata and kept under the name of the conditional
+    url = f"{arch}/repodata.json.bz2"
+    selection = [("a", "conda-forge/noarch/a-1.1-py_0.json", f"{arch}/a-1.1-py_0.conda", None)]
+    assert cache.select(session, url, arch, only_new) == selection
+    monkeypatch.setattr(tools, "iter_repodata_records", None)
+    assert cache.select(session, url, arch, only_new) == selection
+    with pytest.raises(TypeError):
+        cache.select(session, url, arch, lambda v: True)
+
+    cache.evict()
+    cache.max_size = 0
+    cache.evict()
+    assert not list(tmp_path.glob("*/*"))
+
+
+def only_new(record):
+    return record["version"] != "1.0"
+
+
+def test_version_indexes():
+    indexes = VersionIndexes({"a": {"1.0", "1.1", "1.1.1", "1.1.2"}, "b": {"2.0", "2.1"}})
+    assert indexes.find_version_ranges_many({"a": {"1.0", "1.1", "1.1.2"}, "b": {"2.0"}, "c": {"1.0"}}) == {
+        "a": ">=1.0,<=1.1|>=1.1.2",
+        "b": "2.0",
+        "c": "",
+    }
+    assert indexes["a"] is indexes["a"]
+    assert indexes["a"].ranges({"1.0", "1.1", "1.1.1", "1.1.2", "3.0"}) == find_version_ranges(
+        {"1.0", "1.1", "1.1.1", "1.1.2"}, {"1.0", "1.1", "1.1.1", "1.1.2", "3.0"}
+    )
+
+
+def test_manifest(tmp_path):
+    for relative_path in ["a/conda-forge/noarch/a-1.0-py_0.json", "b/conda-forge/linux-64/b-2.0-py39_0.json"]:
+        (tmp_path / relative_path).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / relative_path).write_text("{}")
+    (tmp_path / "_inspection_version.txt").write_text("1")
+    (tmp_path / "a/conda-forge/noarch/c.tmp").write_text("")
+
+    # built from disk on first use
+    assert existing(str(tmp_path)) == {
+        "a": {"conda-forge/noarch/a-1.0-py_0.json"},
+        "b": {"conda-forge/linux-64/b-2.0-py39_0.json"},
+    }
+    manifest = Manifest(str(tmp_path))
+    manifest.add("a/conda-forge/noarch/a-1.1-py_0.json")
+    # an entry still being written
+    with open(manifest.path, "a") as f:
+        f.write("a/conda-forge/noarch/a-1.2")
+    assert existing(str(tmp_path))["a"] == {"conda-forge/noarch/a-1.0-py_0.json", "conda-forge/noarch/a-1.1-py_0.json"}
+    assert manifest.rebuild() == {"a/conda-forge/noarch/a-1.0-py_0.json", "b/conda-forge/linux-64/b-2.0-py39_0.json"}
+    assert manifest.paths() == manifest.rebuild()
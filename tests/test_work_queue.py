@@ -0,0 +1,149 @@
+import pickle
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pytest
+
+from symbol_exporter.tools import executor
+from symbol_exporter.work_queue import CostModel, WorkQueue
+
+ARTIFACTS = [(p, f"conda-forge/noarch/{p}-1.0-py_0.json", f"https://x/noarch/{p}-1.0-py_0.conda") for p in "abcd"]
+
+
+@pytest.fixture
+def work_queue(tmp_path):
+    return WorkQueue(tmp_path / "queue.sqlite", version="1", max_attempts=2)
+
+
+def test_lease_complete_and_fail(work_queue):
+    work_queue.enqueue(ARTIFACTS)
+    assert work_queue.lease(2) == ARTIFACTS[:2]
+    assert work_queue.lease(1) == ARTIFACTS[2:3]
+    assert work_queue.stats() == {"pending": 1, "leased": 3, "done": 0, "failed": 0}
+
+    for _, dst, _ in ARTIFACTS[:3]:
+        work_queue.start(dst)
+    work_queue.complete(ARTIFACTS[0][1])
+    work_queue.fail(ARTIFACTS[1][1], "boom")
+    work_queue.fail(ARTIFACTS[2][1], "boom")
+    assert work_queue.lease(10) == [ARTIFACTS[1], ARTIFACTS[2], ARTIFACTS[3]]
+    # the second failure quarantines
+    work_queue.start(ARTIFACTS[1][1])
+    work_queue.fail(ARTIFACTS[1][1], "boom again")
+    assert work_queue.failures() == [(ARTIFACTS[1][2], 2, "boom again")]
+    assert work_queue.stats() == {"pending": 0, "leased": 2, "done": 1, "failed": 1}
+
+    assert work_queue.release() == 1
+    assert work_queue.lease(1) == [ARTIFACTS[1]]
+
+
+def test_expired_leases_count_as_failures(tmp_path):
+    work_queue = WorkQueue(tmp_path / "queue.sqlite", max_attempts=2, lease_seconds=-1)
+    work_queue.enqueue(ARTIFACTS[:2])
+    # only the artifacts a worker started are charged, the others were leased in a batch that died first
+    for _ in range(2):
+        assert work_queue.lease(2) == ARTIFACTS[:2]
+        work_queue.start(ARTIFACTS[0][1])
+    assert work_queue.lease(2) == ARTIFACTS[1:2]
+    assert work_queue.failures() == [(ARTIFACTS[0][2], 2, "lease expired")]
+    assert work_queue.stats() == {"pending": 0, "leased": 1, "done": 0, "failed": 1}
+
+
+def test_enqueue_keeps_progress(work_queue, tmp_path):
+    work_queue.enqueue(ARTIFACTS[:3])
+    work_queue.lease(2)
+    work_queue.start(ARTIFACTS[1][1])
+    work_queue.complete(ARTIFACTS[0][1])
+    work_queue.fail(ARTIFACTS[1][1], "boom")
+    work_queue.quarantine([ARTIFACTS[2][2]])
+
+    # a done artifact that is missing again is requeued, pending ones that aren't missing any more are done
+    work_queue.enqueue([ARTIFACTS[3], ARTIFACTS[1], ARTIFACTS[0], ARTIFACTS[2]])
+    assert work_queue.stats() == {"pending": 3, "leased": 0, "done": 0, "failed": 1}
+    assert work_queue.lease(10) == [ARTIFACTS[3], ARTIFACTS[1], ARTIFACTS[0]]
+    work_queue.enqueue([])
+    assert work_queue.stats() == {"pending": 0, "leased": 3, "done": 0, "failed": 1}
+    assert work_queue.age() < 60
+
+    # reopening resumes, a new extractor version starts over
+    assert WorkQueue(work_queue.path, version="1").stats() == work_queue.stats()
+    assert WorkQueue(work_queue.path).stats() == work_queue.stats()
+    assert WorkQueue(work_queue.path, version="2").outstanding() == 0
+
+
+def test_concurrent_leases_are_disjoint(work_queue):
+    items = [(str(i), f"conda-forge/noarch/{i}.json", f"https://x/noarch/{i}.conda") for i in range(200)]
+    work_queue.enqueue(items)
+    copy = pickle.loads(pickle.dumps(work_queue))
+    with ThreadPoolExecutor(8) as pool:
+        leased = [item for batch in pool.map(lambda i: (work_queue, copy)[i % 2].lease(7), range(40)) for item in batch]
+    assert sorted(leased) == sorted(items)
+
+
+def test_run_records_the_outcome(work_queue):
+    work_queue.enqueue(ARTIFACTS[:2])
+    calls = []
+
+    def reap_one(package, dst, src_url):
+        calls.append(package)
+        if package == "b":
+            raise ValueError("not an artifact")
+
+    for item in work_queue.lease(2):
+        work_queue.run(reap_one, *item)
+    assert calls == ["a", "b"]
+    assert work_queue.stats() == {"pending": 1, "leased": 0, "done": 1, "failed": 0}
+
+
+def test_schedule_largest_first(work_queue):
+    items = [(p, f"conda-forge/noarch/{p}.json", f"https://x/noarch/{p}.conda") for p in "abcd"]
+    sizes = {items[0][2]: 10, items[1][2]: 1000, items[2][2]: 100}
+    work_queue.enqueue(items, sizes)
+    leased = work_queue.lease(4)
+    assert [p for p, _, _ in work_queue.schedule(leased)[0]] == ["b", "c", "a", "d"]
+
+    # once packages have been timed their history takes over, "a" turns out to be slow for its size
+    for package, dst, _ in leased:
+        work_queue.complete(dst, seconds={"a": 50, "b": 10, "c": 1, "d": 5}[package])
+    work_queue.enqueue(items, sizes)
+    order, expected, _, _ = work_queue.schedule(work_queue.lease(4))
+    assert [p for p, _, _ in order] == ["a", "b", "d", "c"]
+    assert expected[items[3][1]] == 5
+
+
+def test_cost_model():
+    model = CostModel({"a": (10.0, 100, 2)})
+    assert model.seconds("a", 50) == 5
+    assert model.seconds("a", None) == 5
+    # packages without history go by the overall rate
+    assert model.seconds("b", 200) == 20
+    assert model.seconds("b", None) is None
+    model.observe("b", 100, 30)
+    assert model.seconds("b", 10) == 3
+    assert CostModel().seconds("a", 100) is None
+
+
+def hang_first_copy(package, dst, src_url):
+    # copies run in other processes, they tell each other apart with a marker file next to dst
+    marker = Path(f"{dst}.started")
+    if package == "a" and not marker.exists():
+        marker.touch()
+        time.sleep(600)
+    if package == "c":
+        raise ValueError("corrupt")
+    Path(dst).touch()
+
+
+def test_run_batch_speculates_on_stragglers(tmp_path):
+    work_queue = WorkQueue(tmp_path / "queue.sqlite", max_attempts=2)
+    items = [(p, str(tmp_path / p), f"https://x/noarch/{p}.conda") for p in "abc"]
+    work_queue.enqueue(items, {items[0][2]: 1000})
+    start = time.monotonic()
+    # the copy of "a" that hangs is terminated rather than waited for when the pool is closed
+    with executor("process", 2) as pool:
+        work_queue.run_batch(pool, hang_first_copy, work_queue.lease(3), 2, straggler_seconds=0.5)
+    assert time.monotonic() - start < 60
+    assert (tmp_path / "a").exists() and (tmp_path / "b").exists()
+    assert work_queue.stats() == {"pending": 1, "leased": 0, "done": 2, "failed": 0}
+    assert work_queue.lease(3) == [items[2]]